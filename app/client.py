@@ -0,0 +1,205 @@
+"""The HTTP client shared by everything that talks to Steam, which keeps to a rate limit
+per host, sends fewer requests at once while the host is struggling and retries requests
+that failed for reasons that may pass
+"""
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
+import requests
+from app import metrics
+
+
+# Requests per second to each host, and how many may be sent at once after a pause
+RATE = 20.0
+BURST = 20
+MAX_CONCURRENCY = 16
+MIN_CONCURRENCY = 1
+RETRIES = 4
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 60.0
+# Seconds to connect, and to wait for each part of the response
+TIMEOUT = (10, 60)
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    """Lets requests through at the given average rate per second, allowing bursts of up
+    to the given number of them after a pause. A rate of 0 lets everything through.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """Wait for a token and take it. Return how many seconds were waited."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # Tokens are spoken for in turn, so each thread knows how long to wait
+            wait = max(0.0, -self.tokens / self.rate)
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class AdaptiveLimit:
+    """Limits how many requests are sent at once. The limit halves each time the host is
+    throttling or failing and grows by one for every limit's worth of requests that
+    succeed, up to the maximum.
+    """
+
+    def __init__(self, maximum: int, minimum: int = MIN_CONCURRENCY) -> None:
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self) -> "AdaptiveLimit":
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def succeeded(self) -> None:
+        """Allow a little more at once after a request succeeded"""
+        with self.condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def throttled(self) -> None:
+        """Allow half as much at once after the host throttled or failed a request"""
+        with self.condition:
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+def get_retry_after(response: requests.Response) -> float:
+    """Get how many seconds the response asks to wait before trying again, or 0"""
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Client:
+    """Sends requests through the given session, keeping to the rate and concurrency
+    limits of each host and retrying connection failures, timeouts, throttling and
+    server errors a few times, waiting longer with jitter before each retry
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        rate: float = RATE,
+        burst: int = BURST,
+        max_concurrency: int = MAX_CONCURRENCY,
+        retries: int = RETRIES,
+        backoff: float = RETRY_BACKOFF,
+        timeout: Tuple[float, float] = TIMEOUT,
+    ) -> None:
+        self.session = session
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.hosts: Dict[str, Tuple[TokenBucket, AdaptiveLimit]] = dict()
+        self.lock = threading.Lock()
+
+    def configure(self, rate: float, max_concurrency: int) -> None:
+        """Change the rate and concurrency limits, starting every host afresh"""
+        with self.lock:
+            self.rate = rate
+            self.max_concurrency = max_concurrency
+            self.hosts.clear()
+
+    def get_limits(self, url: str) -> Tuple[TokenBucket, AdaptiveLimit]:
+        """Get the rate and concurrency limits of the URL's host"""
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = (
+                    TokenBucket(self.rate, self.burst),
+                    AdaptiveLimit(self.max_concurrency),
+                )
+            return self.hosts[host]
+
+    def get_retry_delay(self, attempt: int) -> float:
+        """Get how long to wait before the given retry, doubling with each attempt up to
+        a limit, with jitter so that threads don't retry in step
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), RETRY_BACKOFF_MAX)
+        return random.uniform(delay / 2, delay)
+
+    def request(
+        self, method: str, url: str, phase: str = "fetch", **kwargs
+    ) -> requests.Response:
+        """Send the request and return the response, counting retries in the given
+        phase. Raises requests.HTTPError for an error response once it is out of retries
+        or can't be retried, or the last connection error or timeout.
+        """
+        bucket, limit = self.get_limits(url)
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            waited = bucket.take()
+            if waited:
+                metrics.METRICS.add(phase, rate_limited_seconds=waited)
+            response: Optional[requests.Response] = None
+            try:
+                with limit:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                limit.succeeded()
+                if response.status_code >= 400:
+                    raise requests.HTTPError(
+                        f"{response.status_code} response from {url}", response=response
+                    )
+                return response
+            limit.throttled()
+            metrics.METRICS.add(phase, throttled=1)
+            if attempt >= self.retries:
+                assert response is not None
+                raise requests.HTTPError(
+                    f"{response.status_code} response from {url} after "
+                    f"{attempt + 1} tries",
+                    response=response,
+                )
+            attempt += 1
+            delay = self.get_retry_delay(attempt)
+            if response is not None:
+                delay = max(delay, min(get_retry_after(response), RETRY_BACKOFF_MAX))
+            metrics.METRICS.add(phase, retries=1)
+            time.sleep(delay)
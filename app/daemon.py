@@ -0,0 +1,200 @@
+"""Keep the mods up to date from a process that stays running, checking for updates on
+an interval with the state, dependency graph and parsed workshop pages kept in memory
+between checks. A small HTTP endpoint reports the status and lets deploy hooks trigger a
+check straight away.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+import click
+from app import download, files, helpers
+from app.state import STATE_FILENAME, StateStore
+
+
+INTERVAL = 15 * 60
+LISTEN = "127.0.0.1:8710"
+STATUS_PATH = "/status"
+TRIGGER_PATH = "/trigger"
+
+
+class Daemon:
+    """Runs an update with the given update_mods options on an interval, or as soon as
+    it is triggered, keeping the state and dependency graph between updates
+    """
+
+    def __init__(self, options: dict, interval: float = INTERVAL) -> None:
+        self.options = dict(options, check=False)
+        self.interval = interval
+        self.triggered = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.status: dict = {
+            "state": "starting",
+            "runs": 0,
+            "last_exit_code": None,
+            "last_error": None,
+            "last_started": None,
+            "last_finished": None,
+            "next_check": time.time(),
+        }
+        self.graph = files.get_dependency_graph(Path(options["mods_path"]))
+        self.state = StateStore(
+            Path(options["mods_path"]),
+            Path(
+                options["state_path"]
+                or Path(options["download_path"], STATE_FILENAME)
+            ),
+        )
+
+    def get_status(self) -> dict:
+        """Get what the daemon is doing and how the last update went"""
+        with self.lock:
+            return dict(self.status)
+
+    def set_status(self, **status) -> None:
+        """Record what the daemon is doing"""
+        with self.lock:
+            self.status.update(status)
+
+    def trigger(self) -> None:
+        """Check for updates as soon as the current update, if any, is finished"""
+        self.triggered.set()
+
+    def stop(self) -> None:
+        """Stop once the current update, if any, is finished"""
+        self.stopped.set()
+        self.triggered.set()
+
+    def update(self) -> int:
+        """Check for updates and download them if there are any. Cached responses are
+        revalidated, so a changed manifest or workshop page is fetched again, but pages
+        that haven't changed are not parsed again.
+        """
+        started = time.time()
+        self.set_status(state="updating", last_started=started)
+        helpers.VALIDATED.clear()
+        try:
+            exit_code = download.run_update(
+                **self.options, state=self.state, graph=self.graph
+            )
+            error = None
+        except Exception as exception:  # pylint: disable=W0703
+            # One failed update mustn't stop the next
+            click.echo(f"ERROR: Update failed: {exception!r}")
+            exit_code, error = download.EXIT_FAILED, repr(exception)
+        # Only reset the state on the first update
+        self.options["reset_state"] = False
+        with self.lock:
+            self.status.update(
+                state="idle",
+                runs=self.status["runs"] + 1,
+                last_exit_code=exit_code,
+                last_error=error,
+                last_finished=time.time(),
+                next_check=started + self.interval,
+            )
+        return exit_code
+
+    def run(self) -> None:
+        """Update straight away, then every interval or when triggered, until stopped"""
+        try:
+            while not self.stopped.is_set():
+                self.triggered.clear()
+                self.update()
+                wait = max(0.0, self.get_status()["next_check"] - time.time())
+                self.triggered.wait(wait)
+        finally:
+            self.state.close()
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Answers GET /status with the daemon's status and POST /trigger by checking for
+    updates straight away
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """Keep quiet"""
+
+    def send_json(self, status_code: int, body: dict) -> None:
+        """Send the given JSON response"""
+        content = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        """Report the status"""
+        if self.path != STATUS_PATH:
+            self.send_json(404, {"error": "not found"})
+            return
+        self.send_json(200, self.server.updater.get_status())
+
+    def do_POST(self):
+        """Trigger a check for updates"""
+        if self.path != TRIGGER_PATH:
+            self.send_json(404, {"error": "not found"})
+            return
+        self.server.updater.trigger()
+        self.send_json(202, self.server.updater.get_status())
+
+
+def serve_status(updater: Daemon, listen: str) -> ThreadingHTTPServer:
+    """Serve the daemon's status and trigger endpoint at the given host and port in a
+    background thread
+    """
+    host, _, port = listen.rpartition(":")
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), StatusHandler)
+    server.daemon_threads = True
+    server.updater = updater  # type: ignore
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=1),
+    default=INTERVAL,
+    show_default=True,
+    help="Seconds between checks for updates",
+)
+@click.option(
+    "--listen",
+    default=LISTEN,
+    show_default=True,
+    help=(
+        f"Host and port to serve GET {STATUS_PATH} and POST {TRIGGER_PATH} on, or "
+        "nothing to not serve them"
+    ),
+)
+def daemon(interval: float, listen: Optional[str], **options) -> None:
+    """Keeps the mods up to date, checking for updates every interval and downloading
+    them when there are any, with the same options as update_mods
+    """
+    updater = Daemon(options, interval)
+    server = serve_status(updater, listen) if listen else None
+    if server is not None:
+        click.echo(f"Serving status on http://{listen}{STATUS_PATH}")
+    try:
+        updater.run()
+    except KeyboardInterrupt:
+        click.echo("Stopping...")
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+# Takes every option update_mods does, apart from only checking for updates
+daemon.params.extend(
+    param for param in download.update_mods.params if param.name != "check"
+)
+
+
+if __name__ == "__main__":
+    daemon()  # pylint: disable=E1120
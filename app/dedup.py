@@ -0,0 +1,109 @@
+"""Share the data of identical files between the published mods, going by the index of
+their hashes
+"""
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import DefaultDict, Dict, List, NamedTuple, Set, Tuple
+import click
+from app import files, metrics
+from app.state import StateStore
+
+
+# Linking small files saves too little to be worth it
+MIN_SIZE = 64 * 1024
+
+
+class DedupStats(NamedTuple):
+    """What a deduplication pass did"""
+
+    linked_files: int = 0
+    saved_bytes: int = 0
+    reflinks: int = 0
+    hardlinks: int = 0
+
+
+def is_indexed(path: Path, record: files.FileRecord) -> bool:
+    """Check if the file is still as it was when it was indexed"""
+    try:
+        path_stat = path.stat()
+    except FileNotFoundError:
+        return False
+    return path_stat.st_size == record.size and path_stat.st_mtime_ns == record.mtime_ns
+
+
+def dedup_mods(
+    mods_path: Path, state: StateStore, min_size: int = MIN_SIZE
+) -> DedupStats:
+    """Replace published files that are identical to a file in another mod, or
+    elsewhere in the same mod, with links to it, keeping the index up to date. Files that
+    changed since they were indexed are left alone. Stops linking once the file system
+    turns out not to support links.
+    """
+    mods_details = state.get_mods_details()
+    indexes = dict()
+    copies: DefaultDict[Tuple[str, int], List[Tuple[str, str]]] = defaultdict(list)
+    for mod_id in sorted(mods_details):
+        indexes[mod_id] = state.get_file_index(mod_id)
+        for relative_path, record in sorted(indexes[mod_id].items()):
+            if record.size >= min_size:
+                copies[(record.hash, record.size)].append((mod_id, relative_path))
+    stats = DedupStats()
+    changed: Set[str] = set()
+    for (_, size), paths in copies.items():
+        originals = []
+        for mod_id, relative_path in paths:
+            path = mods_path / mods_details[mod_id]["directory_name"] / relative_path
+            if is_indexed(path, indexes[mod_id][relative_path]):
+                originals.append((mod_id, relative_path, path))
+        if len(originals) < 2:
+            continue
+        source = originals[0][2]
+        source_stat = source.stat()
+        for mod_id, relative_path, path in originals[1:]:
+            path_stat = path.stat()
+            if path_stat.st_dev != source_stat.st_dev:
+                continue
+            if path_stat.st_ino == source_stat.st_ino:
+                continue
+            try:
+                kind = files.link_file(source, path)
+            except OSError as error:
+                click.echo(f"WARNING: Can't link identical files, stopping: {error!r}")
+                return save_dedup(state, indexes, changed, stats)
+            stats = stats._replace(
+                linked_files=stats.linked_files + 1,
+                saved_bytes=stats.saved_bytes + size,
+                reflinks=stats.reflinks + (kind == "reflink"),
+                hardlinks=stats.hardlinks + (kind == "hardlink"),
+            )
+            indexes[mod_id][relative_path] = indexes[mod_id][relative_path]._replace(
+                mtime_ns=os.stat(path).st_mtime_ns
+            )
+            changed.add(mod_id)
+    return save_dedup(state, indexes, changed, stats)
+
+
+def save_dedup(
+    state: StateStore,
+    indexes: Dict[str, Dict[str, files.FileRecord]],
+    changed: Set[str],
+    stats: DedupStats,
+) -> DedupStats:
+    """Record the new modification times of the linked files and count what was saved"""
+    for mod_id in changed:
+        state.set_file_index(mod_id, indexes[mod_id])
+    metrics.METRICS.add(
+        "dedup",
+        files=stats.linked_files,
+        bytes=stats.saved_bytes,
+        reflinks=stats.reflinks,
+        hardlinks=stats.hardlinks,
+    )
+    click.echo(
+        (
+            f"Linked {stats.linked_files} identical files, saving "
+            f"{stats.saved_bytes / 1024 ** 2:.1f} MB"
+        )
+    )
+    return stats
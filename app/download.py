@@ -2,65 +2,791 @@
 mods manifest
 """
 
+import os
+import random
+import re
+import json
 import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import Thread
 from pathlib import Path
-from subprocess import run
-from typing import List, Set
+from subprocess import PIPE, STDOUT, Popen
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import click
 
-from app import files, steam_site
+from app import client, dedup, files, helpers, metrics, steam_site, targets, verify
+from app.graph import DependencyGraph
+from app.state import STATE_FILENAME, StateStore, get_state_path
 
+WORKSHOP_APP_ID = "107410"
+BATCH_SIZE = 20
+SYNC_MODES = ("replace", "mtime", "hash")
+TRIES = 10
+STALL_TIMEOUT = 600
+PROGRESS_INTERVAL = 5
+PROGRESS_REPORT_INTERVAL = 60
+BACKOFF = 10
+BACKOFF_MAX = 300
+DOWNLOADED_PATTERN = re.compile(r"Success\. Downloaded item (\d+)")
+DOWNLOADED_SIZE_PATTERN = re.compile(
+    r'Success\. Downloaded item (\d+) to "[^"]*" \((\d+) bytes\)'
+)
+QUEUE_SIZE = 4
+# Dates migrated from when they were saved as shown on the workshop pages could be off
+# by as much as any time zone is from UTC
+APPROXIMATE_TOLERANCE = 14 * 60 * 60
+FINISHED = None
+EXIT_UP_TO_DATE = 0
+EXIT_FAILED = 1
+EXIT_PENDING = 3
+MANIFEST_HASH_KEY = "manifest_hash"
+# Where mods are prepared when steamcmd's copies of them are kept, in the download path
+LINKED_DIRNAME = ".zamd_linked"
 
-def get_mods_to_download(new_mods_details: dict, current_mods_details: dict) -> Set[str]:
+
+class Publication(NamedTuple):
+    """A manifest, where its mods and keys are published and the state they are
+    recorded in
+    """
+
+    manifest_url: str
+    mods_path: str
+    keys_path: str
+    state: StateStore
+    mods_target: targets.Target
+    keys_target: targets.Target
+
+
+def is_mod_changed(
+    new_mod_details: dict, current_mod_details: dict, compare_content: bool = False
+) -> bool:
+    """Check if a mod has been updated since it was downloaded, going by when it was
+    last updated to the minute and optionally also by its size and content manifest
+    """
+    # Details recorded from the web API used to keep the seconds
+    difference = abs(
+        steam_site.truncate_to_minute(new_mod_details["updated"])
+        - steam_site.truncate_to_minute(current_mod_details["updated"])
+    )
+    if current_mod_details.get("updated_approximate"):
+        if difference > APPROXIMATE_TOLERANCE:
+            return True
+    elif difference:
+        return True
+    if compare_content:
+        for key in ("file_size", "manifest_id"):
+            if key in new_mod_details and key in current_mod_details:
+                if new_mod_details[key] != current_mod_details[key]:
+                    return True
+    return False
+
+
+def get_mods_to_download(
+    new_mods_details: dict, current_mods_details: dict, compare_content: bool = False
+) -> Set[str]:
     """Figure out which mods to download based on date and prior existence"""
     return {
         mod_id
         for mod_id in new_mods_details
         if mod_id not in current_mods_details
-        or (
-            mod_id in current_mods_details
-            and current_mods_details[mod_id]["updated"]
-            != new_mods_details[mod_id]["updated"]
+        or is_mod_changed(
+            new_mods_details[mod_id], current_mods_details[mod_id], compare_content
         )
     }
 
 
-def download_steam_mod(
-    mod_id: str, steamcmd_path: Path, username: str, password: str, download_path: Path
+def refresh_approximate_dates(
+    new_mods_details: dict, current_mods_details: dict, to_download: Set[str]
 ) -> bool:
-    """Download the given steam mod using steamcmd. Return BOOL if failed."""
-    code = -1
-    counter = 0
-    tries = 10
-    title = steam_site.get_mod_title(steam_site.get_url_from_id(mod_id))
-    while code != 0 and counter < tries:
-        counter += 1
-        command: List[str] = [
-            str(steamcmd_path),
-            "+@sSteamCmdForcePlatformType linux",
-            "+force_install_dir",
-            str(download_path),
-            "+login",
+    """Replace the approximate updated dates of mods that are not going to be
+    downloaded with their exact ones. Return whether any were replaced.
+    """
+    refreshed = False
+    for mod_id, details in current_mods_details.items():
+        if details.get("updated_approximate") and mod_id in new_mods_details:
+            if mod_id not in to_download:
+                details["updated"] = new_mods_details[mod_id]["updated"]
+                del details["updated_approximate"]
+                refreshed = True
+    return refreshed
+
+
+def is_up_to_date(
+    manifest_url: str,
+    manifest_hash: str,
+    state: StateStore,
+    graph: DependencyGraph,
+    max_workers: int = steam_site.MAX_WORKERS,
+    backend: str = "api",
+) -> bool:
+    """Check if the manifest is the same as when all of its mods were last published and
+    none of them have been updated since, without looking up dependencies again. With
+    the api backend, only mods the web API doesn't know have their pages fetched.
+    """
+    if state.get_value(MANIFEST_HASH_KEY) != manifest_hash:
+        return False
+    mods_manifest = helpers.get_mods_manifest(manifest_url)
+    mod_ids = graph.get_closure(
+        mod_id for modline in mods_manifest.values() for mod_id in modline.values()
+    )
+    current_mods_details = state.get_mods_details()
+    for mod_id in mod_ids:
+        details = current_mods_details.get(mod_id)
+        if (
+            details is None
+            or details.get("updated_approximate")
+            or not graph.is_current(mod_id, details["updated"])
+        ):
+            return False
+    updated = steam_site.get_updated_timestamps(mod_ids, max_workers, backend)
+    return all(
+        updated.get(mod_id)
+        == steam_site.truncate_to_minute(current_mods_details[mod_id]["updated"])
+        for mod_id in mod_ids
+    )
+
+
+def quote_argument(argument: str) -> str:
+    """Quote an argument for a steamcmd script so that it may contain spaces"""
+    return '"' + argument + '"'
+
+
+def write_runscript(
+    runscript_path: Path,
+    mod_ids: List[str],
+    username: str,
+    password: str,
+    download_path: Path,
+) -> None:
+    """Write a steamcmd script that logs in once and downloads all the given mods"""
+    lines = [
+        "@ShutdownOnFailedCommand 0",
+        "@NoPromptForPassword 1",
+        "@sSteamCmdForcePlatformType linux",
+        f"force_install_dir {quote_argument(str(download_path))}",
+        f"login {quote_argument(username)} {quote_argument(password)}",
+    ]
+    lines.extend(
+        f"workshop_download_item {WORKSHOP_APP_ID} {mod_id}" for mod_id in mod_ids
+    )
+    lines.append("quit")
+    # The script holds the password, so only the owner may read it
+    with open(os.open(runscript_path, os.O_WRONLY | os.O_CREAT, 0o600), "w") as open_file:
+        open_file.write("\n".join(lines) + "\n")
+
+
+def get_downloaded_mod_ids(output: str) -> Set[str]:
+    """Get the IDs of the mods steamcmd reported as successfully downloaded"""
+    return set(DOWNLOADED_PATTERN.findall(output))
+
+
+def get_reported_sizes(output: str) -> Dict[str, int]:
+    """Get the number of bytes steamcmd reported downloading for each mod"""
+    return {
+        mod_id: int(size) for mod_id, size in DOWNLOADED_SIZE_PATTERN.findall(output)
+    }
+
+
+def is_download_complete(install_path: Path, mod_id: str, size: Optional[int]) -> bool:
+    """Check that the downloaded mod's size on disk is the size steamcmd reported, if
+    it reported one. A mod that isn't was left incomplete, so its copy is deleted for it
+    to be downloaded afresh.
+    """
+    mod_path = get_content_path(install_path) / mod_id
+    found = files.get_directory_size(mod_path)
+    if size is None or found == size:
+        return True
+    click.echo(
+        (
+            f"WARNING: Mod {mod_id} is {found} bytes instead of the {size} bytes "
+            "steamcmd reported, so it is incomplete!"
+        )
+    )
+    shutil.rmtree(str(mod_path), ignore_errors=True)
+    metrics.METRICS.add("download", mod_id, truncated=1)
+    return False
+
+
+def get_partial_path(install_path: Path) -> Path:
+    """Get the directory steamcmd keeps partly downloaded workshop mods in for the given
+    install directory, which it resumes from
+    """
+    return Path(install_path, "steamapps", "workshop", "downloads", WORKSHOP_APP_ID)
+
+
+def get_backoff_delay(attempt: int, backoff: float = BACKOFF) -> float:
+    """Get how long to wait before the given retry, doubling with each attempt up to a
+    limit, with jitter so that parallel workers don't retry in step
+    """
+    return min(BACKOFF_MAX, backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+
+
+def read_lines(stream: IO[str], lines: Queue) -> None:
+    """Put each line from the given stream into the queue as it arrives, then FINISHED"""
+    for line in stream:
+        lines.put(line)
+    lines.put(FINISHED)
+
+
+def supervise_steamcmd(
+    process: Popen,
+    download_path: Path,
+    stall_timeout: float = STALL_TIMEOUT,
+    on_line: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, bool]:
+    """Echo steamcmd's output as it arrives, passing each line to on_line too, and kill
+    steamcmd if it neither prints anything nor grows its partial downloads for
+    stall_timeout seconds. Return its output and whether it was killed.
+    """
+    lines: Queue = Queue()
+    Thread(target=read_lines, args=(process.stdout, lines), daemon=True).start()
+    output = []
+    stalled = False
+    # steamcmd often buffers its output when it isn't writing to a terminal, so the
+    # partial downloads growing counts as progress too
+    partial_path = get_partial_path(download_path)
+    started = last_progress = last_report = time.monotonic()
+    last_size = files.get_directory_size(partial_path)
+    grown = 0
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=PROGRESS_INTERVAL)
+            except Empty:
+                line = ""
+            else:
+                if line is FINISHED:
+                    break
+                click.echo(line, nl=False)
+                output.append(line)
+                if on_line is not None:
+                    on_line(line)
+                last_progress = time.monotonic()
+            size = files.get_directory_size(partial_path)
+            now = time.monotonic()
+            if size != last_size:
+                grown += max(size - last_size, 0)
+                last_size = size
+                last_progress = now
+            if grown and now - last_report >= PROGRESS_REPORT_INTERVAL:
+                last_report = now
+                click.echo(
+                    (
+                        f"Downloaded {grown / 1024 ** 2:.1f} MB at "
+                        f"{grown / 1024 ** 2 / (now - started):.2f} MB/s"
+                    )
+                )
+            if now - last_progress > stall_timeout:
+                click.echo(
+                    (
+                        f"WARNING: steamcmd made no progress for {stall_timeout}s, so "
+                        "it is being stopped!"
+                    )
+                )
+                stalled = True
+                break
+    finally:
+        # Never leave steamcmd running unsupervised, whatever went wrong
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    metrics.METRICS.add("download", partial_bytes=grown, stalls=int(stalled))
+    return "".join(output), stalled
+
+
+def download_steam_mod_batch(
+    mod_ids: List[str],
+    steamcmd_path: Path,
+    username: str,
+    password: str,
+    download_path: Path,
+    stall_timeout: float = STALL_TIMEOUT,
+    home: Optional[Path] = None,
+    on_downloaded: Optional[Callable[[str], None]] = None,
+) -> Set[str]:
+    """Download the given steam mods in a single steamcmd session, stopping it if it
+    stalls. steamcmd runs with the given home directory if there is one. Return the IDs
+    of the mods that downloaded successfully, each of which is also passed to
+    on_downloaded as soon as steamcmd reports it. Mods whose size on disk isn't what
+    steamcmd reported count as failed.
+    """
+    reported: Set[str] = set()
+    truncated: Set[str] = set()
+
+    def report_downloaded(line: str) -> None:
+        sizes = get_reported_sizes(line)
+        for mod_id in get_downloaded_mod_ids(line).intersection(mod_ids):
+            if mod_id in reported:
+                continue
+            reported.add(mod_id)
+            if not is_download_complete(download_path, mod_id, sizes.get(mod_id)):
+                truncated.add(mod_id)
+            elif on_downloaded is not None:
+                on_downloaded(mod_id)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        runscript_path = Path(temp_dir, "download_mods.txt")
+        write_runscript(runscript_path, mod_ids, username, password, download_path)
+        with metrics.METRICS.time("download"):
+            process = Popen(
+                [str(steamcmd_path), "+runscript", str(runscript_path)],
+                stdout=PIPE,
+                stderr=STDOUT,
+                universal_newlines=True,
+                env=dict(os.environ, HOME=str(home)) if home else None,
+            )
+            output, _ = supervise_steamcmd(
+                process, download_path, stall_timeout, report_downloaded
+            )
+    downloaded = get_downloaded_mod_ids(output).intersection(mod_ids) - truncated
+    for mod_id in mod_ids:
+        metrics.METRICS.add(
+            "download", mod_id, attempts=1, downloaded=int(mod_id in downloaded)
+        )
+    return downloaded
+
+
+def download_steam_mods(
+    mod_ids: Iterable[str],
+    steamcmd_path: Path,
+    username: str,
+    password: str,
+    download_path: Path,
+    batch_size: int = BATCH_SIZE,
+    tries: int = TRIES,
+    on_downloaded: Optional[Callable[[str, Path], None]] = None,
+    stall_timeout: float = STALL_TIMEOUT,
+    backoff: float = BACKOFF,
+    home: Optional[Path] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Set[str]:
+    """Download the given steam mods using steamcmd, batch_size mods per login. Mods
+    that fail are retried in a later batch, up to the given number of tries, waiting
+    longer before each retry. Retries resume from what steamcmd already downloaded.
+    Return the IDs of the mods that downloaded successfully. As soon as steamcmd reports
+    it, each downloaded mod is also passed to on_downloaded along with the directory it
+    is in. No more batches are started once should_stop returns True.
+    """
+    if batch_size < 1:
+        raise ValueError(f"Can't download mods in batches of {batch_size}")
+    pending = list(mod_ids)
+    attempts: Counter = Counter()
+    downloaded: Set[str] = set()
+
+    def report_downloaded(mod_id: str) -> None:
+        if on_downloaded is not None:
+            on_downloaded(mod_id, get_content_path(download_path))
+
+    while pending:
+        if should_stop is not None and should_stop():
+            click.echo(f"WARNING: Not downloading the remaining mods: {pending}")
+            break
+        batch, pending = pending[:batch_size], pending[batch_size:]
+        retry = max(attempts[mod_id] for mod_id in batch)
+        if retry:
+            delay = get_backoff_delay(retry, backoff)
+            click.echo(f"Waiting {delay:.1f}s before retrying...")
+            time.sleep(delay)
+        partial_path = get_partial_path(download_path)
+        resuming = [mod_id for mod_id in batch if (partial_path / mod_id).is_dir()]
+        if resuming:
+            click.echo(f"Resuming partial downloads of: {resuming}")
+        batch_downloaded = download_steam_mod_batch(
+            batch,
+            steamcmd_path,
             username,
             password,
-            "+workshop_download_item",
-            "107410",
-            mod_id,
-            "+quit",
-        ]
-        code = run(command).returncode
-        if code != 0:
-            click.echo(
-                (
-                    f"WARNING: Mod {title} download returned with code {code}! "
-                    f"Attempt {counter} of {tries}"
+            download_path,
+            stall_timeout,
+            home,
+            report_downloaded,
+        )
+        downloaded.update(batch_downloaded)
+        for mod_id in batch:
+            if mod_id in downloaded:
+                continue
+            attempts[mod_id] += 1
+            if attempts[mod_id] < tries:
+                click.echo(
+                    (
+                        f"WARNING: Mod {mod_id} failed to download! "
+                        f"Attempt {attempts[mod_id]} of {tries}"
+                    )
                 )
+                pending.append(mod_id)
+            else:
+                click.echo(f"ERROR: Mod {mod_id} failed to download after {tries} tries!")
+    return downloaded
+
+
+def schedule_in_order(
+    mod_ids: Iterable[str],
+    sizes: Dict[str, int],
+    workers: int,
+    placed: Optional[Dict[str, int]] = None,
+) -> List[List[str]]:
+    """Share the given mods out between the given number of workers in the given order,
+    each to the worker with the fewest bytes to download so far, so that each worker
+    downloads them in about that order. Mods of unknown size count as empty. Mods
+    already placed with a worker stay with it.
+    """
+    placed = placed or dict()
+    queues: List[List[str]] = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for mod_id in mod_ids:
+        worker = placed.get(mod_id, loads.index(min(loads)))
+        queues[worker].append(mod_id)
+        loads[worker] += sizes.get(mod_id, 0)
+    return queues
+
+
+def schedule_largest_first(
+    mod_ids: Iterable[str],
+    sizes: Dict[str, int],
+    workers: int,
+    placed: Optional[Dict[str, int]] = None,
+) -> List[List[str]]:
+    """Share the given mods out between the given number of workers so that each ends
+    up with about as many bytes to download, handing out the largest mods first
+    """
+    return schedule_in_order(
+        sorted(mod_ids, key=lambda mod_id: sizes.get(mod_id, 0), reverse=True),
+        sizes,
+        workers,
+        placed,
+    )
+
+
+def schedule_by_modline(
+    mod_ids: Iterable[str], sizes: Dict[str, int], modlines: Dict[str, FrozenSet[str]]
+) -> List[str]:
+    """Order the given mods so that whole mod lines are downloaded as early as possible:
+    the mod line with the fewest bytes left to download first, then the next, counting
+    mods shared with lines already downloaded as done. Each mod line's mods are ordered
+    largest first, and mods in no mod line come last.
+    """
+    remaining = set(mod_ids)
+    order: List[str] = []
+    while remaining:
+        left = {
+            modline: remaining & modline_mods
+            for modline, modline_mods in modlines.items()
+            if remaining & modline_mods
+        }
+        if not left:
+            next_mods = remaining
+        else:
+            next_mods = min(
+                left.items(),
+                key=lambda item: (
+                    sum(sizes.get(mod_id, 0) for mod_id in item[1]),
+                    item[0],
+                ),
+            )[1]
+        order.extend(
+            sorted(next_mods, key=lambda mod_id: (-sizes.get(mod_id, 0), mod_id))
+        )
+        remaining -= next_mods
+    return order
+
+
+def get_modline_mods(
+    manifest_url: str, graph: DependencyGraph
+) -> Dict[str, FrozenSet[str]]:
+    """Get every mod each mod line in the manifest needs, dependencies included"""
+    mods_manifest = helpers.get_mods_manifest(manifest_url)
+    return {
+        modline: graph.get_closure(mods_manifest[modline].values())
+        for modline in mods_manifest
+    }
+
+
+def publish_complete_modlines(
+    published: Iterable[str],
+    pending: Dict[str, Set[str]],
+    modlines: Dict[str, FrozenSet[str]],
+    state: StateStore,
+    mods_path: str,
+    mods_target: targets.Target,
+) -> List[str]:
+    """Count the given mods as published, and add the mod lines that have no mods left
+    to publish to the mod lines file, so that servers can start on them while the rest
+    are still downloading. Return the mod lines that were added.
+    """
+    for mod_ids in pending.values():
+        mod_ids.difference_update(published)
+    mods_details = state.get_mods_details()
+    complete = {
+        modline: [
+            mods_details[mod_id]["directory_name"] for mod_id in sorted(modlines[modline])
+        ]
+        for modline, mod_ids in pending.items()
+        if not mod_ids and modlines[modline].issubset(mods_details)
+    }
+    for modline in complete:
+        del pending[modline]
+    if complete:
+        files.update_modlines(mods_path, complete)
+        publish_metadata(Path(mods_path), mods_target, [files.MODLINES_FILENAME])
+        click.echo(f"Mod lines ready: {sorted(complete)}")
+    return sorted(complete)
+
+
+def get_content_path(install_path: Path) -> Path:
+    """Get the directory steamcmd downloads workshop mods into for the given install
+    directory
+    """
+    return Path(install_path, "steamapps", "workshop", "content", WORKSHOP_APP_ID)
+
+
+def delete_downloads(download_path: Path, mod_ids: Iterable[str]) -> None:
+    """Delete steamcmd's full and partial copies of the given mods in the download path
+    and in every worker's install directory in it, so that steamcmd downloads them
+    afresh rather than counting its copies as up to date
+    """
+    install_paths = [download_path, *download_path.glob("worker_*")]
+    for install_path in install_paths:
+        for mod_id in mod_ids:
+            for path in (get_content_path(install_path), get_partial_path(install_path)):
+                shutil.rmtree(str(path / mod_id), ignore_errors=True)
+
+
+def get_worker_steamcmd(steamcmd_path: Path, install_path: Path) -> Path:
+    """Get a steamcmd for a worker to run on its own, so that workers running at the
+    same time never share steamcmd's login, config or self updates. steamcmd.sh keeps
+    all of those next to itself, so its whole installation is copied into the worker's
+    install directory the first time. Other steamcmds, such as the one packaged for
+    Debian, keep them in the home directory, which each worker gets its own of.
+    """
+    steamcmd_path = Path(steamcmd_path)
+    if steamcmd_path.name != "steamcmd.sh":
+        return steamcmd_path
+    worker_steamcmd = Path(install_path, "steamcmd")
+    if not worker_steamcmd.is_dir():
+        partial = Path(install_path, ".steamcmd.partial")
+        shutil.rmtree(partial, ignore_errors=True)
+        shutil.copytree(steamcmd_path.parent, partial, symlinks=True)
+        os.rename(partial, worker_steamcmd)
+    return worker_steamcmd / steamcmd_path.name
+
+
+def download_steam_mods_in_parallel(
+    mod_ids: Iterable[str],
+    sizes: Dict[str, int],
+    steamcmd_path: Path,
+    username: str,
+    password: str,
+    download_path: Path,
+    workers: int = 1,
+    batch_size: int = BATCH_SIZE,
+    tries: int = TRIES,
+    on_downloaded: Optional[Callable[[str, Path], None]] = None,
+    stall_timeout: float = STALL_TIMEOUT,
+    backoff: float = BACKOFF,
+    should_stop: Optional[Callable[[], bool]] = None,
+    in_order: bool = False,
+) -> Dict[str, Path]:
+    """Download the given steam mods with the given number of steamcmd instances running
+    at the same time. Each instance gets its own install directory in the download path,
+    along with its own steamcmd and home directory, unless there is only one. Mods are
+    handed out largest first, or in the order given if in_order is set. Mods that an
+    instance has a full or partial copy of already go to it again, so that it only
+    downloads what changed. Return the directory each downloaded mod ended up in, which
+    are also passed to on_downloaded as soon as steamcmd reports each one. No more
+    batches are started once should_stop returns True.
+    """
+    if workers < 1:
+        raise ValueError(f"Can't download mods with {workers} workers")
+    if workers == 1:
+        install_paths = [Path(download_path)]
+    else:
+        install_paths = [
+            Path(download_path, f"worker_{worker}") for worker in range(workers)
+        ]
+    mod_ids = list(mod_ids)
+    placed = {
+        mod_id: worker
+        for worker, install_path in enumerate(install_paths)
+        for mod_id in mod_ids
+        if (get_content_path(install_path) / mod_id).is_dir()
+        or (get_partial_path(install_path) / mod_id).is_dir()
+    }
+    schedule = schedule_in_order if in_order else schedule_largest_first
+    queues = schedule(mod_ids, sizes, workers, placed)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (
+                install_path,
+                executor.submit(
+                    download_steam_mods,
+                    queue,
+                    steamcmd_path
+                    if workers == 1
+                    else get_worker_steamcmd(steamcmd_path, install_path),
+                    username,
+                    password,
+                    install_path,
+                    batch_size,
+                    tries,
+                    on_downloaded,
+                    stall_timeout,
+                    backoff,
+                    None if workers == 1 else install_path / "home",
+                    should_stop,
+                ),
             )
-    if counter == tries:
-        click.echo(f"ERROR: Mod {title} failed to download after {tries} tries!")
-        return False
-    return True
+            for install_path, queue in zip(install_paths, queues)
+            if queue
+        ]
+    return {
+        mod_id: get_content_path(install_path)
+        for install_path, future in futures
+        for mod_id in future.result()
+    }
+
+
+def download_steam_mod(
+    mod_id: str, steamcmd_path: Path, username: str, password: str, download_path: Path
+) -> bool:
+    """Download the given steam mod using steamcmd. Return BOOL if failed."""
+    return mod_id in download_steam_mods(
+        [mod_id], steamcmd_path, username, password, download_path
+    )
+
+
+def run_stage(
+    stage: Callable, inbox: Queue, outbox: Optional[Queue], errors: List[Exception]
+) -> None:
+    """Pass every item put in the inbox through the given stage, putting what it returns
+    into the outbox, until the inbox is FINISHED. Once any stage has failed the
+    remaining items are dropped, but the inbox is still drained so nothing upstream
+    gets stuck.
+    """
+    while True:
+        item = inbox.get()
+        if item is FINISHED:
+            break
+        if errors:
+            continue
+        try:
+            result = stage(*item)
+        except Exception as error:  # pylint: disable=W0703
+            # Re-raised by whoever waits for the pipeline
+            errors.append(error)
+            continue
+        if outbox is not None:
+            outbox.put(result)
+    if outbox is not None:
+        outbox.put(FINISHED)
+
+
+def start_stage(
+    stage: Callable, inbox: Queue, outbox: Optional[Queue], errors: List[Exception]
+) -> Thread:
+    """Run the given pipeline stage in its own thread"""
+    thread = Thread(target=run_stage, args=(stage, inbox, outbox, errors), daemon=True)
+    thread.start()
+    return thread
+
+
+def prepare_downloaded_mod(
+    mod_id: str,
+    downloaded_dir: Path,
+    mod_details: dict,
+    keys_path: Path,
+    rename_workers: int = 1,
+    keys_targets: Optional[List[targets.Target]] = None,
+    link_path: Optional[Path] = None,
+) -> Tuple[str, Path]:
+    """Give the downloaded mod its directory name, make it safe for linux and copy its
+    keys to the keys directory, or each of the given targets instead. If a link path is
+    given, steamcmd's copy of the mod is kept and a copy sharing its files is prepared
+    there instead. Return the mod's ID and the directory that is ready to be moved into
+    place.
+    """
+    if keys_targets is None:
+        keys_targets = [targets.LocalTarget(keys_path)]
+
+    def put_key(source: Path, name: str) -> None:
+        for keys_target in keys_targets or []:
+            keys_target.put_file(source, name)
+
+    mod_dir_name = mod_details["directory_name"]
+    if link_path is None:
+        mod_path = files.prepare_mod_dir(mod_id, downloaded_dir, mod_dir_name)
+    else:
+        click.echo(f"Linking to the downloaded files: {mod_details['title']}...")
+        with metrics.METRICS.time("link", mod_id):
+            mod_path = files.prepare_mod_dir(
+                mod_id,
+                downloaded_dir,
+                mod_dir_name,
+                link_path=link_path,
+                max_workers=rename_workers,
+            )
+    click.echo(f"Making file and directory names safe: {mod_details['title']}...")
+    with metrics.METRICS.time("rename", mod_id):
+        key_dirs = files.make_files_and_dirs_safe(mod_path, rename_workers)
+    click.echo(f"Checking for server keys to copy: {mod_details['title']}...")
+    with metrics.METRICS.time("keys", mod_id):
+        files.copy_keys(mod_path, keys_path, key_dirs, put_key)
+    return mod_id, mod_path
+
+
+def publish_mod(
+    mod_id: str,
+    mod_path: Path,
+    mod_details: dict,
+    state: StateStore,
+    mods_path: Path,
+    sync_mode: str = "replace",
+    publish_workers: int = files.TRANSFER_WORKERS,
+    mods_target: Optional[targets.Target] = None,
+    hashes: Optional[Dict[str, str]] = None,
+    index_files: bool = True,
+) -> None:
+    """Publish the prepared mod to the mods directory, or the given target instead, and
+    record its details along with an index of its files to verify it against later, if
+    index_files is set. The files are hashed unless their hashes are given. Without an
+    index, verifying the mod indexes it as it is then.
+    """
+    if mods_target is None:
+        mods_target = targets.LocalTarget(mods_path, publish_workers)
+    if hashes is None and index_files:
+        with metrics.METRICS.time("index", mod_id):
+            hashes = files.hash_mod_dir(mod_path)
+    state.set_file_index(mod_id, mods_target.put_mod(mod_id, mod_path, sync_mode, hashes))
+    state.set_mod_details(mod_id, mod_details)
+
+
+def publish_metadata(
+    mods_path: Path,
+    mods_target: targets.Target,
+    file_names: Iterable[str] = (files.MODS_DETAILS_FILENAME, files.MODLINES_FILENAME),
+) -> None:
+    """Publish the mods details and mod lines files the game servers read, or just the
+    given ones, to the target if it isn't the mods directory they are written to
+    """
+    for file_name in file_names:
+        if (mods_path / file_name).is_file():
+            mods_target.put_file(mods_path / file_name, file_name)
 
 
 @click.command()
@@ -69,23 +795,473 @@ def download_steam_mod(
 @click.option("--download_path", prompt="Path to steam directory to download to")
 @click.option("--mods_path", prompt="Path to directory to move mods to")
 @click.option("--keys_path", prompt="Path to directory to put keys into")
+@click.option(
+    "--extra_manifest",
+    type=(str, str, str),
+    multiple=True,
+    metavar="MANIFEST_URL MODS_PATH KEYS_PATH",
+    help=(
+        "Another manifest to update in the same run, along with the directories to "
+        "publish its mods and keys to. Can be given more than once. The mods of all "
+        "the manifests are resolved and downloaded once, and each directory gets its "
+        "own copy, linked to the others' files where it can, and its own state in "
+        "the download path"
+    ),
+)
 @click.option("--username", prompt="Steam Username")
 @click.option("--password", prompt="Steam Password")
-def update_mods(
-    steamcmd_path, manifest_url, download_path, mods_path, keys_path, username, password
-):
+@click.option(
+    "--max_workers",
+    type=click.IntRange(min=1),
+    default=steam_site.MAX_WORKERS,
+    show_default=True,
+    help="Number of workshop pages to fetch at the same time",
+)
+@click.option(
+    "--rate_limit",
+    type=click.FloatRange(min=0),
+    default=client.RATE,
+    show_default=True,
+    help=(
+        "Requests per second to send to each Steam host at most, or 0 for no limit. "
+        "Fewer requests are sent at once while Steam is throttling or failing them"
+    ),
+)
+@click.option(
+    "--cache_path",
+    default=str(helpers.CACHE_PATH),
+    show_default=True,
+    help="Directory to cache web requests in between runs",
+)
+@click.option(
+    "--batch_size",
+    type=click.IntRange(min=1),
+    default=BATCH_SIZE,
+    show_default=True,
+    help="Number of mods to download per steamcmd login",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help=(
+        "Number of steamcmd instances to download with at the same time, each in its "
+        "own directory in the download path with its own copy of steamcmd.sh and home "
+        "directory, so that they never share steamcmd's login or self updates"
+    ),
+)
+@click.option(
+    "--sync_mode",
+    type=click.Choice(SYNC_MODES),
+    default="replace",
+    show_default=True,
+    help=(
+        "How to put updated mods in place: replace the whole mod directory, or only "
+        "copy files that changed going by size and contents (hash). mtime skips "
+        "hashing files whose size and modification time match, but steamcmd gives "
+        "every file it downloads a new modification time, so in practice it hashes "
+        "the same files as hash does"
+    ),
+)
+@click.option(
+    "--rename_workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of threads to make a mod's file and directory names safe with",
+)
+@click.option(
+    "--publish_workers",
+    type=click.IntRange(min=1),
+    default=files.TRANSFER_WORKERS,
+    show_default=True,
+    help=(
+        "Number of threads to copy a mod's files into the mods directory with, when it "
+        "is on a different file system to the download path"
+    ),
+)
+@click.option(
+    "--mods_target",
+    default=None,
+    help=(
+        "Where to publish mods to instead of the mods directory, which still holds the "
+        "details and mod lines files, which are published there too. Either a "
+        "directory, or the URL of an Azure blob container with a SAS token that can "
+        "list, write and delete"
+    ),
+)
+@click.option(
+    "--keys_target",
+    default=None,
+    help="Where to publish keys to instead of the keys directory, like --mods_target",
+)
+@click.option(
+    "--keep_downloads",
+    is_flag=True,
+    help=(
+        "Leave steamcmd's copy of each mod where it is and publish a copy made of "
+        "reflinks or hard links to its files, so that updates only download what "
+        "changed. Keeps a second copy in the download path where it can't link"
+    ),
+)
+@click.option(
+    "--compare_content",
+    is_flag=True,
+    help=(
+        "Also download mods whose file size or content manifest has changed, even if "
+        "their updated date has not"
+    ),
+)
+@click.option(
+    "--backend",
+    type=click.Choice(steam_site.BACKENDS),
+    default="html",
+    show_default=True,
+    help=(
+        "Where to get mod details from: the workshop pages or the Steam web API, which "
+        "falls back to the workshop pages for mods it has no details for"
+    ),
+)
+@click.option(
+    "--check_backend",
+    type=click.Choice(steam_site.BACKENDS),
+    default="api",
+    show_default=True,
+    help=(
+        "Where to check if mods were updated since the last run, before resolving the "
+        "manifest: the Steam web API looks up every mod in a few batched requests, "
+        "while the workshop pages need every mod's page fetched and parsed"
+    ),
+)
+@click.option(
+    "--stall_timeout",
+    type=click.FloatRange(min=0),
+    default=STALL_TIMEOUT,
+    show_default=True,
+    help=(
+        "Seconds steamcmd may go without printing anything or downloading more before "
+        "it is stopped and its mods retried"
+    ),
+)
+@click.option(
+    "--backoff",
+    type=click.FloatRange(min=0),
+    default=BACKOFF,
+    show_default=True,
+    help="Seconds to wait before the first retry of a failed download, doubling after",
+)
+@click.option(
+    "--check",
+    is_flag=True,
+    help=(
+        f"Only check for updates. Exits with {EXIT_UP_TO_DATE} if all mods are up to "
+        f"date, {EXIT_PENDING} if updates are pending and {EXIT_FAILED} on failure"
+    ),
+)
+@click.option(
+    "--state_path",
+    default=None,
+    help=(
+        "SQLite database to record the state of the mods directory in, which must be "
+        "on local storage rather than a network share. Defaults to "
+        f"{STATE_FILENAME} in the download path. Once it exists, deleting or editing "
+        f"{files.MODS_DETAILS_FILENAME} has no effect unless --reset_state is given"
+    ),
+)
+@click.option(
+    "--reset_state",
+    is_flag=True,
+    help=(
+        "Forget the recorded state and take it from "
+        f"{files.MODS_DETAILS_FILENAME} again, so that mods missing from it are "
+        "downloaded again"
+    ),
+)
+@click.option(
+    "--verify",
+    "verify_files",
+    is_flag=True,
+    help=(
+        "Check the published mods for missing, truncated or changed files first, and "
+        "download the corrupt ones again"
+    ),
+)
+@click.option(
+    "--dedup",
+    "dedup_files",
+    is_flag=True,
+    help=(
+        "After publishing, replace files that are identical to one in another mod with "
+        "reflinks where the file system supports them, or read only hard links. Not "
+        "for file systems without links, such as Azure file shares over SMB"
+    ),
+)
+@click.option(
+    "--metrics_json",
+    default=None,
+    help="File to write the time spent and work done in each phase of the run to",
+)
+@click.option(
+    "--metrics_prom",
+    default=None,
+    help=(
+        "File to write the same metrics to in the Prometheus text format, such as a "
+        ".prom file in node_exporter's textfile collector directory"
+    ),
+)
+def update_mods(**options):
     """Updates mods according to the given mod line decalred in a mods_manifest.json
-    file
+    file. Exits with 0 if all mods are up to date afterwards and 1 if any failed.
     """
-    new_mod_details = steam_site.get_all_manifest_mods_details(manifest_url)
-    current_mods_details = files.get_current_mod_details(mods_path)
-    click.echo(
-        (
-            "Checking which of these mods to download: "
-            f"{[mod_details['title'] for mod_details in new_mod_details.values()]}..."
-        )
+    sys.exit(run_update(**options))
+
+
+def run_update(
+    steamcmd_path,
+    manifest_url,
+    download_path,
+    mods_path,
+    keys_path,
+    extra_manifest,
+    username,
+    password,
+    max_workers,
+    rate_limit,
+    cache_path,
+    batch_size,
+    workers,
+    sync_mode,
+    rename_workers,
+    publish_workers,
+    mods_target,
+    keys_target,
+    keep_downloads,
+    compare_content,
+    backend,
+    check_backend,
+    stall_timeout,
+    backoff,
+    check,
+    state_path,
+    reset_state,
+    verify_files,
+    dedup_files,
+    metrics_json,
+    metrics_prom,
+    state: Optional[StateStore] = None,
+    graph: Optional[DependencyGraph] = None,
+) -> int:
+    """Update the mods with the options update_mods was given and return the exit code.
+    The given state and dependency graph are used instead of loading them, and are
+    left open for the next update. The states of any extra manifests are opened for the
+    update only.
+    """
+    mods_target = targets.get_target(mods_target or mods_path, publish_workers)
+    keys_target = targets.get_target(keys_target or keys_path, publish_workers)
+    published_path = (
+        mods_target.path if isinstance(mods_target, targets.LocalTarget) else None
     )
-    to_download = get_mods_to_download(new_mod_details, current_mods_details)
+    if published_path is None and (verify_files or dedup_files):
+        raise click.UsageError("--verify and --dedup need the mods to be in a directory")
+    helpers.CACHE_PATH = Path(cache_path)
+    helpers.evict_cache()
+    helpers.resize_pool(max(max_workers, helpers.POOL_SIZE))
+    helpers.CLIENT.configure(rate_limit, max(max_workers, 1))
+    metrics.METRICS.reset()
+    started = time.time()
+    exit_code = EXIT_FAILED
+    if graph is None:
+        graph = files.get_dependency_graph(Path(mods_path))
+    opened_states = []
+    if state is None:
+        state = StateStore(
+            Path(mods_path), Path(state_path or Path(download_path, STATE_FILENAME))
+        )
+        opened_states.append(state)
+    publications = [
+        Publication(manifest_url, mods_path, keys_path, state, mods_target, keys_target)
+    ]
+    try:
+        for extra_url, extra_mods_path, extra_keys_path in extra_manifest:
+            extra_state = StateStore(
+                Path(extra_mods_path),
+                get_state_path(Path(download_path), Path(extra_mods_path)),
+            )
+            opened_states.append(extra_state)
+            publications.append(
+                Publication(
+                    extra_url,
+                    extra_mods_path,
+                    extra_keys_path,
+                    extra_state,
+                    targets.LocalTarget(Path(extra_mods_path), publish_workers),
+                    targets.LocalTarget(Path(extra_keys_path)),
+                )
+            )
+        # The extra manifests are always published to directories
+        published_paths = [Path(published_path)] if published_path is not None else []
+        published_paths.extend(
+            Path(publication.mods_path) for publication in publications[1:]
+        )
+        if reset_state:
+            click.echo("Resetting the recorded state of the mods directory...")
+            for publication in publications:
+                publication.state.reset()
+        if verify_files:
+            for path, publication in zip(published_paths, publications):
+                click.echo(f"Verifying the published mods in {path}...")
+                corrupt = verify.verify_mods(path, publication.state)
+                if corrupt:
+                    click.echo(f"Downloading corrupt mods again: {sorted(corrupt)}")
+                    verify.forget_corrupt_mods(publication.state, corrupt)
+                    delete_downloads(Path(download_path), corrupt)
+        manifest_hashes = [
+            helpers.get_manifest_hash(publication.manifest_url)
+            for publication in publications
+        ]
+        with metrics.METRICS.time("check"):
+            up_to_date = all(
+                is_up_to_date(
+                    publication.manifest_url,
+                    manifest_hash,
+                    publication.state,
+                    graph,
+                    max_workers,
+                    check_backend,
+                )
+                for publication, manifest_hash in zip(publications, manifest_hashes)
+            )
+        if up_to_date:
+            click.echo("All mods are up to date")
+            exit_code = EXIT_UP_TO_DATE
+        elif check:
+            click.echo("Mods need to be updated")
+            exit_code = EXIT_PENDING
+        else:
+            with metrics.METRICS.time("resolve"):
+                new_mod_details = steam_site.get_all_manifests_mods_details(
+                    [publication.manifest_url for publication in publications],
+                    max_workers,
+                    backend,
+                    graph,
+                )
+            files.save_dependency_graph(Path(mods_path), graph)
+            exit_code = update_mods_in_state(
+                Path(steamcmd_path),
+                Path(download_path),
+                username,
+                password,
+                new_mod_details,
+                graph,
+                publications,
+                batch_size,
+                workers,
+                sync_mode,
+                rename_workers,
+                compare_content,
+                stall_timeout,
+                backoff,
+                publish_workers,
+                keep_downloads,
+                verify_files or dedup_files,
+            )
+            if exit_code == EXIT_UP_TO_DATE:
+                for publication, manifest_hash in zip(publications, manifest_hashes):
+                    publication.state.set_value(MANIFEST_HASH_KEY, manifest_hash)
+            if dedup_files:
+                for path, publication in zip(published_paths, publications):
+                    click.echo(f"Linking identical files between mods in {path}...")
+                    with metrics.METRICS.time("dedup"):
+                        dedup.dedup_mods(path, publication.state)
+    finally:
+        for opened_state in opened_states:
+            opened_state.close()
+        save_metrics(metrics_json, metrics_prom, exit_code, started)
+    return exit_code
+
+
+def save_metrics(
+    metrics_json: Optional[str],
+    metrics_prom: Optional[str],
+    exit_code: int,
+    started: float,
+) -> None:
+    """Save what was counted during the run as a JSON report and as a Prometheus
+    textfile, to whichever paths are given
+    """
+    seconds = time.time() - started
+    if metrics_json:
+        report = {"exit_code": exit_code, "started": started, "seconds": seconds}
+        report.update(metrics.METRICS.to_dict())
+        helpers.write_atomically(Path(metrics_json), json.dumps(report).encode())
+    if metrics_prom:
+        helpers.write_atomically(
+            Path(metrics_prom),
+            metrics.METRICS.to_prometheus(
+                last_run_exit_code=exit_code,
+                last_run_started_seconds=started,
+                last_run_seconds=seconds,
+            ).encode(),
+        )
+
+
+def update_mods_in_state(
+    steamcmd_path: Path,
+    download_path: Path,
+    username: str,
+    password: str,
+    new_mod_details: dict,
+    graph: DependencyGraph,
+    publications: List[Publication],
+    batch_size: int = BATCH_SIZE,
+    workers: int = 1,
+    sync_mode: str = "replace",
+    rename_workers: int = 1,
+    compare_content: bool = False,
+    stall_timeout: float = STALL_TIMEOUT,
+    backoff: float = BACKOFF,
+    publish_workers: int = files.TRANSFER_WORKERS,
+    keep_downloads: bool = False,
+    index_files: bool = True,
+) -> int:
+    """Download, prepare and publish the mods of each publication's manifest that
+    changed compared to its state, recording each one as it is published. Mods needed
+    by several publications are downloaded and prepared once, and each of them gets a
+    copy linked to the prepared mod's files where it can. steamcmd's copies of the mods
+    are left where they are if keep_downloads is set. The published files are only
+    hashed and indexed if index_files is set. Return the exit code for the run.
+    """
+    to_download: Set[str] = set()
+    # The publications that need each mod, and their mod lines
+    wanted: Dict[str, List[int]] = dict()
+    modlines: List[Dict[str, FrozenSet[str]]] = []
+    for index, publication in enumerate(publications):
+        modlines.append(get_modline_mods(publication.manifest_url, graph))
+        manifest_mods = frozenset().union(*modlines[index].values())
+        mods_details = {
+            mod_id: details
+            for mod_id, details in new_mod_details.items()
+            if mod_id in manifest_mods
+        }
+        current_mods_details = publication.state.get_mods_details()
+        click.echo(
+            (
+                "Checking which of these mods to download: "
+                f"{[mod_details['title'] for mod_details in mods_details.values()]}..."
+            )
+        )
+        publication_to_download = get_mods_to_download(
+            mods_details, current_mods_details, compare_content
+        )
+        if refresh_approximate_dates(
+            mods_details, current_mods_details, publication_to_download
+        ):
+            publication.state.set_mods_details(current_mods_details)
+            publication.state.export_mods_details()
+        for mod_id in publication_to_download:
+            wanted.setdefault(mod_id, []).append(index)
+        to_download.update(publication_to_download)
     if to_download:
         click.echo(
             (
@@ -94,43 +1270,157 @@ def update_mods(
             )
         )
     else:
-        click.echo(
-            (
-                "No mods to download or update according to "
-                f"{Path(mods_path, files.MODS_DETAILS_FILENAME)}"
+        for publication in publications:
+            click.echo(
+                (
+                    "No mods to download or update according to "
+                    f"{Path(publication.mods_path, files.MODS_DETAILS_FILENAME)}"
+                )
+            )
+            files.save_modlines(
+                publication.manifest_url,
+                publication.state.get_mods_details(),
+                publication.mods_path,
+                graph,
+            )
+            publish_metadata(Path(publication.mods_path), publication.mods_target)
+        return EXIT_UP_TO_DATE
+    link_path = None
+    if keep_downloads:
+        link_path = Path(download_path, LINKED_DIRNAME)
+        link_path.mkdir(parents=True, exist_ok=True)
+    sizes = {
+        mod_id: new_mod_details[mod_id].get("file_size", 0) for mod_id in to_download
+    }
+    # Mod lines are downloaded one after the other, and each is added to its mod lines
+    # file as soon as all its mods are published
+    pending = [
+        {
+            modline: {mod_id for mod_id in mod_ids if index in wanted.get(mod_id, [])}
+            for modline, mod_ids in publication_modlines.items()
+        }
+        for index, publication_modlines in enumerate(modlines)
+    ]
+    for index, publication in enumerate(publications):
+        publish_complete_modlines(
+            [],
+            pending[index],
+            modlines[index],
+            publication.state,
+            publication.mods_path,
+            publication.mods_target,
+        )
+
+    def publish(mod_id: str, mod_path: Path) -> None:
+        hashes = None
+        if index_files:
+            with metrics.METRICS.time("index", mod_id):
+                hashes = files.hash_mod_dir(mod_path)
+        for index in wanted[mod_id]:
+            publication = publications[index]
+            # Every publication but the last gets a linked copy, the last the original
+            publish_path = mod_path
+            if index != wanted[mod_id][-1]:
+                publish_path = Path(
+                    download_path, LINKED_DIRNAME, f".{index}", mod_path.name
+                )
+                files.link_mod_dir(mod_path, publish_path, publish_workers)
+            publish_mod(
+                mod_id,
+                publish_path,
+                new_mod_details[mod_id],
+                publication.state,
+                Path(publication.mods_path),
+                sync_mode,
+                publish_workers,
+                publication.mods_target,
+                hashes,
+                index_files,
             )
+            publish_complete_modlines(
+                [mod_id],
+                pending[index],
+                modlines[index],
+                publication.state,
+                publication.mods_path,
+                publication.mods_target,
+            )
+
+    # Each downloaded mod is prepared while the next ones download, and moved into
+    # place while the next one is prepared.
+    downloaded_queue: Queue = Queue(QUEUE_SIZE)
+    prepared_queue: Queue = Queue(QUEUE_SIZE)
+    errors: List[Exception] = []
+    stages = [
+        start_stage(
+            lambda mod_id, downloaded_dir: prepare_downloaded_mod(
+                mod_id,
+                downloaded_dir,
+                new_mod_details[mod_id],
+                Path(publications[wanted[mod_id][-1]].keys_path),
+                rename_workers,
+                [publications[index].keys_target for index in wanted[mod_id]],
+                link_path,
+            ),
+            downloaded_queue,
+            prepared_queue,
+            errors,
+        ),
+        start_stage(publish, prepared_queue, None, errors),
+    ]
+    click.echo("Downloading mods...")
+    try:
+        downloaded = download_steam_mods_in_parallel(
+            schedule_by_modline(
+                to_download,
+                sizes,
+                {
+                    f"{publication.manifest_url} {modline}": modline_mods
+                    for publication, publication_modlines in zip(publications, modlines)
+                    for modline, modline_mods in publication_modlines.items()
+                },
+            ),
+            sizes,
+            steamcmd_path,
+            username,
+            password,
+            download_path,
+            workers,
+            batch_size,
+            on_downloaded=lambda mod_id, content_path: downloaded_queue.put(
+                (mod_id, content_path)
+            ),
+            stall_timeout=stall_timeout,
+            backoff=backoff,
+            should_stop=lambda: bool(errors),
+            in_order=True,
         )
-        return 1
-    for mod_id in to_download:
-        click.echo(f"Downloading: {new_mod_details[mod_id]['title']}...")
-        success = download_steam_mod(
-            mod_id, steamcmd_path, username, password, download_path
+    finally:
+        downloaded_queue.put(FINISHED)
+        for stage in stages:
+            stage.join()
+        for publication in publications:
+            publication.state.export_mods_details()
+    if errors:
+        raise errors[0]
+    for publication in publications:
+        files.save_modlines(
+            publication.manifest_url,
+            publication.state.get_mods_details(),
+            publication.mods_path,
+            graph,
         )
-        if not success:
-            continue
-        downloaded_dir = Path(download_path, "steamapps", "workshop", "content", "107410")
-        destination_dir = Path(mods_path)
-        mod_dir_name = new_mod_details[mod_id]["directory_name"]
+        publish_metadata(Path(publication.mods_path), publication.mods_target)
+    failed = set(to_download).difference(downloaded)
+    if failed:
         click.echo(
             (
-                "Making file and directory names safe: "
-                f"{new_mod_details[mod_id]['title']}..."
+                "ERROR: Failed to download: "
+                f"{[new_mod_details[mod_id]['title'] for mod_id in failed]}"
             )
         )
-        files.prepare_mod_dir(mod_id, downloaded_dir, destination_dir, mod_dir_name)
-        files.make_files_and_dirs_safe(downloaded_dir / mod_dir_name)
-        click.echo(
-            f"Checking for server keys to copy: {new_mod_details[mod_id]['title']}..."
-        )
-        files.copy_keys(downloaded_dir / mod_dir_name, Path(keys_path))
-        click.echo(f"Moving the mod: {mod_dir_name} to destination...")
-        shutil.move(str(downloaded_dir / mod_dir_name), str(destination_dir))
-        current_mods_details = steam_site.detail_mods(
-            current_mods_details, [steam_site.get_url_from_id(mod_id)]
-        )
-        files.save_mods_details(mods_path, current_mods_details)
-    files.save_modlines(manifest_url, current_mods_details, mods_path)
-    return 1
+        return EXIT_FAILED
+    return EXIT_UP_TO_DATE
 
 
 if __name__ == "__main__":
@@ -1,15 +1,88 @@
 """Functions for files on the system"""
+import hashlib
 import os
 import shutil
+import stat
 import json
+import time
+from collections import Counter
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, NamedTuple, Optional, Set
 import click
-from app import steam_site, helpers
+from app import steam_site, helpers, metrics
+from app.graph import DependencyGraph
+
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None  # type: ignore
 
 
 MODS_DETAILS_FILENAME = "mods_details.json"
 MODLINES_FILENAME = "modlines.json"
+DEPENDENCY_GRAPH_FILENAME = "dependency_graph.json"
+HASH_CHUNK_SIZE = 1024 ** 2
+# The Linux ioctl that makes a file share another's data until either is written to
+FICLONE = 0x40049409
+# Smaller files are copied just as fast by reading and writing them
+KERNEL_COPY_MIN_SIZE = 1024 ** 2
+COPY_CHUNK_SIZE = 1024 ** 2
+TRANSFER_WORKERS = 4
+
+
+class SyncStats(NamedTuple):
+    """What it took to bring a mod directory up to date"""
+
+    copied_files: int = 0
+    copied_bytes: int = 0
+    skipped_files: int = 0
+    skipped_bytes: int = 0
+    deleted_files: int = 0
+
+
+class TransferStats(NamedTuple):
+    """What it took to move a mod directory into place"""
+
+    files: int = 0
+    bytes: int = 0
+    seconds: float = 0
+    renamed: bool = False
+
+
+class FileRecord(NamedTuple):
+    """The contents of a published file, and its size and modification time when they
+    were last hashed
+    """
+
+    size: int
+    mtime_ns: int
+    hash: str
+
+
+class Verification(NamedTuple):
+    """What was wrong with a published mod directory, and its updated file index"""
+
+    problems: List[str]
+    file_index: Dict[str, FileRecord]
+    hashed_files: int = 0
+    hashed_bytes: int = 0
+
+
+def migrate_mods_details(mods_details: dict, written: datetime) -> dict:
+    """Convert updated dates saved as they appeared on the workshop pages, at about the
+    given time, to timestamps. The time zone they were shown in is unknown, so they are
+    marked as approximate.
+    """
+    for details in mods_details.values():
+        if isinstance(details["updated"], str):
+            details["updated"] = steam_site.parse_updated_date(
+                details["updated"], written
+            )
+            details["updated_approximate"] = True
+    return mods_details
 
 
 def get_current_mod_details(mods_path: Path) -> dict:
@@ -18,6 +91,8 @@ def get_current_mod_details(mods_path: Path) -> dict:
     if mods_details_path.is_file():
         with open(mods_details_path) as open_file:
             mods_details = json.loads(open_file.read())
+        written = datetime.fromtimestamp(mods_details_path.stat().st_mtime, timezone.utc)
+        mods_details = migrate_mods_details(mods_details, written)
     else:
         mods_details = dict()
     return mods_details
@@ -36,79 +111,619 @@ def is_key_dir(full_path: Path) -> bool:
     ]
 
 
-def copy_keys(full_mod_path: Path, keys_path: Path) -> None:
-    """Recursively search for the server key directory and copy it's keys to the
-    destination directory.
+def find_key_dirs(full_mod_path: Path) -> List[Path]:
+    """Recursively search for the directories in the given mod that hold server keys"""
+    return [
+        Path(parent)
+        for parent, _, _ in os.walk(full_mod_path)
+        if is_key_dir(Path(parent))
+    ]
+
+
+def copy_key(source: Path, keys_path: Path) -> None:
+    """Copy the key file into the keys directory, replacing any key of the same name"""
+    if (keys_path / source.name).is_file():
+        os.remove(keys_path / source.name)
+    shutil.copy2(source, keys_path)
+
+
+def copy_keys(
+    full_mod_path: Path,
+    keys_path: Path,
+    key_dirs: Optional[List[Path]] = None,
+    put_file: Optional[Callable[[Path, str], None]] = None,
+) -> None:
+    """Copy the keys in the given mod's server key directories to the destination
+    directory, or pass each to put_file along with its name instead. The key directories
+    are searched for unless they are already known.
     """
+    if key_dirs is None:
+        key_dirs = find_key_dirs(full_mod_path)
     key_copied = False
-    for parent, _, files in os.walk(full_mod_path):
-        parent_path = Path(parent)
-        if is_key_dir(parent_path):
-            for file_name in files:
-                click.echo(
-                    f"Copying server key file {file_name} for: {full_mod_path.name}"
-                )
-                if (keys_path / file_name).is_file():
-                    os.remove(keys_path / file_name)
-                shutil.copy2((parent_path / file_name), keys_path)
-                key_copied = True
+    for key_dir in key_dirs:
+        for entry in os.scandir(key_dir):
+            if not entry.is_file():
+                continue
+            click.echo(f"Copying server key file {entry.name} for: {full_mod_path.name}")
+            if put_file is None:
+                copy_key(Path(entry.path), keys_path)
+            else:
+                put_file(Path(entry.path), entry.name)
+            metrics.METRICS.add("keys", files=1, bytes=entry.stat().st_size)
+            key_copied = True
     if not key_copied:
         click.echo(f"WARNING: A server key for {full_mod_path.name} was not found!")
 
 
 def prepare_mod_dir(
-    mod_id: str, downloaded_dir: Path, destination_dir: Path, mod_dir_name: str
-) -> None:
-    """Rename the mod directory in the download folder and make sure the destination
-    mod folder is clear of it
+    mod_id: str,
+    downloaded_dir: Path,
+    mod_dir_name: str,
+    link_path: Optional[Path] = None,
+    max_workers: int = 1,
+) -> Path:
+    """Rename the mod directory in the download folder. The published copy is left in
+    place until the prepared one is swapped in for it. If a link path is given, the
+    downloaded mod is left where it is for steamcmd to update and a copy of it that
+    shares its files is made there instead. Return the directory to prepare.
+    """
+    if link_path is None:
+        prepared_dir = downloaded_dir / mod_dir_name
+        shutil.rmtree(str(prepared_dir), ignore_errors=True)
+        os.rename(downloaded_dir / mod_id, prepared_dir)
+    else:
+        prepared_dir = link_path / mod_dir_name
+        link_mod_dir(downloaded_dir / mod_id, prepared_dir, max_workers)
+    return prepared_dir
+
+
+def hash_file(path: Path) -> str:
+    """Get the SHA-256 hex digest of the given file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as open_file:
+        for chunk in iter(lambda: open_file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_same_file(source: Path, destination: Path, use_hash: bool = False) -> bool:
+    """Check if the destination file is already the same as the source file, going by
+    size and modification time, or by contents if use_hash is set. Files of the same size
+    with different modification times are compared by contents either way, since
+    steamcmd writes every file it downloads afresh.
+    """
+    try:
+        source_stat = source.stat()
+        destination_stat = destination.stat()
+    except FileNotFoundError:
+        return False
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+    # Allow for file systems that only keep modification times to the second
+    if not use_hash and abs(source_stat.st_mtime - destination_stat.st_mtime) < 1:
+        return True
+    return hash_file(source) == hash_file(destination)
+
+
+def get_directory_size(directory: Path) -> int:
+    """Get the total size in bytes of all the files in the given directory, which is
+    empty if it doesn't exist
+    """
+    size = 0
+    for parent, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(parent, file_name))
+            except FileNotFoundError:
+                # Moved away while the directory was being walked
+                continue
+    return size
+
+
+def get_relative_files(directory: Path) -> Set[Path]:
+    """Get the paths of all the files in the given directory relative to it"""
+    return {
+        Path(parent, file_name).relative_to(directory)
+        for parent, _, file_names in os.walk(directory)
+        for file_name in file_names
+    }
+
+
+def hash_mod_dir(mod_dir: Path) -> Dict[str, str]:
+    """Get the hash of each file in the given directory, by its path relative to it"""
+    return {
+        relative_path.as_posix(): hash_file(mod_dir / relative_path)
+        for relative_path in get_relative_files(mod_dir)
+    }
+
+
+def index_mod_dir(mod_dir: Path, hashes: Dict[str, str]) -> Dict[str, FileRecord]:
+    """Record the size and modification time of each file in the given directory along
+    with its hash, which is looked up by its relative path
+    """
+    index = dict()
+    for relative_path, file_hash in hashes.items():
+        stat = (mod_dir / relative_path).stat()
+        index[relative_path] = FileRecord(stat.st_size, stat.st_mtime_ns, file_hash)
+    return index
+
+
+def verify_mod_dir(mod_dir: Path, index: Dict[str, FileRecord]) -> Verification:
+    """Check the given mod directory against the index of its files as they were
+    published. Only files whose size or modification time changed are hashed, and those
+    whose contents turn out to be the same are indexed again so they aren't next time.
+    """
+    if not mod_dir.is_dir():
+        return Verification(["the mod directory is missing"], index)
+    found = {path.as_posix() for path in get_relative_files(mod_dir)}
+    problems = [f"{path} is missing" for path in sorted(set(index) - found)]
+    problems.extend(f"{path} is unexpected" for path in sorted(found - set(index)))
+    new_index = dict(index)
+    hashed_files = hashed_bytes = 0
+    for relative_path in sorted(found.intersection(index)):
+        record = index[relative_path]
+        stat = (mod_dir / relative_path).stat()
+        if stat.st_size != record.size:
+            problems.append(
+                f"{relative_path} is {stat.st_size} bytes instead of {record.size}"
+            )
+            continue
+        if stat.st_mtime_ns == record.mtime_ns:
+            continue
+        file_hash = hash_file(mod_dir / relative_path)
+        hashed_files += 1
+        hashed_bytes += stat.st_size
+        if file_hash == record.hash:
+            new_index[relative_path] = record._replace(mtime_ns=stat.st_mtime_ns)
+        else:
+            problems.append(f"{relative_path} has different contents")
+    return Verification(problems, new_index, hashed_files, hashed_bytes)
+
+
+def copy_file_range(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    """Copy up to count bytes at the offset with copy_file_range, which some network
+    file systems can do on the server
+    """
+    return os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+
+
+def send_file(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    """Copy up to count bytes at the offset with sendfile"""
+    return os.sendfile(destination_fd, source_fd, offset, count)
+
+
+def copy_with_kernel(source_fd: int, destination_fd: int, size: int) -> bool:
+    """Copy size bytes between the given files without passing them through Python.
+    Return False if the kernel can't copy between the files, in which case nothing was
+    copied.
+    """
+    copiers = []
+    if hasattr(os, "copy_file_range"):
+        copiers.append(copy_file_range)
+    if hasattr(os, "sendfile"):
+        copiers.append(send_file)
+    for copier in copiers:
+        copied = 0
+        try:
+            while copied < size:
+                done = copier(source_fd, destination_fd, copied, size - copied)
+                if not done:
+                    break
+                copied += done
+        except OSError:
+            if copied:
+                raise
+            continue
+        return True
+    return False
+
+
+def copy_file(source: Path, destination: Path) -> None:
+    """Copy the file's contents and metadata, letting the kernel copy large files"""
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        size = os.fstat(source_file.fileno()).st_size
+        if size < KERNEL_COPY_MIN_SIZE or not copy_with_kernel(
+            source_file.fileno(), destination_file.fileno(), size
+        ):
+            shutil.copyfileobj(source_file, destination_file, COPY_CHUNK_SIZE)
+    shutil.copystat(source, destination)
+
+
+def swap_in(staging_dir: Path, destination_dir: Path) -> None:
+    """Replace the destination directory with the staging one, with a rename so that it
+    is never missing or half updated
+    """
+    old_dir = destination_dir.with_name(f".{destination_dir.name}.old")
+    shutil.rmtree(str(old_dir), ignore_errors=True)
+    if destination_dir.exists():
+        os.rename(destination_dir, old_dir)
+    os.rename(staging_dir, destination_dir)
+    shutil.rmtree(str(old_dir), ignore_errors=True)
+
+
+def is_same_file_system(first: Path, second: Path) -> bool:
+    """Check if the given paths are on the same file system, so can be renamed between"""
+    return os.stat(first).st_dev == os.stat(second).st_dev
+
+
+def transfer_mod_dir(
+    source_dir: Path, destination_dir: Path, max_workers: int = TRANSFER_WORKERS
+) -> TransferStats:
+    """Move the source directory to the destination. On the same file system it is
+    renamed. Otherwise its files are copied next to the destination by the given number
+    of threads, keeping their metadata, and the copy is swapped in with a rename before
+    the source is deleted.
+    """
+    start = time.perf_counter()
+    relative_files = sorted(get_relative_files(source_dir))
+    total_bytes = sum((source_dir / path).stat().st_size for path in relative_files)
+    if is_same_file_system(source_dir, destination_dir.parent):
+        swap_in(source_dir, destination_dir)
+        return TransferStats(
+            len(relative_files), total_bytes, time.perf_counter() - start, True
+        )
+    staging_dir = destination_dir.with_name(f".{destination_dir.name}.staging")
+    shutil.rmtree(str(staging_dir), ignore_errors=True)
+    directories = [Path()] + [
+        Path(parent, directory).relative_to(source_dir)
+        for parent, directories, _ in os.walk(source_dir)
+        for directory in directories
+    ]
+    for directory in directories:
+        (staging_dir / directory).mkdir(parents=True, exist_ok=True)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(
+                executor.map(
+                    lambda path: copy_file(source_dir / path, staging_dir / path),
+                    relative_files,
+                )
+            )
+        # After the files, since adding them changes the directories' times
+        for directory in reversed(directories):
+            shutil.copystat(source_dir / directory, staging_dir / directory)
+    except BaseException:
+        shutil.rmtree(str(staging_dir), ignore_errors=True)
+        raise
+    swap_in(staging_dir, destination_dir)
+    shutil.rmtree(str(source_dir))
+    return TransferStats(len(relative_files), total_bytes, time.perf_counter() - start)
+
+
+def reflink_file(source: Path, destination: Path) -> None:
+    """Make a new destination file that shares the source file's data, copied on write.
+    Raises OSError if the file system can't.
+    """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(source, "rb") as source_file, open(destination, "xb") as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+
+def make_read_only(path: Path) -> None:
+    """Stop the file from being written to, through any of its hard links"""
+    mode = path.stat().st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def link_file(source: Path, destination: Path) -> str:
+    """Replace the destination file with a reflink to the source file, or a hard link
+    where the file system can't reflink, in one step. Hard linked files are made read
+    only, since writing to one would change the other too. Return which kind of link was
+    made. Raises OSError if the file system can do neither.
+    """
+    temp_path = destination.with_name(f".{destination.name}.link")
+    try:
+        try:
+            reflink_file(source, temp_path)
+            shutil.copystat(destination, temp_path)
+            kind = "reflink"
+        except OSError:
+            if temp_path.exists():
+                os.remove(temp_path)
+            os.link(source, temp_path)
+            make_read_only(temp_path)
+            kind = "hardlink"
+        os.replace(temp_path, destination)
+    except OSError:
+        if temp_path.exists():
+            os.remove(temp_path)
+        raise
+    return kind
+
+
+def clone_file(source: Path, destination: Path) -> str:
+    """Make a new destination file with the source file's contents that shares its data
+    where the file system allows: a reflink, or else a hard link, or else a copy. Hard
+    linked files are made read only, so that patching either copy in place fails rather
+    than changing the other. Return which kind of file was made.
+    """
+    try:
+        reflink_file(source, destination)
+        shutil.copystat(source, destination)
+        return "reflink"
+    except OSError:
+        if destination.exists():
+            os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        copy_file(source, destination)
+        return "copy"
+    make_read_only(destination)
+    return "hardlink"
+
+
+def link_mod_dir(
+    source_dir: Path, destination_dir: Path, max_workers: int = 1
+) -> Counter:
+    """Make the destination directory a copy of the source one whose files share the
+    source's data where they can, leaving the source as it is. Hard linked files are
+    read only, so should steamcmd ever patch a file in place rather than write it afresh,
+    it fails instead of changing the copy. Return how many files of each kind were made.
+    """
+    shutil.rmtree(str(destination_dir), ignore_errors=True)
+    relative_files = sorted(get_relative_files(source_dir))
+    for parent, directories, _ in os.walk(source_dir):
+        for directory in directories:
+            (destination_dir / Path(parent, directory).relative_to(source_dir)).mkdir(
+                parents=True, exist_ok=True
+            )
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        kinds = Counter(
+            executor.map(
+                lambda path: clone_file(source_dir / path, destination_dir / path),
+                relative_files,
+            )
+        )
+    metrics.METRICS.add(
+        "link",
+        files=len(relative_files),
+        reflinks=kinds["reflink"],
+        hardlinks=kinds["hardlink"],
+        copies=kinds["copy"],
+    )
+    return kinds
+
+
+def stage_mod_dir(
+    source_dir: Path, destination_dir: Path, staging_dir: Path, use_hash: bool
+) -> SyncStats:
+    """Build a copy of the source directory in the staging directory, hard linking
+    files that are unchanged in the destination directory instead of copying them.
+    Raises OSError if the file system can't hard link.
+    """
+    stats = SyncStats()
+    source_files = get_relative_files(source_dir)
+    for relative_path in sorted(source_files):
+        source, destination = source_dir / relative_path, destination_dir / relative_path
+        staged = staging_dir / relative_path
+        staged.parent.mkdir(parents=True, exist_ok=True)
+        size = source.stat().st_size
+        if is_same_file(source, destination, use_hash):
+            os.link(destination, staged)
+            stats = stats._replace(
+                skipped_files=stats.skipped_files + 1,
+                skipped_bytes=stats.skipped_bytes + size,
+            )
+        else:
+            copy_file(source, staged)
+            stats = stats._replace(
+                copied_files=stats.copied_files + 1,
+                copied_bytes=stats.copied_bytes + size,
+            )
+    for parent, directories, _ in os.walk(source_dir):
+        for directory in directories:
+            (staging_dir / Path(parent, directory).relative_to(source_dir)).mkdir(
+                parents=True, exist_ok=True
+            )
+    if destination_dir.is_dir():
+        stats = stats._replace(
+            deleted_files=len(get_relative_files(destination_dir) - source_files)
+        )
+    return stats
+
+
+def sync_mod_dir_in_place(
+    source_dir: Path, destination_dir: Path, use_hash: bool
+) -> SyncStats:
+    """Bring the destination directory up to date with the source directory file by
+    file. Each file is replaced atomically, but not the directory as a whole.
     """
-    shutil.rmtree(str(downloaded_dir / mod_dir_name), ignore_errors=True)
-    os.rename(downloaded_dir / mod_id, downloaded_dir / mod_dir_name)
-    shutil.rmtree(str(destination_dir / mod_dir_name), ignore_errors=True)
+    stats = SyncStats()
+    source_files = get_relative_files(source_dir)
+    for parent, directories, _ in os.walk(source_dir):
+        for directory in directories:
+            (destination_dir / Path(parent, directory).relative_to(source_dir)).mkdir(
+                parents=True, exist_ok=True
+            )
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    for relative_path in sorted(source_files):
+        source, destination = source_dir / relative_path, destination_dir / relative_path
+        size = source.stat().st_size
+        if is_same_file(source, destination, use_hash):
+            stats = stats._replace(
+                skipped_files=stats.skipped_files + 1,
+                skipped_bytes=stats.skipped_bytes + size,
+            )
+            continue
+        temp_path = destination.with_name(f".{destination.name}.partial")
+        copy_file(source, temp_path)
+        os.replace(temp_path, destination)
+        stats = stats._replace(
+            copied_files=stats.copied_files + 1, copied_bytes=stats.copied_bytes + size
+        )
+    for parent, directories, file_names in os.walk(destination_dir, topdown=False):
+        relative_parent = Path(parent).relative_to(destination_dir)
+        for file_name in file_names:
+            if relative_parent / file_name not in source_files:
+                os.remove(Path(parent, file_name))
+                stats = stats._replace(deleted_files=stats.deleted_files + 1)
+        for directory in directories:
+            if not (source_dir / relative_parent / directory).is_dir():
+                shutil.rmtree(Path(parent, directory), ignore_errors=True)
+    return stats
 
 
-def rename_to_safe(parent: str, files_or_dirs: List[str]) -> None:
-    """Makes the given files or dirs in the given parent directory unix safe
-    eg: lowercase, etc...
+def sync_mod_dir(
+    source_dir: Path, destination_dir: Path, use_hash: bool = False
+) -> SyncStats:
+    """Make the destination mod directory match the source one, only copying files that
+    are new or have changed and deleting files that are gone. The new version is built
+    next to the old one, with unchanged files hard linked across, and swapped in with a
+    rename so the mod is never missing or half updated. On file systems without hard
+    links the destination is updated in place instead.
     """
-    parent_path = Path(parent)
-    for file_or_dir in files_or_dirs:
-        safe_name = helpers.make_filename_safe(file_or_dir)
-        os.rename(parent_path / file_or_dir, parent_path / safe_name)
+    staging_dir = destination_dir.with_name(f".{destination_dir.name}.staging")
+    old_dir = destination_dir.with_name(f".{destination_dir.name}.old")
+    for leftover in (staging_dir, old_dir):
+        shutil.rmtree(str(leftover), ignore_errors=True)
+    try:
+        stats = stage_mod_dir(source_dir, destination_dir, staging_dir, use_hash)
+    except OSError as error:
+        shutil.rmtree(str(staging_dir), ignore_errors=True)
+        click.echo(
+            (
+                f"WARNING: Could not stage {destination_dir.name} ({error}), so it "
+                "will be synced in place!"
+            )
+        )
+        return sync_mod_dir_in_place(source_dir, destination_dir, use_hash)
+    swap_in(staging_dir, destination_dir)
+    return stats
 
 
-def make_files_and_dirs_safe(full_mod_path: Path) -> None:
+def get_safe_names(names: List[str], parent: Path) -> Dict[str, str]:
+    """Work out what each of the given names in the given directory need to be renamed
+    to in order to be safe. Names that are already safe are left out, as is every name
+    that would end up the same as another name in the directory, which are reported, so
+    the result doesn't depend on the order of the names.
+    """
+    safe_names = {name: helpers.make_filename_safe(name) for name in names}
+    final_names = Counter(safe_names.values())
+    renames = dict()
+    for name, safe_name in sorted(safe_names.items()):
+        if safe_name == name:
+            continue
+        # A name left as it is isn't safe, so it can't clash with a safe one in turn
+        if not safe_name or final_names[safe_name] > 1:
+            click.echo(
+                (
+                    f"WARNING: Can't rename {parent / name} to a safe name as it would "
+                    "clash with another name, so it is left as it is!"
+                )
+            )
+            continue
+        renames[name] = safe_name
+    return renames
+
+
+def make_tree_safe(directory: Path, executor: Optional[Executor] = None) -> List[Path]:
+    """Make all the names in the given directory safe, working bottom up so renaming a
+    directory never moves anything still to be renamed. Return the key directories
+    found along the way, relative to the given directory and with their safe names.
+    Each subdirectory is handed to the executor if one is given.
+    """
+    with os.scandir(directory) as scanned:
+        entries = list(scanned)
+    subdirectories = [
+        entry.name for entry in entries if entry.is_dir(follow_symlinks=False)
+    ]
+    if executor is None:
+        subdirectory_key_dirs = [
+            make_tree_safe(directory / name) for name in subdirectories
+        ]
+    else:
+        subdirectory_key_dirs = list(
+            executor.map(make_tree_safe, [directory / name for name in subdirectories])
+        )
+    renames = get_safe_names([entry.name for entry in entries], directory)
+    for name, safe_name in renames.items():
+        os.rename(directory / name, directory / safe_name)
+    metrics.METRICS.add("rename", files=len(entries), renamed=len(renames))
+    key_dirs = []
+    for name, key_dirs_within in zip(subdirectories, subdirectory_key_dirs):
+        safe_path = Path(renames.get(name, name))
+        if is_key_dir(safe_path):
+            key_dirs.append(safe_path)
+        key_dirs.extend(safe_path / key_dir for key_dir in key_dirs_within)
+    return key_dirs
+
+
+def make_files_and_dirs_safe(full_mod_path: Path, max_workers: int = 1) -> List[Path]:
     """Recursively make all the file and directory names in the given directory safe for
-    linux.
+    linux, in a single pass that only renames what needs it. The top level
+    subdirectories are shared out between max_workers threads. Return the paths of the
+    server key directories that were found.
     """
-    # Do files and dirs separately as on linux renaming files could fail if parent dir
-    # is changed first.
-    for parent, _, files in os.walk(full_mod_path):
-        rename_to_safe(parent, files)
-    for parent, directories, _ in os.walk(full_mod_path):
-        rename_to_safe(parent, directories)
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            key_dirs = make_tree_safe(full_mod_path, executor)
+    else:
+        key_dirs = make_tree_safe(full_mod_path)
+    return [full_mod_path / key_dir for key_dir in key_dirs]
 
 
 def save_mods_details(mods_path: str, mods_details: dict) -> None:
     """Save mods details to a json file at the given path"""
-    with open(Path(mods_path, MODS_DETAILS_FILENAME), "w") as open_file:
-        open_file.write(json.dumps(mods_details))
+    helpers.write_atomically(
+        Path(mods_path, MODS_DETAILS_FILENAME), json.dumps(mods_details).encode()
+    )
+
+
+def get_dependency_graph(mods_path: Path) -> DependencyGraph:
+    """Get the dependency graph saved in the given mods directory, or an empty one"""
+    graph_path = mods_path / DEPENDENCY_GRAPH_FILENAME
+    if graph_path.is_file():
+        with open(graph_path) as open_file:
+            return DependencyGraph(json.load(open_file))
+    return DependencyGraph()
 
 
-def save_modlines(manifest_url: str, mods_details: dict, mods_path: str) -> None:
+def save_dependency_graph(mods_path: Path, graph: DependencyGraph) -> None:
+    """Save the given dependency graph in the given mods directory"""
+    helpers.write_atomically(
+        mods_path / DEPENDENCY_GRAPH_FILENAME, json.dumps(graph.nodes).encode()
+    )
+
+
+def update_modlines(mods_path: str, modlines: Dict[str, List[str]]) -> None:
+    """Add the given mod lines to the file that maps mod folders to mod lines, keeping
+    the others in it as they are
+    """
+    modlines_path = Path(mods_path, MODLINES_FILENAME)
+    try:
+        saved = json.loads(modlines_path.read_text())
+    except (OSError, ValueError):
+        saved = dict()
+    saved.update(modlines)
+    helpers.write_atomically(modlines_path, json.dumps(saved).encode())
+
+
+def save_modlines(
+    manifest_url: str,
+    mods_details: dict,
+    mods_path: str,
+    graph: Optional[DependencyGraph] = None,
+) -> None:
     """Save a file that maps all mod folders to mod lines according to the manifest at
-    the given URL
+    the given URL. Dependencies are taken from the given graph if there is one, or
+    else looked up again.
     """
     mods_manifest = helpers.get_mods_manifest(manifest_url)
     modlines = dict()
     for modline in mods_manifest:
-        mod_urls = steam_site.collect_all_dependencies(
-            {
-                steam_site.get_url_from_id(mod_id)
-                for mod_id in mods_manifest[modline].values()
-            }
-        )
-        mod_ids = {steam_site.get_id_from_url(mod_url) for mod_url in mod_urls}
+        if graph is not None:
+            mod_ids = set(graph.get_closure(mods_manifest[modline].values()))
+        else:
+            mod_urls = steam_site.collect_all_dependencies(
+                {
+                    steam_site.get_url_from_id(mod_id)
+                    for mod_id in mods_manifest[modline].values()
+                }
+            )
+            mod_ids = {steam_site.get_id_from_url(mod_url) for mod_url in mod_urls}
         if mod_ids.difference(set(mods_details)):
             click.echo(
                 (
@@ -118,5 +733,6 @@ def save_modlines(manifest_url: str, mods_details: dict, mods_path: str) -> None
             )
             continue
         modlines[modline] = [mods_details[mod_id]["directory_name"] for mod_id in mod_ids]
-    with open(Path(mods_path, MODLINES_FILENAME), "w") as open_file:
-        open_file.write(json.dumps(modlines))
+    helpers.write_atomically(
+        Path(mods_path, MODLINES_FILENAME), json.dumps(modlines).encode()
+    )
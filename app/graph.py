@@ -0,0 +1,53 @@
+"""The dependency graph of steam workshop mods, kept between runs"""
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+
+class DependencyGraph:
+    """Which mods each mod depends on, as of when each mod was last updated. Closures
+    are remembered until the graph changes.
+    """
+
+    def __init__(self, nodes: Optional[Dict[str, dict]] = None) -> None:
+        self.nodes: Dict[str, dict] = nodes if nodes is not None else dict()
+        self.closures: Dict[FrozenSet[str], FrozenSet[str]] = dict()
+
+    def is_current(self, mod_id: str, updated: int) -> bool:
+        """Check if the dependencies of the given mod are known as of when it was last
+        updated
+        """
+        return mod_id in self.nodes and self.nodes[mod_id]["updated"] == updated
+
+    def get_dependencies(self, mod_id: str) -> List[str]:
+        """Get the IDs of the mods the given mod directly depends on"""
+        if mod_id not in self.nodes:
+            return []
+        return self.nodes[mod_id]["dependencies"]
+
+    def set_dependencies(
+        self, mod_id: str, updated: int, dependencies: List[str]
+    ) -> None:
+        """Record the mods the given mod depends on as of when it was last updated"""
+        self.nodes[mod_id] = {"updated": updated, "dependencies": sorted(dependencies)}
+        self.closures.clear()
+
+    def get_closure(self, mod_ids: Iterable[str]) -> FrozenSet[str]:
+        """Get the given mods and every mod they directly or indirectly depend on"""
+        roots = frozenset(mod_ids)
+        if roots not in self.closures:
+            closure = set(roots)
+            frontier = list(roots)
+            while frontier:
+                for dependency in self.get_dependencies(frontier.pop()):
+                    if dependency not in closure:
+                        closure.add(dependency)
+                        frontier.append(dependency)
+            self.closures[roots] = frozenset(closure)
+        return self.closures[roots]
+
+    def prune(self, mod_ids: Iterable[str]) -> None:
+        """Forget every mod that the given mods don't depend on"""
+        keep = self.get_closure(mod_ids)
+        self.nodes = {
+            mod_id: node for mod_id, node in self.nodes.items() if mod_id in keep
+        }
+        self.closures.clear()
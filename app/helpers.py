@@ -1,18 +1,173 @@
 """Common helper funcions"""
+import hashlib
 import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import DefaultDict, NamedTuple, Optional, Set, Tuple
 import requests
+from app import client, metrics
 
 
-CACHE: dict = dict()
+POOL_SIZE = 16
+CACHE_PATH = Path(os.environ.get("ZAMD_CACHE_PATH", Path.home() / ".cache" / "zamd"))
+CACHE_MAX_BYTES = 512 * 1024 ** 2
+CACHE_TTL = 30 * 24 * 60 * 60
+VALIDATED: Set[str] = set()
+URL_LOCKS: DefaultDict[str, threading.Lock] = defaultdict(threading.Lock)
+URL_LOCKS_LOCK = threading.Lock()
+SESSION = requests.Session()
+CLIENT = client.Client(SESSION)
 
 
-def get_requests_object(url: str) -> requests.models.Response:
-    """Memoization for web requests"""
-    if url not in CACHE:
-        request = requests.get(url)
-        assert request.status_code == 200
-        CACHE[url] = request
-    return CACHE[url]
+class CachedResponse(NamedTuple):
+    """The parts of a successful web request that are kept in the cache"""
+
+    url: str
+    status_code: int
+    content: bytes
+    encoding: str
+    date: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors="replace")
+
+
+def resize_pool(pool_size: int) -> None:
+    """Make sure the shared session can keep the given number of connections alive per
+    host, so that concurrent workers don't throw away each other's connections.
+    """
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    SESSION.mount("https://", adapter)
+    SESSION.mount("http://", adapter)
+
+
+resize_pool(POOL_SIZE)
+
+
+def get_url_lock(url: str) -> threading.Lock:
+    """Get the lock that guards fetching the given URL"""
+    with URL_LOCKS_LOCK:
+        return URL_LOCKS[url]
+
+
+def get_cache_paths(url: str) -> Tuple[Path, Path]:
+    """Get the paths of the body and metadata files the given URL is cached in"""
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return CACHE_PATH / f"{key}.body", CACHE_PATH / f"{key}.json"
+
+
+def write_atomically(path: Path, data: bytes) -> None:
+    """Write the given data so that the file at the path is never left half written"""
+    temp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+    with open(temp_path, "wb") as open_file:
+        open_file.write(data)
+    os.replace(temp_path, path)
+
+
+def read_cached(url: str) -> Optional[CachedResponse]:
+    """Get the cached response for the given URL, if there is one"""
+    body_path, meta_path = get_cache_paths(url)
+    try:
+        with open(meta_path) as open_file:
+            meta = json.loads(open_file.read())
+        with open(body_path, "rb") as open_file:
+            content = open_file.read()
+    except (OSError, ValueError):
+        return None
+    return CachedResponse(content=content, status_code=200, **meta)
+
+
+def write_cached(response: CachedResponse) -> None:
+    """Save the given response to the cache"""
+    body_path, meta_path = get_cache_paths(response.url)
+    meta = response._asdict()
+    del meta["content"], meta["status_code"]
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    write_atomically(body_path, response.content)
+    write_atomically(meta_path, json.dumps(meta).encode())
+
+
+def get_requests_object(url: str) -> CachedResponse:
+    """Memoization for web requests, persisted to disk between runs. A cached response
+    is revalidated with the server the first time it is asked for in a run, so an
+    unchanged page only costs a 304. Threads asking for the same URL at the same time
+    wait for the first one to fetch it instead of fetching it again. Raises
+    requests.HTTPError if the server doesn't give a successful response, even after
+    retrying.
+    """
+    with get_url_lock(url):
+        cached = read_cached(url)
+        if cached and url in VALIDATED:
+            metrics.METRICS.add("fetch", cache_hits=1)
+            return cached
+        headers = dict()
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+        with metrics.METRICS.time("fetch"):
+            request = CLIENT.request("GET", url, headers=headers)
+        metrics.METRICS.add("fetch", requests=1, bytes=len(request.content))
+        if cached and request.status_code == 304:
+            metrics.METRICS.add("fetch", not_modified=1)
+            response = cached
+            os.utime(get_cache_paths(url)[1])
+        else:
+            response = CachedResponse(
+                url=url,
+                status_code=request.status_code,
+                content=request.content,
+                encoding=request.encoding or "utf-8",
+                date=request.headers.get("Date", ""),
+                etag=request.headers.get("ETag"),
+                last_modified=request.headers.get("Last-Modified"),
+            )
+            write_cached(response)
+        VALIDATED.add(url)
+    return response
+
+
+def post_for_json(url: str, data: dict) -> dict:
+    """Post the given form data to the given URL and return the decoded JSON response"""
+    with metrics.METRICS.time("api"):
+        request = CLIENT.request("POST", url, phase="api", data=data)
+    metrics.METRICS.add("api", requests=1, bytes=len(request.content))
+    return request.json()
+
+
+def evict_cache(max_bytes: int = CACHE_MAX_BYTES, ttl: int = CACHE_TTL) -> None:
+    """Remove cached responses that haven't been used within the TTL, then the least
+    recently used ones until the cache fits in the given number of bytes
+    """
+    if not CACHE_PATH.is_dir():
+        return
+    entries = []
+    for meta_path in CACHE_PATH.glob("*.json"):
+        body_path = meta_path.with_suffix(".body")
+        try:
+            last_used = meta_path.stat().st_mtime
+            size = body_path.stat().st_size + meta_path.stat().st_size
+        except OSError:
+            last_used, size = 0, 0
+        entries.append((last_used, size, body_path, meta_path))
+    entries.sort(reverse=True)
+    kept_bytes = 0
+    expired_before = time.time() - ttl
+    for last_used, size, body_path, meta_path in entries:
+        if last_used >= expired_before and kept_bytes + size <= max_bytes:
+            kept_bytes += size
+            continue
+        for path in (meta_path, body_path):
+            if path.is_file():
+                os.remove(path)
 
 
 def make_filename_safe(filename: str) -> str:
@@ -28,3 +183,8 @@ def make_filename_safe(filename: str) -> str:
 def get_mods_manifest(manifest_url: str) -> dict:
     """Get a dictionary of the manifest at the given URL"""
     return json.loads(get_requests_object(manifest_url).text)
+
+
+def get_manifest_hash(manifest_url: str) -> str:
+    """Get a hash of the manifest at the given URL, to tell if it has changed"""
+    return hashlib.sha256(get_requests_object(manifest_url).content).hexdigest()
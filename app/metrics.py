@@ -0,0 +1,92 @@
+"""Timings and counters for each phase of a run, per mod where it applies"""
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import DefaultDict, Iterator, List, Optional
+
+
+PREFIX = "zamd"
+
+
+def format_labels(**labels: str) -> str:
+    """Format the given labels for a Prometheus sample, escaped the same way as JSON"""
+    pairs = (
+        f"{name}={json.dumps(value, ensure_ascii=False)}"
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metrics:
+    """Counters kept per phase of a run, such as fetching pages or renaming files, and
+    per mod within each phase. Safe to add to from several threads.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.phases: DefaultDict[str, Counter] = defaultdict(Counter)
+        self.mods: DefaultDict[str, DefaultDict[str, Counter]] = defaultdict(
+            lambda: defaultdict(Counter)
+        )
+
+    def add(self, phase: str, mod_id: Optional[str] = None, **counts: float) -> None:
+        """Add the given counts to the phase, and to the mod within it if one is given"""
+        with self.lock:
+            self.phases[phase].update(counts)
+            if mod_id is not None:
+                self.mods[mod_id][phase].update(counts)
+
+    @contextmanager
+    def time(self, phase: str, mod_id: Optional[str] = None) -> Iterator[None]:
+        """Count a call to the phase and the wall time it takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, mod_id, calls=1, seconds=time.perf_counter() - start)
+
+    def reset(self) -> None:
+        """Forget everything counted so far"""
+        with self.lock:
+            self.phases.clear()
+            self.mods.clear()
+
+    def to_dict(self) -> dict:
+        """Get the counts by phase and by mod"""
+        with self.lock:
+            return {
+                "phases": {phase: dict(counts) for phase, counts in self.phases.items()},
+                "mods": {
+                    mod_id: {phase: dict(counts) for phase, counts in phases.items()}
+                    for mod_id, phases in self.mods.items()
+                },
+            }
+
+    def to_prometheus(self, **gauges: float) -> str:
+        """Get the counts in the Prometheus text format, for node_exporter's textfile
+        collector, along with the given gauges about the run as a whole
+        """
+        report = self.to_dict()
+        samples: DefaultDict[str, List[str]] = defaultdict(list)
+        for name, value in gauges.items():
+            samples[f"{PREFIX}_{name}"].append(f"{PREFIX}_{name} {value}")
+        for phase, counts in report["phases"].items():
+            for counter, value in counts.items():
+                name = f"{PREFIX}_phase_{counter}"
+                samples[name].append(f"{name}{format_labels(phase=phase)} {value}")
+        for mod_id, phases in report["mods"].items():
+            for phase, counts in phases.items():
+                for counter, value in counts.items():
+                    name = f"{PREFIX}_mod_{counter}"
+                    labels = format_labels(mod_id=mod_id, phase=phase)
+                    samples[name].append(f"{name}{labels} {value}")
+        lines = []
+        for name in sorted(samples):
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(sorted(samples[name]))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
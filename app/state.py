@@ -0,0 +1,148 @@
+"""Transactional record of the mods in the mods directory, kept in SQLite"""
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+from app import files, helpers
+
+
+STATE_FILENAME = ".zamd_state.sqlite3"
+
+
+def get_state_path(download_path: Path, mods_path: Path) -> Path:
+    """Get where the state of another mods directory updated in the same run as the
+    main one is kept in the download path, named after the directory
+    """
+    digest = hashlib.sha256(str(mods_path.resolve()).encode()).hexdigest()[:16]
+    return download_path / f".zamd_state.{digest}.sqlite3"
+
+
+class StateStore:
+    """The details of each mod in the mods directory, saved one mod at a time so that a
+    crash never loses or corrupts what was already recorded. The JSON files the game
+    servers read are exported from it. The details are only taken from the mods details
+    file when the store is new or reset, after that the store is what counts.
+
+    The database uses a write ahead log, which SQLite can't keep on network file systems
+    such as an Azure file share, so it belongs on local storage.
+    """
+
+    def __init__(self, mods_path: Path, state_path: Optional[Path] = None) -> None:
+        self.mods_path = mods_path
+        self.lock = threading.Lock()
+        state_path = state_path or mods_path / STATE_FILENAME
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            str(state_path),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS mods (mod_id TEXT PRIMARY KEY, details TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (mod_id TEXT, path TEXT, size INTEGER, "
+            "mtime_ns INTEGER, hash TEXT, PRIMARY KEY (mod_id, path))"
+        )
+        if not self.get_mods_details():
+            self.set_mods_details(files.get_current_mod_details(mods_path))
+
+    def reset(self) -> None:
+        """Forget everything recorded and take the details from the mods details file
+        again, so that deleting or editing it takes effect
+        """
+        mods_details = files.get_current_mod_details(self.mods_path)
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM mods")
+            self.connection.execute("DELETE FROM meta")
+            self.connection.execute("DELETE FROM files")
+        self.set_mods_details(mods_details)
+
+    def get_mods_details(self) -> dict:
+        """Get the details of all recorded mods"""
+        with self.lock:
+            rows = self.connection.execute("SELECT mod_id, details FROM mods").fetchall()
+        return {mod_id: json.loads(details) for mod_id, details in rows}
+
+    def set_mods_details(self, mods_details: dict) -> None:
+        """Record the details of all the given mods in a single transaction"""
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO mods (mod_id, details) VALUES (?, ?)",
+                [
+                    (mod_id, json.dumps(details))
+                    for mod_id, details in mods_details.items()
+                ],
+            )
+
+    def set_mod_details(self, mod_id: str, mod_details: dict) -> None:
+        """Record the details of the given mod"""
+        self.set_mods_details({mod_id: mod_details})
+
+    def forget_mods(self, mod_ids: Iterable[str]) -> None:
+        """Forget the given mods and their files, so that they are downloaded again"""
+        rows = [(mod_id,) for mod_id in mod_ids]
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("DELETE FROM mods WHERE mod_id = ?", rows)
+            self.connection.executemany("DELETE FROM files WHERE mod_id = ?", rows)
+
+    def get_file_index(self, mod_id: str) -> Dict[str, files.FileRecord]:
+        """Get the size, modification time and hash of each of the mod's published files
+        by their path relative to the mod's directory
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime_ns, hash FROM files WHERE mod_id = ?",
+                (mod_id,),
+            ).fetchall()
+        return {path: files.FileRecord(*record) for path, *record in rows}
+
+    def set_file_index(self, mod_id: str, index: Dict[str, files.FileRecord]) -> None:
+        """Replace the index of the mod's published files in a single transaction"""
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM files WHERE mod_id = ?", (mod_id,))
+            self.connection.executemany(
+                "INSERT INTO files (mod_id, path, size, mtime_ns, hash) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(mod_id, path, *record) for path, record in index.items()],
+            )
+
+    def get_value(self, key: str) -> Optional[str]:
+        """Get a value recorded about the run as a whole, such as the manifest's hash"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_value(self, key: str, value: str) -> None:
+        """Record a value about the run as a whole"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def export_mods_details(self) -> None:
+        """Write the recorded details to the mods details file in the mods directory,
+        replacing it in one step
+        """
+        helpers.write_atomically(
+            self.mods_path / files.MODS_DETAILS_FILENAME,
+            json.dumps(self.get_mods_details()).encode(),
+        )
+
+    def close(self) -> None:
+        """Close the underlying database"""
+        with self.lock:
+            self.connection.close()
@@ -1,22 +1,157 @@
 """Code to scrape the Steam site for workshop item details"""
-from typing import List, Set
+import hashlib
+import importlib.util
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
 from urllib.parse import urlparse, parse_qs, urlunparse, urlencode
 from bs4 import BeautifulSoup
 import click
-from app import helpers
+import requests
+from app import helpers, metrics
+from app.graph import DependencyGraph
+
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore
 
 
 STEAM_WORKHOP_PAGE_URL = "https://steamcommunity.com/workshop/filedetails/"
+STEAM_API_DETAILS_URL = (
+    "https://api.steampowered.com/ISteamRemoteStorage/GetPublishedFileDetails/v1/"
+)
+API_BATCH_SIZE = 100
+BACKENDS = ("html", "api")
+MAX_WORKERS = 8
+PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+FILE_SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+UPDATED_DATE_FORMATS = ("%d %b %Y @ %I:%M%p", "%b %d %Y @ %I:%M%p")
 
+# Have Steam render dates on workshop pages in UTC
+helpers.SESSION.cookies.set("timezoneOffset", "0,0", domain="steamcommunity.com")
 
-def get_dependencies(url: str) -> List[str]:
-    """Get steam workshop urls for all dependencies with the given mod's workshop url
+
+class WorkshopPage(NamedTuple):
+    """The details scraped from a mod's steam workshop page"""
+
+    title: str
+    updated: str
+    time_updated: int
+    file_size: int
+    dependencies: List[str]
+
+
+PAGES: Dict[str, WorkshopPage] = dict()
+# The hash of the page each parsed page was parsed from
+PAGE_HASHES: Dict[str, str] = dict()
+
+
+def parse_file_size(text: str) -> int:
+    """Get the number of bytes from a file size as it appears on a workshop page, eg:
+    1.993 MB
+    """
+    number, unit = text.split()
+    return int(float(number.replace(",", "")) * FILE_SIZE_UNITS[unit.upper()])
+
+
+def parse_updated_date(text: str, rendered: datetime) -> int:
+    """Get the epoch timestamp of a date as it appears on a workshop page rendered at
+    the given time, eg: 10 May, 2018 @ 11:01am. Dates from the year the page was
+    rendered in leave out the year, eg: 10 Jan @ 7:24am. Steam renders the dates in the
+    time zone given by the timezoneOffset cookie, which is set to UTC.
+    """
+    text = " ".join(text.replace(",", "").split())
+    if not re.search(r"\d{4} @", text):
+        text = text.replace(" @", f" {rendered.year} @")
+    for date_format in UPDATED_DATE_FORMATS:
+        try:
+            date = datetime.strptime(text, date_format).replace(tzinfo=timezone.utc)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"Unknown workshop date format: {text}")
+    # A date without a year that would be in the future must be from the year before
+    if date > rendered + timedelta(days=1):
+        date = date.replace(year=date.year - 1)
+    return int(date.timestamp())
+
+
+def parse_workshop_page(html: str, rendered: datetime) -> WorkshopPage:
+    """Pull all the details needed out of the given workshop page's html, rendered at
+    the given time, in one pass
     """
-    soup = BeautifulSoup(helpers.get_requests_object(url).text, "html.parser")
+    soup = BeautifulSoup(html, PARSER)
+    title = str(soup.find_all("div", class_="workshopItemTitle")[0].contents[0])
+    details_column = [
+        str(stat.contents[0]) for stat in soup.find_all("div", class_="detailsStatRight")
+    ]
     dependency_section = soup.find(id="RequiredItems")
     if dependency_section:
-        return [link.get("href") for link in dependency_section.find_all("a")]
-    return []
+        dependencies = [str(link["href"]) for link in dependency_section.find_all("a")]
+    else:
+        dependencies = []
+    soup.decompose()
+    # Mods that have never been updated only have a posted date
+    updated = details_column[2] if len(details_column) > 2 else details_column[1]
+    return WorkshopPage(
+        title=title,
+        updated=updated,
+        time_updated=parse_updated_date(updated, rendered),
+        file_size=parse_file_size(details_column[0]),
+        dependencies=dependencies,
+    )
+
+
+def get_peak_memory() -> str:
+    """Describe the peak memory used by this process so far, if it can be known"""
+    if resource is None:
+        return "unknown"
+    # Linux reports kilobytes
+    return f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB"
+
+
+def get_workshop_page(url: str) -> WorkshopPage:
+    """Get the parsed workshop page for the given mod URL. Each mod's page is only
+    parsed once, and only the parsed details are kept in memory. A page parsed in an
+    earlier run is revalidated, and only parsed again if it changed.
+    """
+    mod_id = get_id_from_url(url)
+    if mod_id in PAGES and url in helpers.VALIDATED:
+        return PAGES[mod_id]
+    response = helpers.get_requests_object(url)
+    page_hash = hashlib.sha256(response.content).hexdigest()
+    if PAGE_HASHES.get(mod_id) != page_hash:
+        if response.date:
+            rendered = parsedate_to_datetime(response.date)
+        else:
+            rendered = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        page = parse_workshop_page(response.text, rendered)
+        seconds = time.perf_counter() - start
+        metrics.METRICS.add(
+            "parse", mod_id, calls=1, seconds=seconds, bytes=len(response.content)
+        )
+        click.echo(
+            (
+                f"Parsed workshop page for {page.title} in "
+                f"{seconds:.3f}s (peak memory: {get_peak_memory()})"
+            )
+        )
+        PAGES[mod_id] = page
+        PAGE_HASHES[mod_id] = page_hash
+    return PAGES[mod_id]
+
+
+def get_dependencies(url: str) -> List[str]:
+    """Get steam workshop urls for all dependencies with the given mod's workshop url
+    """
+    return get_workshop_page(url).dependencies
 
 
 def get_id_from_url(url: str) -> str:
@@ -33,28 +168,83 @@ def get_url_from_id(mod_id: str) -> str:
 
 def get_mod_title(url: str) -> str:
     """Get the title for the given steamworkshop URL"""
-    soup = BeautifulSoup(helpers.get_requests_object(url).text, "html.parser")
-    return soup.find_all("div", class_="workshopItemTitle")[0].contents[0]
+    return get_workshop_page(url).title
 
 
-def collect_all_dependencies(urls: Set[str]) -> Set[str]:
-    """Return a set of all steamworkshop mods (dependencies and given urls) needed to
-    use all the mods defined by the given urls
+def get_published_file_details(mod_ids: Iterable[str]) -> Dict[str, dict]:
+    """Get the details of the given mods from the Steam web API, batching as many mods
+    into each request as allowed. Mods that the API has no details for are left out.
     """
-    url_set = set(urls)
-    traversed_mods: set = set()
-    for url in urls:
-        recurse_dependencies(url, url_set, traversed_mods)
-    return url_set
+    mod_ids = sorted(set(mod_ids))
+    details = dict()
+    for start in range(0, len(mod_ids), API_BATCH_SIZE):
+        batch = mod_ids[start : start + API_BATCH_SIZE]
+        data = {
+            f"publishedfileids[{index}]": mod_id for index, mod_id in enumerate(batch)
+        }
+        data["itemcount"] = str(len(batch))
+        response = helpers.post_for_json(STEAM_API_DETAILS_URL, data)["response"]
+        for item in response.get("publishedfiledetails", []):
+            if item.get("result") == 1:
+                details[item["publishedfileid"]] = item
+    return details
 
 
-def recurse_dependencies(first_url: str, url_set: set, traversed_mods: set) -> set:
-    """Recurse dependencies for given url and add to given set"""
-    for url in get_dependencies(first_url):
-        if url not in traversed_mods:
-            traversed_mods.add(url)
-            url_set.add(url)
-            recurse_dependencies(url, url_set, traversed_mods)
+def try_published_file_details(mod_ids: Iterable[str]) -> Dict[str, dict]:
+    """Get the details of the given mods from the Steam web API, or nothing if the API
+    can't be used right now so that the workshop pages are used instead
+    """
+    try:
+        return get_published_file_details(mod_ids)
+    except (requests.RequestException, KeyError, ValueError) as error:
+        click.echo(f"WARNING: Steam web API failed, using workshop pages: {error!r}")
+        return dict()
+
+
+def get_api_dependencies(published_file_details: dict) -> Optional[List[str]]:
+    """Get the workshop urls of the dependencies in the given published file details, or
+    None if the API did not include them
+    """
+    if "children" not in published_file_details:
+        return None
+    return [
+        get_url_from_id(child["publishedfileid"])
+        for child in published_file_details["children"]
+    ]
+
+
+def collect_all_dependencies(
+    urls: Iterable[str], max_workers: int = MAX_WORKERS, backend: str = "html"
+) -> Set[str]:
+    """Return a set of all steamworkshop mods (dependencies and given urls) needed to
+    use all the mods defined by the given urls.
+
+    The dependency graph is walked breadth first, with the pages of each level fetched
+    concurrently by up to max_workers threads. With the api backend each level is
+    looked up in a single batch instead, and only mods whose dependencies the API did
+    not give are scraped.
+    """
+    url_set = set(urls)
+    frontier = set(url_set)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier:
+            found: Set[str] = set()
+            to_scrape = set(frontier)
+            if backend == "api":
+                api_details = try_published_file_details(
+                    get_id_from_url(url) for url in frontier
+                )
+                for url in frontier:
+                    dependencies = get_api_dependencies(
+                        api_details.get(get_id_from_url(url), dict())
+                    )
+                    if dependencies is not None:
+                        found.update(dependencies)
+                        to_scrape.remove(url)
+            for dependencies in executor.map(get_dependencies, to_scrape):
+                found.update(dependencies)
+            frontier = found.difference(url_set)
+            url_set.update(frontier)
     return url_set
 
 
@@ -62,13 +252,7 @@ def get_updated_date(url: str) -> str:
     """Get the string as it appears on the steamworkshop page of when it was last
     updated
     """
-    soup = BeautifulSoup(helpers.get_requests_object(url).text, "html.parser")
-    details_column = soup.find_all("div", class_="detailsStatRight")
-    try:
-        date = details_column[2].contents[0]
-    except IndexError:
-        date = details_column[1].contents[0]
-    return date
+    return get_workshop_page(url).updated
 
 
 def get_all_mods_manifest_urls(manifest_dic: dict) -> Set[str]:
@@ -85,20 +269,153 @@ def detail_mods(mod_details: dict, mod_urls: Set[str]) -> dict:
     their URLs
     """
     for mod_url in mod_urls:
-        title = get_mod_title(mod_url)
+        page = get_workshop_page(mod_url)
         mod_details[get_id_from_url(mod_url)] = {
-            "title": title,
-            "updated": get_updated_date(mod_url),
-            "directory_name": "@" + helpers.make_filename_safe(title),
+            "title": page.title,
+            "updated": page.time_updated,
+            "file_size": page.file_size,
+            "directory_name": "@" + helpers.make_filename_safe(page.title),
         }
     return mod_details
 
 
-def get_all_manifest_mods_details(manifest_url: str) -> dict:
-    """Get the details for all mods and their dependencies in the given manifest URL"""
+def truncate_to_minute(timestamp: int) -> int:
+    """Drop the seconds from the given timestamp, which workshop pages don't show"""
+    return timestamp // 60 * 60
+
+
+def get_api_time_updated(published_file_details: dict) -> int:
+    """Get when a mod was last updated from its published file details, to the minute
+    like the workshop pages show it, so that the two backends always agree
+    """
+    return truncate_to_minute(int(published_file_details["time_updated"]))
+
+
+def get_api_mod_details(published_file_details: dict) -> dict:
+    """Get a mod's details from its published file details from the Steam web API"""
+    title = published_file_details["title"]
+    mod_details = {
+        "title": title,
+        "updated": get_api_time_updated(published_file_details),
+        "file_size": int(published_file_details["file_size"]),
+        "directory_name": "@" + helpers.make_filename_safe(title),
+    }
+    if published_file_details.get("hcontent_file"):
+        mod_details["manifest_id"] = str(published_file_details["hcontent_file"])
+    return mod_details
+
+
+def resolve_mods_details(
+    urls: Iterable[str],
+    graph: DependencyGraph,
+    max_workers: int = MAX_WORKERS,
+    backend: str = "html",
+) -> dict:
+    """Get the details for all the given mods and everything they depend on, walking
+    the dependency graph breadth first. A mod's dependencies are taken from the graph
+    while it has not been updated since they were found. Otherwise they come from the
+    Steam web API or the mod's workshop page, and the graph is updated.
+    """
+    mod_details: dict = dict()
+    seen = set(urls)
+    frontier = set(seen)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier:
+            api_details = dict()
+            if backend == "api":
+                api_details = try_published_file_details(
+                    get_id_from_url(url) for url in frontier
+                )
+                for mod_id, details in api_details.items():
+                    mod_details[mod_id] = get_api_mod_details(details)
+            to_detail = [
+                url for url in frontier if get_id_from_url(url) not in api_details
+            ]
+            list(executor.map(get_workshop_page, to_detail))
+            detail_mods(mod_details, set(to_detail))
+            found: Set[str] = set()
+            to_scrape = []
+            for url in frontier:
+                mod_id = get_id_from_url(url)
+                updated = mod_details[mod_id]["updated"]
+                dependencies = get_api_dependencies(api_details.get(mod_id, dict()))
+                if graph.is_current(mod_id, updated):
+                    dependencies = [
+                        get_url_from_id(dependency)
+                        for dependency in graph.get_dependencies(mod_id)
+                    ]
+                elif dependencies is None:
+                    to_scrape.append(url)
+                    continue
+                else:
+                    graph.set_dependencies(
+                        mod_id, updated, [get_id_from_url(url) for url in dependencies]
+                    )
+                found.update(dependencies)
+            for url, dependencies in zip(
+                to_scrape, executor.map(get_dependencies, to_scrape)
+            ):
+                mod_id = get_id_from_url(url)
+                graph.set_dependencies(
+                    mod_id,
+                    mod_details[mod_id]["updated"],
+                    [get_id_from_url(dependency) for dependency in dependencies],
+                )
+                found.update(dependencies)
+            frontier = found.difference(seen)
+            seen.update(frontier)
+    return mod_details
+
+
+def get_updated_timestamps(
+    mod_ids: Iterable[str], max_workers: int = MAX_WORKERS, backend: str = "html"
+) -> Dict[str, int]:
+    """Get when each of the given mods was last updated, without looking at their
+    dependencies
+    """
+    mod_ids = set(mod_ids)
+    updated = dict()
+    if backend == "api":
+        for mod_id, details in try_published_file_details(mod_ids).items():
+            updated[mod_id] = get_api_time_updated(details)
+    to_scrape = [get_url_from_id(mod_id) for mod_id in mod_ids if mod_id not in updated]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for url, page in zip(to_scrape, executor.map(get_workshop_page, to_scrape)):
+            updated[get_id_from_url(url)] = page.time_updated
+    return updated
+
+
+def get_all_manifest_mods_details(
+    manifest_url: str,
+    max_workers: int = MAX_WORKERS,
+    backend: str = "html",
+    graph: Optional[DependencyGraph] = None,
+) -> dict:
+    """Get the details for all mods and their dependencies in the given manifest URL,
+    either by scraping their workshop pages (html) or from the Steam web API (api). The
+    dependencies are recorded in the given graph, which is pruned down to the manifest.
+    """
+    return get_all_manifests_mods_details([manifest_url], max_workers, backend, graph)
+
+
+def get_all_manifests_mods_details(
+    manifest_urls: Iterable[str],
+    max_workers: int = MAX_WORKERS,
+    backend: str = "html",
+    graph: Optional[DependencyGraph] = None,
+) -> dict:
+    """Get the details for all mods and their dependencies in any of the given
+    manifests, resolving the mods they share only once. The graph is pruned down to
+    the manifests.
+    """
+    if graph is None:
+        graph = DependencyGraph()
     click.echo("Collecting urls for all mods in mods manifest...")
-    mods_manifest = helpers.get_mods_manifest(manifest_url)
-    manifest_mods_urls = get_all_mods_manifest_urls(mods_manifest)
+    manifest_mods_urls: Set[str] = set()
+    for manifest_url in manifest_urls:
+        mods_manifest = helpers.get_mods_manifest(manifest_url)
+        manifest_mods_urls.update(get_all_mods_manifest_urls(mods_manifest))
     click.echo("Making sure all dependencies are accounted for...")
-    all_mod_urls = collect_all_dependencies(manifest_mods_urls)
-    return detail_mods(dict(), all_mod_urls)
+    mods_details = resolve_mods_details(manifest_mods_urls, graph, max_workers, backend)
+    graph.prune(get_id_from_url(url) for url in manifest_mods_urls)
+    return mods_details
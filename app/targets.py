@@ -0,0 +1,278 @@
+"""Where mods and keys are published to: a directory, or a container in blob storage"""
+import base64
+import os
+import shutil
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import quote, urlencode, urlparse
+import click
+import requests
+from app import client, files, helpers, metrics
+
+
+# Files up to this size are uploaded in one request, larger ones in blocks of it
+CHUNK_SIZE = 8 * 1024 ** 2
+BLOB_API_VERSION = "2020-10-02"
+HASH_METADATA = "sha256"
+
+
+class LocalTarget:
+    """Publishes into a directory on a local or mounted file system"""
+
+    def __init__(self, path: Path, workers: int = files.TRANSFER_WORKERS) -> None:
+        self.path = Path(path)
+        self.workers = workers
+
+    def put_mod(
+        self,
+        mod_id: str,
+        mod_path: Path,
+        sync_mode: str,
+        hashes: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, files.FileRecord]:
+        """Move the prepared mod into the directory, copying its files in parallel if it
+        is on another file system, or sync only what changed into the existing copy of
+        it. Return the index of the published files, which is empty unless their hashes
+        are given.
+        """
+        destination = self.path / mod_path.name
+        if sync_mode == "replace":
+            click.echo(f"Moving the mod: {mod_path.name} to destination...")
+            with metrics.METRICS.time("publish", mod_id):
+                transfer = files.transfer_mod_dir(mod_path, destination, self.workers)
+            metrics.METRICS.add(
+                "publish", mod_id, files=transfer.files, bytes=transfer.bytes
+            )
+            if not transfer.renamed:
+                click.echo(
+                    (
+                        f"Copied {mod_path.name}: {transfer.bytes / 1024 ** 2:.1f} MB "
+                        f"in {transfer.seconds:.1f}s "
+                        f"({transfer.bytes / 1024 ** 2 / max(transfer.seconds, 1e-6):.1f}"
+                        " MB/s)"
+                    )
+                )
+        else:
+            click.echo(f"Syncing the mod: {mod_path.name} to destination...")
+            with metrics.METRICS.time("publish", mod_id):
+                stats = files.sync_mod_dir(
+                    mod_path, destination, use_hash=sync_mode == "hash"
+                )
+            metrics.METRICS.add(
+                "publish",
+                mod_id,
+                files=stats.copied_files,
+                bytes=stats.copied_bytes,
+                skipped_files=stats.skipped_files,
+                skipped_bytes=stats.skipped_bytes,
+                deleted_files=stats.deleted_files,
+            )
+            shutil.rmtree(str(mod_path))
+            click.echo(
+                (
+                    f"Synced {mod_path.name}: copied {stats.copied_files} files "
+                    f"({stats.copied_bytes} bytes), kept {stats.skipped_files} files "
+                    f"({stats.skipped_bytes} bytes not copied), deleted "
+                    f"{stats.deleted_files} files"
+                )
+            )
+        return files.index_mod_dir(destination, hashes or dict())
+
+    def put_file(self, source: Path, name: str) -> None:
+        """Copy the given file into the directory under the given name, replacing any
+        file already there
+        """
+        destination = self.path / name
+        if destination == source:
+            return
+        if destination.is_file():
+            os.remove(destination)
+        shutil.copy2(source, destination)
+
+
+class BlobTarget:
+    """Publishes into a container in Azure blob storage, or an emulator of it such as
+    Azurite, given by the container's URL with a SAS token that allows listing, writing
+    and deleting. Each file is uploaded in blocks by several threads at once, and files
+    whose size and hash are the same as the blob's are skipped. Requests time out, and
+    those the service throttles or fails are retried. Unlike a directory, a mod
+    is not swapped in all at once, so it is mixed while it is being uploaded.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        workers: int = files.TRANSFER_WORKERS,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> None:
+        parsed = urlparse(url)
+        self.container_url = f"{parsed.scheme}://{parsed.netloc}{parsed.path.rstrip('/')}"
+        self.token = parsed.query
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.block_executor = ThreadPoolExecutor(max_workers=workers)
+        helpers.resize_pool(max(workers * 2, helpers.POOL_SIZE))
+        # Not limited to Steam's rate, but only as many requests at once as there are
+        # threads uploading files and blocks
+        self.client = client.Client(helpers.SESSION, rate=0, max_concurrency=workers * 2)
+
+    def get_url(self, name: Optional[str] = None, **parameters: str) -> str:
+        """Get the URL of the container, or of the named blob in it, with the token"""
+        url = self.container_url
+        if name is not None:
+            url += "/" + quote(name)
+        query = "&".join(query for query in (self.token, urlencode(parameters)) if query)
+        return f"{url}?{query}"
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Make a request to the blob service, retrying it if it may pass, and raise
+        requests.HTTPError if it fails
+        """
+        headers = {"x-ms-version": BLOB_API_VERSION, **kwargs.pop("headers", dict())}
+        return self.client.request(
+            method, url, phase="publish", headers=headers, **kwargs
+        )
+
+    def list_blobs(self, prefix: str) -> Dict[str, Tuple[int, Optional[str]]]:
+        """Get the size and recorded hash of each blob whose name starts with the
+        prefix
+        """
+        blobs = dict()
+        marker = ""
+        while True:
+            parameters = {
+                "restype": "container",
+                "comp": "list",
+                "prefix": prefix,
+                "include": "metadata",
+            }
+            if marker:
+                parameters["marker"] = marker
+            response = self.request("GET", self.get_url(**parameters))
+            root = ElementTree.fromstring(response.content)
+            for blob in root.iter("Blob"):
+                blobs[blob.findtext("Name", "")] = (
+                    int(blob.findtext("Properties/Content-Length", "0")),
+                    blob.findtext(f"Metadata/{HASH_METADATA}"),
+                )
+            marker = root.findtext("NextMarker", "")
+            if not marker:
+                return blobs
+
+    def put_block(self, source: Path, name: str, block_id: str, offset: int) -> int:
+        """Upload the chunk of the file at the offset as a block of the blob"""
+        with open(source, "rb") as open_file:
+            open_file.seek(offset)
+            data = open_file.read(self.chunk_size)
+        self.request(
+            "PUT", self.get_url(name, comp="block", blockid=block_id), data=data
+        )
+        return len(data)
+
+    def upload_file(self, source: Path, name: str, file_hash: str) -> int:
+        """Upload the file as the named blob, recording its hash, in blocks uploaded at
+        the same time if it is large. Return the number of bytes uploaded.
+        """
+        size = source.stat().st_size
+        metadata = {f"x-ms-meta-{HASH_METADATA}": file_hash}
+        if size <= self.chunk_size:
+            self.request(
+                "PUT",
+                self.get_url(name),
+                data=source.read_bytes(),
+                headers={"x-ms-blob-type": "BlockBlob", **metadata},
+            )
+            return size
+        block_ids = [
+            base64.b64encode(f"{index:08d}".encode()).decode()
+            for index in range(-(-size // self.chunk_size))
+        ]
+        futures = [
+            self.block_executor.submit(
+                self.put_block, source, name, block_id, index * self.chunk_size
+            )
+            for index, block_id in enumerate(block_ids)
+        ]
+        uploaded = sum(future.result() for future in futures)
+        block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+        self.request(
+            "PUT",
+            self.get_url(name, comp="blocklist"),
+            data=f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}'
+            "</BlockList>",
+            headers=metadata,
+        )
+        return uploaded
+
+    def put_mod(
+        self,
+        mod_id: str,
+        mod_path: Path,
+        sync_mode: str,
+        hashes: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, files.FileRecord]:
+        """Upload the prepared mod's files that aren't already in the container, whatever
+        the sync mode, and delete the blobs of files it no longer has. The files are
+        hashed to compare with the blobs unless their hashes are given. Return the index
+        of the uploaded files.
+        """
+        click.echo(f"Uploading the mod: {mod_path.name} to destination...")
+        if hashes is None:
+            with metrics.METRICS.time("index", mod_id):
+                hashes = files.hash_mod_dir(mod_path)
+        index = files.index_mod_dir(mod_path, hashes)
+        with metrics.METRICS.time("publish", mod_id):
+            blobs = self.list_blobs(f"{mod_path.name}/")
+            changed: List[str] = [
+                relative_path
+                for relative_path, record in index.items()
+                if blobs.get(f"{mod_path.name}/{relative_path}")
+                != (record.size, record.hash)
+            ]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                uploaded = sum(
+                    executor.map(
+                        lambda path: self.upload_file(
+                            mod_path / path, f"{mod_path.name}/{path}", index[path].hash
+                        ),
+                        changed,
+                    )
+                )
+            stale = set(blobs) - {f"{mod_path.name}/{path}" for path in index}
+            for name in sorted(stale):
+                self.request("DELETE", self.get_url(name))
+        skipped = len(index) - len(changed)
+        metrics.METRICS.add(
+            "publish",
+            mod_id,
+            files=len(changed),
+            bytes=uploaded,
+            skipped_files=skipped,
+            deleted_files=len(stale),
+        )
+        click.echo(
+            (
+                f"Uploaded {mod_path.name}: {len(changed)} files ({uploaded} bytes), "
+                f"kept {skipped} files, deleted {len(stale)} files"
+            )
+        )
+        shutil.rmtree(str(mod_path))
+        return index
+
+    def put_file(self, source: Path, name: str) -> None:
+        """Upload the given file as the named blob, unless it is already there"""
+        file_hash = files.hash_file(source)
+        if self.list_blobs(name).get(name) != (source.stat().st_size, file_hash):
+            self.upload_file(source, name, file_hash)
+
+
+Target = Union[LocalTarget, BlobTarget]
+
+
+def get_target(location: str, workers: int = files.TRANSFER_WORKERS) -> Target:
+    """Get the target for the given directory, or blob container URL"""
+    if urlparse(location).scheme in ("http", "https"):
+        return BlobTarget(location, workers)
+    return LocalTarget(Path(location), workers)
@@ -0,0 +1,97 @@
+"""Check the published mods against the index of their files recorded when they were
+published, to find mods that were left incomplete or changed since
+"""
+import sys
+from pathlib import Path
+from typing import Dict, List
+import click
+from app import files, metrics
+from app.state import STATE_FILENAME, StateStore
+
+
+EXIT_VERIFIED = 0
+EXIT_CORRUPT = 1
+
+
+def verify_mods(mods_path: Path, state: StateStore) -> Dict[str, List[str]]:
+    """Check each recorded mod's directory against the index of its files. Mods that
+    were published before their files were indexed are indexed as they are now. Return
+    what is wrong with each mod that has any problems.
+    """
+    corrupt = dict()
+    for mod_id, details in sorted(state.get_mods_details().items()):
+        mod_dir = mods_path / details["directory_name"]
+        index = state.get_file_index(mod_id)
+        if not index and mod_dir.is_dir():
+            click.echo(f"Indexing {mod_dir.name}, which has no index to check against...")
+            with metrics.METRICS.time("index", mod_id):
+                hashes = files.hash_mod_dir(mod_dir)
+            state.set_file_index(mod_id, files.index_mod_dir(mod_dir, hashes))
+            continue
+        with metrics.METRICS.time("verify", mod_id):
+            verification = files.verify_mod_dir(mod_dir, index)
+        metrics.METRICS.add(
+            "verify",
+            mod_id,
+            files=len(index),
+            hashed_files=verification.hashed_files,
+            hashed_bytes=verification.hashed_bytes,
+        )
+        if verification.file_index != index:
+            state.set_file_index(mod_id, verification.file_index)
+        if verification.problems:
+            corrupt[mod_id] = verification.problems
+            for problem in verification.problems:
+                click.echo(f"WARNING: {mod_dir.name}: {problem}!")
+    return corrupt
+
+
+def forget_corrupt_mods(state: StateStore, corrupt: Dict[str, List[str]]) -> None:
+    """Forget the given corrupt mods so that the next update downloads them again"""
+    state.forget_mods(corrupt)
+    state.export_mods_details()
+
+
+@click.command()
+@click.option("--mods_path", prompt="Path to directory the mods are in")
+@click.option("--download_path", prompt="Path to steam directory mods are downloaded to")
+@click.option(
+    "--state_path",
+    default=None,
+    help=(
+        f"SQLite database the mods are recorded in. Defaults to {STATE_FILENAME} in "
+        "the download path"
+    ),
+)
+@click.option(
+    "--repair",
+    is_flag=True,
+    help=(
+        "Forget the mods that are corrupt, so that the next update downloads just "
+        "those again. update_mods --verify does both in one run"
+    ),
+)
+def verify(mods_path, download_path, state_path, repair):
+    """Checks the published mods for missing, truncated or changed files, only hashing
+    files whose size or modification time changed since they were last checked. Exits
+    with 0 if all mods are intact and 1 otherwise.
+    """
+    state = StateStore(
+        Path(mods_path), Path(state_path or Path(download_path, STATE_FILENAME))
+    )
+    try:
+        corrupt = verify_mods(Path(mods_path), state)
+        if corrupt and repair:
+            click.echo(f"Forgetting corrupt mods to download again: {sorted(corrupt)}")
+            forget_corrupt_mods(state, corrupt)
+    finally:
+        state.close()
+    if corrupt:
+        click.echo(f"ERROR: {len(corrupt)} mods are corrupt: {sorted(corrupt)}")
+        sys.exit(EXIT_CORRUPT)
+    click.echo("All mods are intact")
+    sys.exit(EXIT_VERIFIED)
+
+
+if __name__ == "__main__":
+    verify()  # pylint: disable=E1120
@@ -0,0 +1 @@
+"""Offline benchmarks for scraping, dependency resolution and the filesystem stages"""
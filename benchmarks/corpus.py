@@ -0,0 +1,212 @@
+"""A synthetic steam workshop, served by a local HTTP server"""
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, NamedTuple
+from urllib.parse import parse_qs, urlparse
+
+
+WORKSHOP_PATH = "/workshop/filedetails/"
+API_PATH = "/ISteamRemoteStorage/GetPublishedFileDetails/v1/"
+MANIFEST_PATH = "/mods_manifest.json"
+FIRST_MOD_ID = 1000000000
+# Pads each page to roughly the size of a real workshop page
+FILLER = '<div class="commentthread_comment">Some comment about the mod</div>\n' * 600
+
+
+class SyntheticMod(NamedTuple):
+    """A mod in the synthetic workshop"""
+
+    mod_id: str
+    title: str
+    time_updated: int
+    file_size: int
+    dependencies: List[str]
+
+
+def build_corpus(
+    mods: int, depth: int, fan_out: int, seed: int = 0
+) -> List[SyntheticMod]:
+    """Make a workshop of the given number of mods in the given number of layers. Each
+    mod depends on fan_out random mods in the layer below it, and every mod but those
+    in the top layer is depended on by at least one mod. The same arguments always make
+    the same workshop.
+    """
+    randomiser = random.Random(seed)
+    layers: List[List[str]] = [[] for _ in range(depth)]
+    for index in range(mods):
+        layers[index * depth // mods].append(str(FIRST_MOD_ID + index))
+    dependencies: Dict[str, set] = {
+        mod_id: set() for layer in layers for mod_id in layer
+    }
+    for layer, below in zip(layers, layers[1:]):
+        for index, mod_id in enumerate(below):
+            dependencies[layer[index % len(layer)]].add(mod_id)
+        for mod_id in layer:
+            dependencies[mod_id].update(
+                randomiser.sample(below, min(fan_out, len(below)))
+            )
+    return [
+        SyntheticMod(
+            mod_id=mod_id,
+            title=f"Synthetic Mod #{mod_id} ({randomiser.choice('ABCDEF')})",
+            time_updated=1500000000 + randomiser.randrange(10 ** 8) // 60 * 60,
+            file_size=randomiser.randrange(1024 ** 2, 1024 ** 3),
+            dependencies=sorted(dependencies[mod_id]),
+        )
+        for mod_id in dependencies
+    ]
+
+
+def get_manifest(corpus: List[SyntheticMod], modlines: int = 4) -> dict:
+    """Make a manifest of the top layer of mods, shared out between mod lines"""
+    depended_on = {mod_id for mod in corpus for mod_id in mod.dependencies}
+    roots = [mod.mod_id for mod in corpus if mod.mod_id not in depended_on]
+    return {
+        f"Line {line}": {f"Mod {mod_id}": mod_id for mod_id in roots[line::modlines]}
+        for line in range(modlines)
+    }
+
+
+def render_workshop_page(mod: SyntheticMod, base_url: str) -> str:
+    """Render the parts of a workshop page that are scraped, amongst filler"""
+    updated = datetime.fromtimestamp(mod.time_updated, timezone.utc)
+    links = "\n".join(
+        f'<a href="{base_url}{WORKSHOP_PATH}?id={mod_id}"><div>Mod {mod_id}</div></a>'
+        for mod_id in mod.dependencies
+    )
+    return f"""<html><head><title>Steam Workshop::{mod.title}</title></head><body>
+<div class="workshopItemTitle">{mod.title}</div>
+<div class="detailsStatsContainerRight">
+<div class="detailsStatRight">{mod.file_size / 1024 ** 2:,.3f} MB</div>
+<div class="detailsStatRight">1 Jan, 2017 @ 12:00am</div>
+<div class="detailsStatRight">{updated.strftime("%d %b, %Y @ %I:%M%p").lower()}</div>
+</div>
+<div class="requiredItemsContainer" id="RequiredItems">{links}</div>
+{FILLER}</body></html>"""
+
+
+def get_published_file(mod: SyntheticMod) -> dict:
+    """Get the published file details the Steam web API would give for the mod"""
+    return {
+        "publishedfileid": mod.mod_id,
+        "result": 1,
+        "title": mod.title,
+        "time_updated": mod.time_updated,
+        "file_size": str(mod.file_size),
+        "hcontent_file": hashlib.sha1(mod.mod_id.encode()).hexdigest()[:19],
+        "children": [
+            {"publishedfileid": mod_id, "sortorder": 0, "file_type": 0}
+            for mod_id in mod.dependencies
+        ],
+    }
+
+
+class WorkshopHandler(BaseHTTPRequestHandler):
+    """Serves the synthetic workshop pages, the manifest and the web API, answering
+    conditional requests with 304s
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """Keep quiet"""
+
+    def send_body(self, body: bytes, content_type: str) -> None:
+        """Send the body unless the client already has it"""
+        time.sleep(self.server.latency)  # type: ignore
+        with self.server.lock:  # type: ignore
+            self.server.requests += 1  # type: ignore
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Serve a workshop page or the manifest"""
+        url = urlparse(self.path)
+        if url.path == MANIFEST_PATH:
+            self.send_body(json.dumps(self.server.manifest).encode(), "application/json")
+            return
+        mod_id = parse_qs(url.query).get("id", [""])[0]
+        if url.path != WORKSHOP_PATH or mod_id not in self.server.mods:
+            self.send_error(404)
+            return
+        page = render_workshop_page(self.server.mods[mod_id], self.server.base_url)
+        self.send_body(page.encode(), "text/html; charset=utf-8")
+
+    def do_POST(self):
+        """Answer a GetPublishedFileDetails request"""
+        length = int(self.headers["Content-Length"])
+        form = parse_qs(self.rfile.read(length).decode())
+        count = int(form["itemcount"][0])
+        details = []
+        for index in range(count):
+            mod_id = form[f"publishedfileids[{index}]"][0]
+            if mod_id in self.server.mods:
+                details.append(get_published_file(self.server.mods[mod_id]))
+            else:
+                details.append({"publishedfileid": mod_id, "result": 9})
+        response = {"response": {"resultcount": count, "publishedfiledetails": details}}
+        self.send_body(json.dumps(response).encode(), "application/json")
+
+
+class WorkshopServer:
+    """Serves the given synthetic workshop on a local port in a background thread,
+    waiting the given number of seconds before answering each request
+    """
+
+    def __init__(self, corpus: List[SyntheticMod], manifest: dict, latency: float = 0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), WorkshopHandler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.server.mods = {mod.mod_id: mod for mod in corpus}  # type: ignore
+        self.server.manifest = manifest  # type: ignore
+        self.server.base_url = self.base_url  # type: ignore
+        self.server.latency = latency  # type: ignore
+        self.server.requests = 0  # type: ignore
+        self.server.lock = threading.Lock()  # type: ignore
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+        )
+
+    @property
+    def workshop_url(self) -> str:
+        """The URL to use in place of the steam workshop's"""
+        return self.base_url + WORKSHOP_PATH
+
+    @property
+    def api_url(self) -> str:
+        """The URL to use in place of the Steam web API's"""
+        return self.base_url + API_PATH
+
+    @property
+    def manifest_url(self) -> str:
+        """The URL the manifest is served at"""
+        return self.base_url + MANIFEST_PATH
+
+    @property
+    def requests(self) -> int:
+        """The number of requests answered so far"""
+        return self.server.requests  # type: ignore
+
+    def __enter__(self) -> "WorkshopServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
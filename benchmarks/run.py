@@ -0,0 +1,263 @@
+"""Run the offline benchmarks and compare them with an earlier run
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json
+"""
+import contextlib
+import io
+import json
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import click
+from app import download, files, helpers, metrics, steam_site
+from benchmarks.corpus import WorkshopServer, build_corpus, get_manifest
+from benchmarks.trees import make_mod_tree, make_templates, write_fake_steamcmd
+
+
+def reset_steam_site(cache_path: Optional[Path] = None) -> None:
+    """Forget every parsed page and that any cached response was revalidated, and empty
+    the given cache directory
+    """
+    steam_site.PAGES.clear()
+    steam_site.PAGE_HASHES.clear()
+    helpers.VALIDATED.clear()
+    helpers.SESSION.close()
+    if cache_path is not None:
+        shutil.rmtree(cache_path, ignore_errors=True)
+        cache_path.mkdir(parents=True)
+
+
+def reset_directory(directory: Path) -> Path:
+    """Empty the given directory"""
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+    return directory
+
+
+def measure(setup: Callable[[], None], action: Callable[[], None], repeat: int) -> dict:
+    """Time the action the given number of times, each after an untimed setup. Return
+    the wall times along with what was counted during the last run.
+    """
+    seconds = []
+    for _ in range(repeat):
+        setup()
+        metrics.METRICS.reset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            action()
+            seconds.append(time.perf_counter() - start)
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "metrics": metrics.METRICS.to_dict()["phases"],
+    }
+
+
+def run_update_mods(arguments: List[str]) -> None:
+    """Run the update_mods command and make sure it succeeded"""
+    try:
+        download.update_mods.main(arguments, standalone_mode=False)
+    except SystemExit as error:
+        if error.code != download.EXIT_UP_TO_DATE:
+            raise RuntimeError(f"update_mods exited with {error.code}") from error
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """Show how the median times compare with those of the baseline run"""
+    click.echo(f"{'benchmark':<40} {'median':>10} {'baseline':>10} {'ratio':>7}")
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            click.echo(f"{name:<40} {result['median']:>10.3f}")
+            continue
+        ratio = result["median"] / before["median"]
+        click.echo(
+            f"{name:<40} {result['median']:>10.3f} {before['median']:>10.3f} "
+            f"{ratio:>7.2f}"
+        )
+    if results["parameters"] != baseline["parameters"]:
+        click.echo("WARNING: The baseline was run with different parameters!")
+
+
+@click.command()
+@click.option("--mods", default=200, show_default=True, help="Mods in the workshop")
+@click.option("--depth", default=6, show_default=True, help="Layers of dependencies")
+@click.option(
+    "--fan_out", default=3, show_default=True, help="Dependencies of each mod"
+)
+@click.option(
+    "--tree_files",
+    default=10000,
+    show_default=True,
+    help="Files in the mod tree that is renamed and searched for keys",
+)
+@click.option(
+    "--flow_files",
+    default=100,
+    show_default=True,
+    help="Files in each mod downloaded by the fake steamcmd",
+)
+@click.option(
+    "--latency",
+    default=0.005,
+    show_default=True,
+    help="Seconds the local server waits before answering each request",
+)
+@click.option(
+    "--max_workers",
+    type=click.IntRange(min=1),
+    default=steam_site.MAX_WORKERS,
+    show_default=True,
+)
+@click.option(
+    "--rename_workers", type=click.IntRange(min=1), default=4, show_default=True
+)
+@click.option("--repeat", default=3, show_default=True, help="Runs of each benchmark")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--only", multiple=True, help="Only run benchmarks with these names")
+@click.option("--output", default=None, help="File to save the results to")
+@click.option("--baseline", default=None, help="Results of an earlier run to compare")
+def run_benchmarks(
+    mods,
+    depth,
+    fan_out,
+    tree_files,
+    flow_files,
+    latency,
+    max_workers,
+    rename_workers,
+    repeat,
+    seed,
+    only,
+    output,
+    baseline,
+):
+    """Benchmark scraping, dependency resolution, the filesystem stages and the whole
+    update against a synthetic workshop served locally and a fake steamcmd
+    """
+    parameters = {
+        "mods": mods,
+        "depth": depth,
+        "fan_out": fan_out,
+        "tree_files": tree_files,
+        "flow_files": flow_files,
+        "latency": latency,
+        "max_workers": max_workers,
+        "rename_workers": rename_workers,
+        "seed": seed,
+    }
+    corpus = build_corpus(mods, depth, fan_out, seed)
+    manifest = get_manifest(corpus)
+    results: Dict[str, dict] = dict()
+    with tempfile.TemporaryDirectory() as temp_dir, WorkshopServer(
+        corpus, manifest, latency
+    ) as server:
+        work = Path(temp_dir)
+        cache = work / "cache"
+        helpers.CACHE_PATH = cache
+        steam_site.STEAM_WORKHOP_PAGE_URL = server.workshop_url
+        steam_site.STEAM_API_DETAILS_URL = server.api_url
+        helpers.resize_pool(max(max_workers, helpers.POOL_SIZE))
+        # Measure the work done rather than how fast Steam would let it be done
+        helpers.CLIENT.configure(0, max_workers)
+        roots = steam_site.get_all_mods_manifest_urls(manifest)
+        all_urls = {steam_site.get_url_from_id(mod.mod_id) for mod in corpus}
+        click.echo(f"Making a mod tree of {tree_files} files...")
+        template = work / "template"
+        make_mod_tree(template, tree_files, seed)
+        tree = work / "tree"
+        keys = work / "keys"
+        make_templates(work / "templates", [mod.mod_id for mod in corpus], flow_files)
+        steamcmd_path = write_fake_steamcmd(work / "steamcmd", work / "templates")
+
+        def copy_tree() -> None:
+            shutil.rmtree(tree, ignore_errors=True)
+            shutil.copytree(template, tree)
+            reset_directory(keys)
+
+        def revalidate() -> None:
+            reset_steam_site()
+            with contextlib.redirect_stdout(io.StringIO()):
+                steam_site.collect_all_dependencies(roots, max_workers)
+            reset_steam_site()
+
+        def reset_update() -> None:
+            reset_steam_site(cache)
+            for name in ("downloads", "mods", "mod_keys"):
+                reset_directory(work / name)
+
+        benchmarks = {
+            "collect_all_dependencies": (
+                lambda: reset_steam_site(cache),
+                lambda: steam_site.collect_all_dependencies(roots, max_workers),
+            ),
+            "collect_all_dependencies_revalidated": (
+                revalidate,
+                lambda: steam_site.collect_all_dependencies(roots, max_workers),
+            ),
+            "collect_all_dependencies_api": (
+                lambda: reset_steam_site(cache),
+                lambda: steam_site.collect_all_dependencies(
+                    roots, max_workers, backend="api"
+                ),
+            ),
+            "detail_mods": (
+                lambda: reset_steam_site(cache),
+                lambda: steam_site.detail_mods(dict(), all_urls),
+            ),
+            "make_files_and_dirs_safe": (
+                copy_tree,
+                lambda: files.make_files_and_dirs_safe(tree),
+            ),
+            "make_files_and_dirs_safe_parallel": (
+                copy_tree,
+                lambda: files.make_files_and_dirs_safe(tree, rename_workers),
+            ),
+            "copy_keys": (copy_tree, lambda: files.copy_keys(tree, keys)),
+            "update_mods": (
+                reset_update,
+                lambda: run_update_mods(
+                    [
+                        *("--steamcmd_path", str(steamcmd_path)),
+                        *("--manifest_url", server.manifest_url),
+                        *("--download_path", str(work / "downloads")),
+                        *("--mods_path", str(work / "mods")),
+                        *("--keys_path", str(work / "mod_keys")),
+                        *("--username", "someone", "--password", "secret"),
+                        *("--cache_path", str(cache)),
+                        *("--max_workers", str(max_workers)),
+                        *("--rate_limit", "0"),
+                        *("--rename_workers", str(rename_workers)),
+                    ]
+                ),
+            ),
+        }
+        for name, (setup, action) in benchmarks.items():
+            if only and name not in only:
+                continue
+            click.echo(f"Running {name}...")
+            results[name] = measure(setup, action, repeat)
+            click.echo(
+                f"{name}: median {results[name]['median']:.3f}s, "
+                f"min {results[name]['min']:.3f}s"
+            )
+    report = {
+        "parameters": parameters,
+        "python": platform.python_version(),
+        "parser": steam_site.PARSER,
+        "results": results,
+    }
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2))
+    if baseline:
+        compare(report, json.loads(Path(baseline).read_text()))
+
+
+if __name__ == "__main__":
+    run_benchmarks()  # pylint: disable=E1120
@@ -0,0 +1,88 @@
+"""Synthetic mod directories with messy names, and a fake steamcmd that downloads them"""
+import os
+import random
+import sys
+from pathlib import Path
+from typing import List
+
+
+# Names like the ones found in real mods, which all need renaming
+NAME_PARTS = ("Addons", "Data F", "UI Textures", "Sounds #2", "Config (Old)", "READ ME")
+EXTENSIONS = (".pbo", ".bisign", ".paa", ".P3D", ".hpp", ".TXT")
+FILES_PER_DIRECTORY = 50
+KEY_FILES = 3
+
+FAKE_STEAMCMD = """#!{python}
+\"\"\"Pretends to be steamcmd running a runscript of workshop_download_item commands,
+copying each mod from the templates\"\"\"
+import shutil
+import sys
+from pathlib import Path
+
+templates = Path({templates!r})
+script = Path(sys.argv[sys.argv.index("+runscript") + 1]).read_text().splitlines()
+install_dir = Path(
+    next(line for line in script if line.startswith("force_install_dir")).split('"')[1]
+)
+for line in script:
+    if not line.startswith("workshop_download_item"):
+        continue
+    mod_id = line.split()[2]
+    content = install_dir / "steamapps" / "workshop" / "content" / "107410" / mod_id
+    if content.exists():
+        shutil.rmtree(content)
+    shutil.copytree(templates / mod_id, content)
+    print(f'Success. Downloaded item {{mod_id}} to "{{content}}" (0 bytes)')
+"""
+
+
+def make_mod_tree(directory: Path, files: int, seed: int = 0, file_size: int = 0) -> int:
+    """Make a mod in the given directory with the given number of files of the given
+    size, spread over nested directories with names that need making safe, including
+    some that clash once made safe and a directory of keys. The same arguments always
+    make the same tree. Return the number of directories made.
+    """
+    randomiser = random.Random(seed)
+    contents = b"\0" * file_size
+    key_dir = directory / "Keys"
+    key_dir.mkdir(parents=True)
+    for index in range(KEY_FILES):
+        (key_dir / f"Server Key {index}.BiKEY").write_bytes(contents)
+    directories = [directory]
+    made = 1
+    for index in range(files - KEY_FILES):
+        if index % FILES_PER_DIRECTORY == 0:
+            parent = randomiser.choice(directories)
+            name = f"{randomiser.choice(NAME_PARTS)} {made}"
+            if randomiser.random() < 0.05:
+                name = name.upper()
+            (parent / name).mkdir(exist_ok=True)
+            directories.append(parent / name)
+            made += 1
+        name = f"{randomiser.choice(NAME_PARTS)} File-$ {index}"
+        extension = randomiser.choice(EXTENSIONS)
+        (directories[-1] / (name + extension)).write_bytes(contents)
+        if randomiser.random() < 0.01:
+            (directories[-1] / (name.lower() + extension.lower())).write_bytes(contents)
+    return made
+
+
+def write_fake_steamcmd(directory: Path, templates: Path) -> Path:
+    """Write a fake steamcmd executable to the given directory that downloads mods by
+    copying them from the given directory of mod templates, named by mod ID
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / "steamcmd.py"
+    path.write_text(FAKE_STEAMCMD.format(python=sys.executable, templates=str(templates)))
+    os.chmod(path, 0o755)
+    return path
+
+
+def make_templates(
+    directory: Path, mod_ids: List[str], files: int, file_size: int = 0, seed: int = 0
+) -> None:
+    """Make a template mod with the given number of files for each of the given mod IDs
+    for the fake steamcmd to download
+    """
+    for index, mod_id in enumerate(mod_ids):
+        make_mod_tree(directory / mod_id, files, seed + index, file_size)
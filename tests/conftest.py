@@ -1,27 +1,81 @@
-import pytest
+import json
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+import pytest
 
 
 MODS_DETAILS = {
     "450814997": {
         "title": "CBA_A3",
-        "updated": "10 Jan @ 7:24am",
+        "updated": 1547105040,
+        "file_size": 2089811,
         "directory_name": "@cba_a3",
     },
     "333310405": {
         "title": "Enhanced Movement",
-        "updated": "10 May, 2018 @ 11:01am",
+        "updated": 1525950060,
+        "file_size": 628097,
         "directory_name": "@enhanced_movement",
     },
     "871504836": {
         "title": "cTab",
-        "updated": "24 Feb, 2017 @ 5:12pm",
+        "updated": 1487956320,
+        "file_size": 14204010,
         "directory_name": "@ctab",
     },
 }
 MOD_ID_KEY_PAIRS = {"450814997": "Key", "333310405": "Keys", "871504836": "Serverkey"}
 
 
+@pytest.fixture(autouse=True, scope="session")
+def request_cache(tmp_path_factory):
+    """Keep cached web requests out of the user's cache for the whole test session"""
+    from app import helpers
+
+    helpers.CACHE_PATH = tmp_path_factory.mktemp("cache")
+    helpers.VALIDATED.clear()
+    yield helpers.CACHE_PATH
+
+
+@pytest.fixture(autouse=True, scope="session")
+def serial_connection_creation():
+    """vcrpy briefly unpatches the connection classes while it creates a connection, so
+    another thread creating one at the same time can end up with a real connection.
+    Only let one thread create a connection at a time.
+    """
+    import threading
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    lock = threading.RLock()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for pool_class in (HTTPConnectionPool, HTTPSConnectionPool):
+
+            def new_conn(self, new_conn=pool_class._new_conn):
+                with lock:
+                    return new_conn(self)
+
+            monkeypatch.setattr(pool_class, "_new_conn", new_conn)
+        yield
+
+
+@pytest.fixture(autouse=True)
+def fresh_connections():
+    """Stop pooled connections made while replaying one cassette, and how much the
+    client throttled, leaking into the next test
+    """
+    from app import client, helpers
+
+    helpers.SESSION.close()
+    helpers.CLIENT.configure(client.RATE, client.MAX_CONCURRENCY)
+    yield
+
+
 @pytest.fixture()
 def source_mods(tmp_path: Path) -> Path:
     """Create a simulated Steam Workshop download directory"""
@@ -48,3 +102,338 @@ def empty_destination(tmp_path: Path) -> Path:
     destination = tmp_path / "mods"
     destination.mkdir()
     return destination
+
+
+class FakeSteamAPIHandler(BaseHTTPRequestHandler):
+    """Answers GetPublishedFileDetails requests from the server's published_files"""
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        mod_ids = [
+            form[f"publishedfileids[{index}]"][0]
+            for index in range(int(form["itemcount"][0]))
+        ]
+        self.server.batches.append(mod_ids)
+        details = [
+            self.server.published_files.get(
+                mod_id, {"publishedfileid": mod_id, "result": 9}
+            )
+            for mod_id in mod_ids
+        ]
+        body = json.dumps(
+            {"response": {"result": 1, "publishedfiledetails": details}}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+
+@pytest.fixture()
+def fake_steam_api(monkeypatch):
+    """Run a local stand in for the Steam web API's published file details method and
+    point the app at it
+    """
+    from app import steam_site
+
+    server = HTTPServer(("127.0.0.1", 0), FakeSteamAPIHandler)
+    server.published_files = dict()
+    server.batches = []
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    monkeypatch.setattr(
+        steam_site,
+        "STEAM_API_DETAILS_URL",
+        f"http://127.0.0.1:{server.server_port}/ISteamRemoteStorage/"
+        "GetPublishedFileDetails/v1/",
+    )
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def fake_updated_timestamps(monkeypatch):
+    """Stand in for looking up when the mods were last updated, which finds them as
+    they were resolved. Changing the returned timestamps updates the mods.
+    """
+    from app import steam_site
+
+    updated = {
+        mod_id: details["updated"] for mod_id, details in UPDATE_MODS_DETAILS.items()
+    }
+    monkeypatch.setattr(
+        steam_site, "get_updated_timestamps", lambda mod_ids, *args: dict(updated)
+    )
+    return updated
+
+
+FAKE_STEAMCMD = """#!{python}
+\"\"\"Pretends to be steamcmd running a runscript of workshop_download_item commands\"\"\"
+import json
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+here = Path(__file__).parent
+config = json.loads((here / "config.json").read_text())
+script = Path(sys.argv[sys.argv.index("+runscript") + 1]).read_text().splitlines()
+install_dir = Path(
+    next(line for line in script if line.startswith("force_install_dir")).split('"')[1]
+)
+mod_ids = [
+    line.split()[2] for line in script if line.startswith("workshop_download_item")
+]
+downloads = install_dir / "steamapps" / "workshop" / "downloads" / "107410"
+contents = install_dir / "steamapps" / "workshop" / "content" / "107410"
+with open(here / "calls.jsonl", "a") as open_file:
+    call = {{
+        "install_dir": str(install_dir),
+        "mod_ids": mod_ids,
+        "resumed": [mod_id for mod_id in mod_ids if (downloads / mod_id).is_dir()],
+        "updated": [mod_id for mod_id in mod_ids if (contents / mod_id).is_dir()],
+        "home": os.environ.get("HOME"),
+    }}
+    open_file.write(json.dumps(call) + "\\n")
+print("Logging in user 'someone' to Steam Public...OK", flush=True)
+for mod_id in mod_ids:
+    if config["failures"].get(mod_id, 0) > 0:
+        config["failures"][mod_id] -= 1
+        (here / "config.json").write_text(json.dumps(config))
+        print(f"ERROR! Download item {{mod_id}} failed (Failure).", flush=True)
+        continue
+    if config["stalls"].get(mod_id, 0) > 0:
+        config["stalls"][mod_id] -= 1
+        (here / "config.json").write_text(json.dumps(config))
+        (downloads / mod_id).mkdir(parents=True, exist_ok=True)
+        (downloads / mod_id / "partial.pbo").write_text("partial junk")
+        time.sleep(60)
+    # Like steamcmd, each file is written in the downloads directory and then moved
+    # into place, replacing the old one
+    content = contents / mod_id
+    size = 0
+    for path, text in (
+        (Path("Addons", f"Mod {{mod_id}}.pbo"), "mod junk " * 10),
+        (Path("Keys", f"Mod {{mod_id}}.BiKEY"), "key junk"),
+    ):
+        size += len(text)
+        if config["truncations"].get(mod_id, 0) > 0:
+            text = text[:4]
+        (downloads / mod_id / path).parent.mkdir(parents=True, exist_ok=True)
+        (downloads / mod_id / path).write_text(text)
+        (content / path).parent.mkdir(parents=True, exist_ok=True)
+        os.replace(downloads / mod_id / path, content / path)
+    if config["truncations"].get(mod_id, 0) > 0:
+        config["truncations"][mod_id] -= 1
+        (here / "config.json").write_text(json.dumps(config))
+    shutil.rmtree(downloads / mod_id, ignore_errors=True)
+    print(
+        f'Success. Downloaded item {{mod_id}} to "{{content}}" ({{size}} bytes)',
+        flush=True,
+    )
+"""
+
+
+class FakeSteamCMD:
+    """A stand in steamcmd executable that downloads fake mods"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.path = directory / "steamcmd.py"
+        self.path.write_text(FAKE_STEAMCMD.format(python=sys.executable))
+        os.chmod(self.path, 0o755)
+        self.config: dict = {"failures": dict(), "stalls": dict(), "truncations": dict()}
+        self.write_config()
+
+    def write_config(self) -> None:
+        """Save the fake's configuration where the fake reads it from"""
+        (self.directory / "config.json").write_text(json.dumps(self.config))
+
+    def set_failures(self, failures: dict) -> None:
+        """Make the given mods fail to download the given number of times"""
+        self.config["failures"] = failures
+        self.write_config()
+
+    def set_stalls(self, stalls: dict) -> None:
+        """Make the given mods hang part way through downloading the given number of
+        times
+        """
+        self.config["stalls"] = stalls
+        self.write_config()
+
+    def set_truncations(self, truncations: dict) -> None:
+        """Make the given mods report success while leaving their files cut short the
+        given number of times
+        """
+        self.config["truncations"] = truncations
+        self.write_config()
+
+    @property
+    def calls(self) -> list:
+        """The install directory, mod IDs, those it resumed or already had and home
+        directory of every time steamcmd was run
+        """
+        calls_path = self.directory / "calls.jsonl"
+        if not calls_path.is_file():
+            return []
+        return [json.loads(line) for line in calls_path.read_text().splitlines()]
+
+
+@pytest.fixture()
+def fake_steamcmd(tmp_path: Path) -> FakeSteamCMD:
+    """A stand in steamcmd executable that downloads fake mods"""
+    directory = tmp_path / "steamcmd"
+    directory.mkdir()
+    return FakeSteamCMD(directory)
+
+
+UPDATE_MODS_DETAILS = {
+    "1": {
+        "title": "Mod One",
+        "updated": 1547105040,
+        "file_size": 100,
+        "directory_name": "@mod_one",
+    },
+    "2": {
+        "title": "Mod Two",
+        "updated": 1543914840,
+        "file_size": 200,
+        "directory_name": "@mod_two",
+    },
+}
+
+
+def fake_manifest_mods_details(manifest_urls, max_workers, backend, graph):
+    """Stand in for resolving the manifests' mods, which have no dependencies"""
+    for mod_id, details in UPDATE_MODS_DETAILS.items():
+        graph.set_dependencies(mod_id, details["updated"], [])
+    return {mod_id: dict(details) for mod_id, details in UPDATE_MODS_DETAILS.items()}
+
+
+@pytest.fixture()
+def fake_manifest(monkeypatch):
+    """Stand in for the manifest and resolving its mods"""
+    from app import files, helpers, steam_site
+
+    monkeypatch.setattr(helpers, "get_manifest_hash", lambda manifest_url: "abc")
+    monkeypatch.setattr(
+        helpers,
+        "get_mods_manifest",
+        lambda manifest_url: {"Line": {"One": "1", "Two": "2"}},
+    )
+    monkeypatch.setattr(
+        steam_site, "get_all_manifests_mods_details", fake_manifest_mods_details
+    )
+    monkeypatch.setattr(files, "save_modlines", lambda *args: None)
+
+
+class FakeBlobHandler(BaseHTTPRequestHandler):
+    """Answers the few Azure blob storage requests the blob target makes, for a single
+    container, from the server's blobs
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def parse(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        name = unquote(url.path.split("/", 2)[2]) if url.path.count("/") > 1 else ""
+        return name, query
+
+    def respond(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        name, query = self.parse()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if query.get("sig") != "secret":
+            return self.respond(403)
+        if self.server.failures:
+            self.server.failures -= 1
+            return self.respond(503)
+        self.server.requests.append((method, name, query.get("comp")))
+        if method == "GET" and query.get("comp") == "list":
+            return self.respond(200, self.list_blobs(query))
+        if method == "DELETE":
+            return self.respond(202 if self.server.blobs.pop(name, None) else 404)
+        metadata = {
+            key[len("x-ms-meta-") :]: value
+            for key, value in self.headers.items()
+            if key.lower().startswith("x-ms-meta-")
+        }
+        if query.get("comp") == "block":
+            self.server.blocks[(name, query["blockid"])] = body
+        elif query.get("comp") == "blocklist":
+            block_ids = re.findall(r"<Latest>(.*?)</Latest>", body.decode())
+            data = b"".join(self.server.blocks.pop((name, block)) for block in block_ids)
+            self.server.blobs[name] = (data, metadata)
+        else:
+            assert self.headers["x-ms-blob-type"] == "BlockBlob"
+            self.server.blobs[name] = (body, metadata)
+        return self.respond(201)
+
+    def list_blobs(self, query):
+        names = sorted(
+            name
+            for name in self.server.blobs
+            if name.startswith(query.get("prefix", "")) and name > query.get("marker", "")
+        )
+        page, rest = names[: self.server.page_size], names[self.server.page_size :]
+        blobs = "".join(
+            f"<Blob><Name>{escape(name)}</Name><Properties><Content-Length>"
+            f"{len(self.server.blobs[name][0])}</Content-Length></Properties><Metadata>"
+            + "".join(
+                f"<{key}>{escape(value)}</{key}>"
+                for key, value in self.server.blobs[name][1].items()
+            )
+            + "</Metadata></Blob>"
+            for name in page
+        )
+        marker = page[-1] if rest else ""
+        return (
+            f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults><Blobs>{blobs}'
+            f"</Blobs><NextMarker>{escape(marker)}</NextMarker></EnumerationResults>"
+        ).encode()
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+
+@pytest.fixture()
+def fake_blob_storage():
+    """Run a local stand in for an Azure blob storage container"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBlobHandler)
+    server.daemon_threads = True
+    server.blobs = dict()
+    server.blocks = dict()
+    server.requests = []
+    server.page_size = 2
+    server.failures = 0
+    server.url = f"http://127.0.0.1:{server.server_port}/mods?sv=2020-10-02&sig=secret"
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,42 @@
+"""Smoke test for the offline benchmarks"""
+import json
+
+
+def test_run_benchmarks(tmp_path, monkeypatch):
+    """Check that every benchmark runs against a tiny workshop and is reported"""
+    from click.testing import CliRunner
+    from app import helpers, steam_site
+    from benchmarks.run import run_benchmarks
+
+    # The benchmarks point these at their own server and cache
+    for module, name in (
+        (steam_site, "STEAM_WORKHOP_PAGE_URL"),
+        (steam_site, "STEAM_API_DETAILS_URL"),
+        (helpers, "CACHE_PATH"),
+    ):
+        monkeypatch.setattr(module, name, getattr(module, name))
+    output = tmp_path / "results.json"
+    result = CliRunner().invoke(
+        run_benchmarks,
+        [
+            *("--mods", "6", "--depth", "3", "--fan_out", "2"),
+            *("--tree_files", "60", "--flow_files", "5"),
+            *("--latency", "0", "--repeat", "1", "--output", str(output)),
+        ],
+    )
+    assert result.exception is None, result.output
+    report = json.loads(output.read_text())
+    assert set(report["results"]) == {
+        "collect_all_dependencies",
+        "collect_all_dependencies_revalidated",
+        "collect_all_dependencies_api",
+        "detail_mods",
+        "make_files_and_dirs_safe",
+        "make_files_and_dirs_safe_parallel",
+        "copy_keys",
+        "update_mods",
+    }
+    assert report["results"]["update_mods"]["metrics"]["download"]["downloaded"] == 6
+    assert report["results"]["collect_all_dependencies_revalidated"]["metrics"][
+        "fetch"
+    ]["not_modified"] == 6
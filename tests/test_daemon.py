@@ -0,0 +1,92 @@
+"""Test keeping the mods up to date from a long running process"""
+import json
+import threading
+import time
+import pytest
+
+
+@pytest.fixture()
+def updater(fake_steamcmd, fake_manifest, fake_updated_timestamps, tmp_path):
+    """A daemon with the test's directories that has not started yet"""
+    from app.daemon import Daemon, daemon
+
+    for directory in ("downloads", "mods", "keys"):
+        (tmp_path / directory).mkdir()
+    context = daemon.make_context(
+        "daemon",
+        [
+            *("--steamcmd_path", str(fake_steamcmd.path)),
+            *("--manifest_url", "https://example.com/mods_manifest.json"),
+            *("--download_path", str(tmp_path / "downloads")),
+            *("--mods_path", str(tmp_path / "mods")),
+            *("--keys_path", str(tmp_path / "keys")),
+            *("--username", "someone", "--password", "secret"),
+            *("--cache_path", str(tmp_path / "cache")),
+        ],
+    )
+    options = dict(context.params)
+    interval = options.pop("interval")
+    del options["listen"]
+    updater = Daemon(options, interval)
+    yield updater
+    updater.state.close()
+
+
+def test_daemon_updates_only_changes(updater, fake_steamcmd, monkeypatch):
+    """Check that the first update downloads the mods and the next finds nothing
+    changed, and that a failed update is reported without stopping the daemon
+    """
+    from app import helpers
+    from app.download import EXIT_FAILED, EXIT_UP_TO_DATE
+
+    assert updater.update() == EXIT_UP_TO_DATE
+    assert updater.update() == EXIT_UP_TO_DATE
+    assert len(fake_steamcmd.calls) == 1
+    assert sorted(updater.state.get_mods_details()) == ["1", "2"]
+
+    def fail(manifest_url):
+        raise ConnectionError("Steam is down")
+
+    monkeypatch.setattr(helpers, "get_manifest_hash", fail)
+    assert updater.update() == EXIT_FAILED
+    status = updater.get_status()
+    assert status["runs"] == 3 and status["state"] == "idle"
+    assert "Steam is down" in status["last_error"]
+
+
+def test_daemon_status_and_trigger(updater):
+    """Check that the status is served and that a trigger starts an update straight
+    away
+    """
+    import requests
+    from app.daemon import serve_status
+
+    updates = []
+    updated = threading.Event()
+
+    def update():
+        updates.append(True)
+        updater.set_status(runs=len(updates), next_check=time.time() + 3600)
+        updated.set()
+        return 0
+
+    updater.update = update
+    server = serve_status(updater, "127.0.0.1:0")
+    url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=updater.run)
+    thread.start()
+    try:
+        assert updated.wait(5)
+        updated.clear()
+        assert requests.get(f"{url}/status").json()["runs"] == 1
+        response = requests.post(f"{url}/trigger")
+        assert response.status_code == 202
+        assert updated.wait(5)
+        assert json.loads(requests.get(f"{url}/status").content)["runs"] == 2
+        assert requests.get(f"{url}/nothing").status_code == 404
+    finally:
+        updater.stop()
+        thread.join(5)
+        server.shutdown()
+        server.server_close()
+    assert not thread.is_alive()
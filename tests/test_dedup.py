@@ -0,0 +1,56 @@
+"""Test linking identical files between mods"""
+
+
+def publish_fake_mods(tmp_path, contents):
+    """Publish a mod with the given contents for each mod ID, with its files indexed"""
+    from app.files import hash_mod_dir, index_mod_dir
+    from app.state import StateStore
+
+    mods = tmp_path / "mods"
+    state = StateStore(mods, tmp_path / "state.sqlite3")
+    for mod_id, files in contents.items():
+        mod_dir = mods / f"@mod_{mod_id}"
+        (mod_dir / "addons").mkdir(parents=True)
+        for name, text in files.items():
+            (mod_dir / "addons" / name).write_text(text)
+        state.set_mod_details(mod_id, {"title": mod_id, "directory_name": mod_dir.name})
+        state.set_file_index(mod_id, index_mod_dir(mod_dir, hash_mod_dir(mod_dir)))
+    return mods, state
+
+
+def test_dedup_mods(tmp_path):
+    """Check that identical files are linked once, that the index stays up to date and
+    that hard linked files can't be written to
+    """
+    from app.dedup import dedup_mods
+    from app.verify import verify_mods
+
+    shared = "shared junk " * 100
+    mods, state = publish_fake_mods(
+        tmp_path,
+        {
+            "1": {"cba.pbo": shared, "one.pbo": "one junk " * 100},
+            "2": {"cba.pbo": shared, "small.pbo": "small"},
+            "3": {"copy_of_cba.pbo": shared, "small.pbo": "small"},
+        },
+    )
+    (mods / "@mod_3" / "addons" / "copy_of_cba.pbo").write_text(shared.upper())
+
+    stats = dedup_mods(mods, state, min_size=100)
+    assert stats.linked_files == 1
+    assert stats.saved_bytes == len(shared)
+    assert stats.reflinks + stats.hardlinks == 1
+    first, second = (mods / f"@mod_{mod_id}" / "addons" / "cba.pbo" for mod_id in "12")
+    assert second.read_text() == shared
+    if stats.hardlinks:
+        assert first.stat().st_ino == second.stat().st_ino
+        assert not second.stat().st_mode & 0o222
+    assert sorted(path.name for path in second.parent.iterdir()) == [
+        "cba.pbo",
+        "small.pbo",
+    ]
+    assert verify_mods(mods, state) == {
+        "3": ["addons/copy_of_cba.pbo has different contents"]
+    }
+    assert dedup_mods(mods, state, min_size=100).linked_files == 0
+    state.close()
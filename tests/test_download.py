@@ -1 +1,704 @@
 """Test downloading functions"""
+import json
+from pathlib import Path
+import pytest
+from tests.conftest import UPDATE_MODS_DETAILS
+
+
+def test_get_mods_to_download():
+    """Check that only new and updated mods are downloaded"""
+    from app.download import get_mods_to_download
+    from tests.conftest import MODS_DETAILS
+
+    current_mods_details = {
+        mod_id: dict(details) for mod_id, details in MODS_DETAILS.items()
+    }
+    new_mods_details = {
+        mod_id: dict(details) for mod_id, details in MODS_DETAILS.items()
+    }
+    new_mods_details["450814997"]["updated"] += 60
+    new_mods_details["1"] = {"title": "New", "updated": 1546304400}
+    del current_mods_details["333310405"]
+    assert get_mods_to_download(new_mods_details, current_mods_details) == {
+        "450814997",
+        "333310405",
+        "1",
+    }
+
+
+def test_get_mods_to_download_approximate():
+    """Check that migrated dates are allowed to be off by a time zone and that content
+    is only compared when asked to
+    """
+    from app.download import get_mods_to_download
+
+    current_mods_details = {
+        "1": {"updated": 1547105040, "updated_approximate": True, "file_size": 10},
+        "2": {"updated": 1547105040, "updated_approximate": True},
+        "3": {"updated": 1547105040, "file_size": 10, "manifest_id": "123"},
+    }
+    new_mods_details = {
+        "1": {"updated": 1547105040 + 8 * 60 * 60, "file_size": 10},
+        "2": {"updated": 1547105040 + 2 * 24 * 60 * 60},
+        "3": {"updated": 1547105040, "file_size": 10, "manifest_id": "456"},
+    }
+    assert get_mods_to_download(new_mods_details, current_mods_details) == {"2"}
+    assert get_mods_to_download(
+        new_mods_details, current_mods_details, compare_content=True
+    ) == {"2", "3"}
+
+
+def test_refresh_approximate_dates():
+    """Check that mods that are not downloaded get their exact dates saved"""
+    from app.download import refresh_approximate_dates
+
+    current_mods_details = {
+        "1": {"updated": 100, "updated_approximate": True},
+        "2": {"updated": 100, "updated_approximate": True},
+    }
+    new_mods_details = {"1": {"updated": 200}, "2": {"updated": 300}}
+    assert refresh_approximate_dates(new_mods_details, current_mods_details, {"2"})
+    assert current_mods_details == {
+        "1": {"updated": 200},
+        "2": {"updated": 100, "updated_approximate": True},
+    }
+
+
+def test_write_runscript(tmp_path):
+    """Check that a single login is followed by all the downloads"""
+    from app.download import write_runscript
+
+    runscript = tmp_path / "script.txt"
+    write_runscript(runscript, ["1", "2"], "someone", "secret", Path("/downloads"))
+    lines = runscript.read_text().splitlines()
+    assert lines[-4:] == [
+        'login "someone" "secret"',
+        "workshop_download_item 107410 1",
+        "workshop_download_item 107410 2",
+        "quit",
+    ]
+    assert 'force_install_dir "/downloads"' in lines
+    assert runscript.stat().st_mode & 0o777 == 0o600
+
+
+def test_get_downloaded_mod_ids():
+    """Check that successful downloads are picked out of steamcmd's output"""
+    from app.download import get_downloaded_mod_ids
+
+    output = (
+        "Logging in user 'someone' to Steam Public...OK\n"
+        'Success. Downloaded item 450814997 to "/steamapps/workshop/content/107410/'
+        '450814997" (2089811 bytes)\n'
+        "ERROR! Download item 463939057 failed (Failure).\n"
+    )
+    assert get_downloaded_mod_ids(output) == {"450814997"}
+
+
+def test_download_steam_mods(fake_steamcmd, tmp_path):
+    """Check that mods are downloaded in batches and only failures are retried"""
+    from app.download import download_steam_mods
+
+    fake_steamcmd.set_failures({"2": 1, "3": 5})
+    downloaded = download_steam_mods(
+        ["1", "2", "3", "4"],
+        fake_steamcmd.path,
+        "someone",
+        "secret",
+        tmp_path,
+        batch_size=3,
+        tries=2,
+        backoff=0,
+    )
+    assert downloaded == {"1", "2", "4"}
+    assert [call["mod_ids"] for call in fake_steamcmd.calls] == [
+        ["1", "2", "3"],
+        ["4", "2", "3"],
+    ]
+    content = tmp_path / "steamapps" / "workshop" / "content" / "107410"
+    assert sorted(path.name for path in content.iterdir()) == ["1", "2", "4"]
+
+
+def test_download_steam_mods_truncated(fake_steamcmd, tmp_path):
+    """Check that a mod steamcmd reports as downloaded but whose files are smaller than
+    it reported is downloaded again from scratch
+    """
+    from app.download import download_steam_mods
+
+    fake_steamcmd.set_truncations({"1": 1})
+    reported = []
+    downloaded = download_steam_mods(
+        ["1", "2"],
+        fake_steamcmd.path,
+        "someone",
+        "secret",
+        tmp_path,
+        backoff=0,
+        on_downloaded=lambda mod_id, content_path: reported.append(mod_id),
+    )
+    assert downloaded == {"1", "2"}
+    assert reported == ["2", "1"]
+    assert [call["updated"] for call in fake_steamcmd.calls] == [[], []]
+    mod_1 = tmp_path / "steamapps" / "workshop" / "content" / "107410" / "1"
+    assert (mod_1 / "Addons" / "Mod 1.pbo").read_text() == "mod junk " * 10
+
+
+def test_download_steam_mods_batch_size(fake_steamcmd, tmp_path):
+    """Check that an empty batch size is refused rather than looping forever"""
+    from app.download import download_steam_mods
+
+    with pytest.raises(ValueError):
+        download_steam_mods(
+            ["1"], fake_steamcmd.path, "someone", "secret", tmp_path, batch_size=0
+        )
+    assert fake_steamcmd.calls == []
+    result = run_update_mods(tmp_path, fake_steamcmd, "--batch_size", "0")
+    assert result.exit_code == 2
+    assert "--batch_size" in result.output
+
+
+def test_download_steam_mods_stalled(fake_steamcmd, tmp_path, monkeypatch):
+    """Check that a stalled steamcmd is stopped and its mods resumed in the next batch"""
+    from app import download
+
+    monkeypatch.setattr(download, "PROGRESS_INTERVAL", 0.05)
+    fake_steamcmd.set_stalls({"2": 1})
+    downloaded = download.download_steam_mods(
+        ["1", "2", "3"],
+        fake_steamcmd.path,
+        "someone",
+        "secret",
+        tmp_path,
+        stall_timeout=0.5,
+        backoff=0,
+    )
+    assert downloaded == {"1", "2", "3"}
+    calls = fake_steamcmd.calls
+    assert [call["mod_ids"] for call in calls] == [["1", "2", "3"], ["2", "3"]]
+    assert calls[1]["resumed"] == ["2"]
+    assert not (download.get_partial_path(tmp_path) / "2").exists()
+
+
+def test_download_steam_mods_reports_each_mod(
+    fake_steamcmd, tmp_path, monkeypatch, capsys
+):
+    """Check that each mod is reported as soon as steamcmd says it downloaded, rather
+    than when its batch ends
+    """
+    from app import download
+
+    monkeypatch.setattr(download, "PROGRESS_INTERVAL", 0.05)
+    fake_steamcmd.set_stalls({"2": 1})
+    reported = []
+    download.download_steam_mods(
+        ["1", "2"],
+        fake_steamcmd.path,
+        "someone",
+        "secret",
+        tmp_path,
+        on_downloaded=lambda mod_id, content_path: reported.append(
+            (
+                mod_id,
+                (content_path / mod_id).is_dir(),
+                "no progress" in capsys.readouterr().out,
+            )
+        ),
+        stall_timeout=0.5,
+        backoff=0,
+    )
+    # Mod 1 is reported before the first steamcmd stalls on mod 2 and is stopped
+    assert reported == [("1", True, False), ("2", True, True)]
+    assert fake_steamcmd.calls[0]["mod_ids"] == ["1", "2"]
+
+
+def test_download_steam_mods_should_stop(fake_steamcmd, tmp_path):
+    """Check that no more batches are started once told to stop"""
+    from app.download import download_steam_mods
+
+    downloaded = download_steam_mods(
+        ["1", "2", "3"],
+        fake_steamcmd.path,
+        "someone",
+        "secret",
+        tmp_path,
+        batch_size=1,
+        should_stop=lambda: len(fake_steamcmd.calls) >= 1,
+    )
+    assert downloaded == {"1"}
+    assert [call["mod_ids"] for call in fake_steamcmd.calls] == [["1"]]
+
+
+def test_get_backoff_delay():
+    """Check that retries wait twice as long each time, with jitter, up to a limit"""
+    from app.download import BACKOFF_MAX, get_backoff_delay
+
+    assert 5 <= get_backoff_delay(1, 10) <= 10
+    assert 20 <= get_backoff_delay(3, 10) <= 40
+    assert BACKOFF_MAX / 2 <= get_backoff_delay(20, 10) <= BACKOFF_MAX
+    assert get_backoff_delay(4, 0) == 0
+
+
+def test_schedule_largest_first():
+    """Check that mods are shared out largest first to the least loaded worker"""
+    from app.download import schedule_largest_first
+
+    sizes = {"a": 100, "b": 60, "c": 50, "d": 40, "e": 10}
+    assert schedule_largest_first(["e", "d", "c", "b", "a", "f"], sizes, 2) == [
+        ["a", "d"],
+        ["b", "c", "e", "f"],
+    ]
+    assert schedule_largest_first(["a"], sizes, 3) == [["a"], [], []]
+    assert schedule_largest_first(["a", "b", "c"], sizes, 2, {"b": 0}) == [
+        ["a", "b"],
+        ["c"],
+    ]
+
+
+def test_schedule_by_modline():
+    """Check that the mod line with the fewest bytes left goes first, counting mods
+    shared with mod lines already downloaded as done
+    """
+    from app.download import schedule_by_modline
+
+    sizes = {"a": 100, "b": 10, "c": 20, "d": 5}
+    modlines = {
+        "A": frozenset({"a"}),
+        "B": frozenset({"b", "c"}),
+        "C": frozenset({"c", "d"}),
+    }
+    assert schedule_by_modline(["x", "a", "b", "c", "d"], sizes, modlines) == [
+        "c",
+        "d",
+        "b",
+        "a",
+        "x",
+    ]
+
+
+def test_download_steam_mods_in_parallel(fake_steamcmd, tmp_path):
+    """Check that each worker downloads into its own install directory"""
+    from app.download import download_steam_mods_in_parallel, get_content_path
+
+    downloaded = download_steam_mods_in_parallel(
+        ["1", "2", "3"],
+        {"1": 300, "2": 200, "3": 100},
+        fake_steamcmd.path,
+        "someone",
+        "secret",
+        tmp_path,
+        workers=2,
+    )
+    worker_0 = get_content_path(tmp_path / "worker_0")
+    worker_1 = get_content_path(tmp_path / "worker_1")
+    assert downloaded == {"1": worker_0, "2": worker_1, "3": worker_1}
+    assert all((path / mod_id).is_dir() for mod_id, path in downloaded.items())
+    assert sorted(call["install_dir"] for call in fake_steamcmd.calls) == [
+        str(tmp_path / "worker_0"),
+        str(tmp_path / "worker_1"),
+    ]
+    assert sorted(call["home"] for call in fake_steamcmd.calls) == [
+        str(tmp_path / "worker_0" / "home"),
+        str(tmp_path / "worker_1" / "home"),
+    ]
+    with pytest.raises(ValueError):
+        download_steam_mods_in_parallel(
+            ["1"], dict(), fake_steamcmd.path, "someone", "secret", tmp_path, workers=0
+        )
+
+
+def test_get_worker_steamcmd(tmp_path):
+    """Check that steamcmd.sh installations are copied for each worker, once"""
+    from app.download import get_worker_steamcmd
+
+    steamcmd_path = tmp_path / "steamcmd" / "steamcmd.sh"
+    (steamcmd_path.parent / "linux32").mkdir(parents=True)
+    steamcmd_path.write_text("#!/bin/sh")
+    (steamcmd_path.parent / "linux32" / "steamcmd").write_text("binary")
+    install_path = tmp_path / "worker_0"
+    install_path.mkdir()
+    worker_steamcmd = get_worker_steamcmd(steamcmd_path, install_path)
+    assert worker_steamcmd == install_path / "steamcmd" / "steamcmd.sh"
+    assert (install_path / "steamcmd" / "linux32" / "steamcmd").read_text() == "binary"
+    (worker_steamcmd.parent / "config.vdf").write_text("logged in")
+    assert get_worker_steamcmd(steamcmd_path, install_path) == worker_steamcmd
+    assert (worker_steamcmd.parent / "config.vdf").is_file()
+    assert get_worker_steamcmd(Path("/usr/games/steamcmd"), install_path) == Path(
+        "/usr/games/steamcmd"
+    )
+
+
+def run_update_mods(tmp_path, fake_steamcmd, *options):
+    """Run update_mods against the fake steamcmd with the test's directories"""
+    from click.testing import CliRunner
+    from app.download import update_mods
+
+    for directory in ("downloads", "mods", "keys"):
+        (tmp_path / directory).mkdir(exist_ok=True)
+    return CliRunner().invoke(
+        update_mods,
+        [
+            "--steamcmd_path",
+            str(fake_steamcmd.path),
+            "--manifest_url",
+            "https://example.com/mods_manifest.json",
+            "--download_path",
+            str(tmp_path / "downloads"),
+            "--mods_path",
+            str(tmp_path / "mods"),
+            "--keys_path",
+            str(tmp_path / "keys"),
+            "--username",
+            "someone",
+            "--password",
+            "secret",
+            "--cache_path",
+            str(tmp_path / "cache"),
+            *options,
+        ],
+    )
+
+
+def test_update_mods(fake_steamcmd, fake_manifest, tmp_path):
+    """Check that downloaded mods end up prepared in the mods directory and that a mod
+    that failed to download fails the run
+    """
+    from app import files
+    from app.download import EXIT_FAILED
+    from app.state import STATE_FILENAME
+
+    fake_steamcmd.set_failures({"2": 10})
+
+    result = run_update_mods(
+        tmp_path,
+        fake_steamcmd,
+        "--batch_size",
+        "1",
+        "--backoff",
+        "0",
+        "--metrics_json",
+        str(tmp_path / "metrics.json"),
+        "--metrics_prom",
+        str(tmp_path / "zamd.prom"),
+    )
+    assert result.exit_code == EXIT_FAILED, result.output
+    assert "ERROR: Failed to download: ['Mod Two']" in result.output
+    mods = tmp_path / "mods"
+    assert (mods / "@mod_one" / "addons" / "mod_1.pbo").is_file()
+    assert not (mods / "@mod_two").exists()
+    assert (tmp_path / "keys" / "mod_1.bikey").is_file()
+    assert files.get_current_mod_details(mods) == {"1": UPDATE_MODS_DETAILS["1"]}
+    assert (tmp_path / "downloads" / STATE_FILENAME).is_file()
+    assert not (mods / STATE_FILENAME).exists()
+    report = json.loads((tmp_path / "metrics.json").read_text())
+    assert report["exit_code"] == EXIT_FAILED
+    assert report["mods"]["1"]["download"] == {"attempts": 1, "downloaded": 1}
+    assert report["mods"]["2"]["download"] == {"attempts": 10, "downloaded": 0}
+    assert report["mods"]["1"]["publish"]["files"] == 2
+    assert "zamd_last_run_exit_code 1" in (tmp_path / "zamd.prom").read_text()
+
+
+@pytest.mark.parametrize("option", ["--max_workers", "--rename_workers"])
+def test_update_mods_no_workers(fake_steamcmd, tmp_path, option):
+    """Check that running without any workers is refused before anything is done"""
+    result = run_update_mods(tmp_path, fake_steamcmd, option, "0")
+    assert result.exit_code == 2
+    assert f"Invalid value for {option!r}" in result.output
+    assert fake_steamcmd.calls == []
+
+
+def test_update_mods_check(
+    fake_steamcmd, fake_manifest, fake_updated_timestamps, tmp_path, monkeypatch
+):
+    """Check that once everything is published, unchanged mods are found to be up to
+    date without resolving the manifest again, and updated ones to be pending
+    """
+    from app import steam_site
+    from app.download import EXIT_PENDING, EXIT_UP_TO_DATE
+
+    result = run_update_mods(tmp_path, fake_steamcmd, "--check")
+    assert result.exit_code == EXIT_PENDING, result.output
+
+    result = run_update_mods(tmp_path, fake_steamcmd)
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert len(fake_steamcmd.calls) == 1
+
+    monkeypatch.setattr(steam_site, "get_all_manifests_mods_details", None)
+    result = run_update_mods(tmp_path, fake_steamcmd, "--check")
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    result = run_update_mods(tmp_path, fake_steamcmd)
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert len(fake_steamcmd.calls) == 1
+
+    fake_updated_timestamps["2"] += 60
+    result = run_update_mods(tmp_path, fake_steamcmd, "--check")
+    assert result.exit_code == EXIT_PENDING, result.output
+
+
+def test_is_up_to_date_api(fake_steam_api, monkeypatch, tmp_path):
+    """Check that the fast check looks mods up in a batch rather than page by page"""
+    from app import download, helpers, steam_site
+    from app.graph import DependencyGraph
+    from app.state import StateStore
+    from tests.test_steam_site import published_file
+
+    monkeypatch.setattr(
+        helpers, "get_mods_manifest", lambda url: {"Line": {"One": "1", "Two": "2"}}
+    )
+    monkeypatch.setattr(steam_site, "get_workshop_page", None)
+    state = StateStore(tmp_path)
+    state.set_mods_details(UPDATE_MODS_DETAILS)
+    state.set_value(download.MANIFEST_HASH_KEY, "abc")
+    graph = DependencyGraph()
+    for mod_id, details in UPDATE_MODS_DETAILS.items():
+        graph.set_dependencies(mod_id, details["updated"], [])
+        fake_steam_api.published_files[mod_id] = published_file(
+            mod_id, details["title"], details["updated"] + 30, details["file_size"]
+        )
+    assert download.is_up_to_date("manifest", "abc", state, graph)
+    assert [sorted(batch) for batch in fake_steam_api.batches] == [["1", "2"]]
+
+    fake_steam_api.published_files["2"]["time_updated"] += 60
+    assert not download.is_up_to_date("manifest", "abc", state, graph)
+    state.close()
+
+
+def test_update_mods_reset_state(
+    fake_steamcmd, fake_manifest, fake_updated_timestamps, tmp_path
+):
+    """Check that deleting the mods details file only makes mods download again once
+    the state is reset
+    """
+    from app import files
+    from app.download import EXIT_UP_TO_DATE
+
+    assert run_update_mods(tmp_path, fake_steamcmd).exit_code == EXIT_UP_TO_DATE
+    (tmp_path / "mods" / files.MODS_DETAILS_FILENAME).unlink()
+    assert run_update_mods(tmp_path, fake_steamcmd).exit_code == EXIT_UP_TO_DATE
+    assert len(fake_steamcmd.calls) == 1
+
+    result = run_update_mods(tmp_path, fake_steamcmd, "--reset_state")
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert sorted(fake_steamcmd.calls[1]["mod_ids"]) == ["1", "2"]
+
+
+def test_update_mods_verify(
+    fake_steamcmd, fake_manifest, fake_updated_timestamps, tmp_path
+):
+    """Check that only the published mods that turn out to be corrupt are downloaded
+    again
+    """
+    from app.download import EXIT_UP_TO_DATE
+    from app.state import STATE_FILENAME, StateStore
+
+    assert run_update_mods(tmp_path, fake_steamcmd).exit_code == EXIT_UP_TO_DATE
+    # The files are only hashed when something needs the index
+    state = StateStore(tmp_path / "mods", tmp_path / "downloads" / STATE_FILENAME)
+    assert state.get_file_index("2") == dict()
+    state.close()
+    result = run_update_mods(tmp_path, fake_steamcmd, "--verify")
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert len(fake_steamcmd.calls) == 1
+
+    (tmp_path / "mods" / "@mod_two" / "addons" / "mod_2.pbo").write_text("trunc")
+    result = run_update_mods(tmp_path, fake_steamcmd, "--verify")
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert "@mod_two: addons/mod_2.pbo is 5 bytes instead of 90!" in result.output
+    assert [call["mod_ids"] for call in fake_steamcmd.calls][1:] == [["2"]]
+    mod_2 = tmp_path / "mods" / "@mod_two" / "addons" / "mod_2.pbo"
+    assert mod_2.read_text() == "mod junk " * 10
+
+
+def test_run_stage():
+    """Check that a stage passes items on and drains its inbox after a failure"""
+    from queue import Queue
+    from app.download import FINISHED, run_stage
+
+    def halve(number):
+        if number == 3:
+            raise ValueError(number)
+        return (number / 2,)
+
+    inbox: Queue = Queue()
+    outbox: Queue = Queue()
+    errors: list = []
+    for number in (2, 4, 3, 6):
+        inbox.put((number,))
+    inbox.put(FINISHED)
+    run_stage(halve, inbox, outbox, errors)
+    assert [outbox.get() for _ in range(3)] == [(1,), (2,), FINISHED]
+    assert [str(error) for error in errors] == ["3"]
+
+
+def test_prepare_downloaded_mod_keeps_published(tmp_path):
+    """Check that preparing a mod leaves its published copy in place until it is
+    swapped for the new one
+    """
+    from app.download import prepare_downloaded_mod, publish_mod
+    from app.state import StateStore
+
+    downloaded_dir, mods_path, keys_path = (
+        tmp_path / "downloaded",
+        tmp_path / "mods",
+        tmp_path / "keys",
+    )
+    (downloaded_dir / "1" / "keys").mkdir(parents=True)
+    (downloaded_dir / "1" / "keys" / "mod.bikey").write_text("key")
+    (downloaded_dir / "1" / "new.pbo").write_text("new")
+    (mods_path / "@mod_one").mkdir(parents=True)
+    (mods_path / "@mod_one" / "old.pbo").write_text("old")
+    keys_path.mkdir()
+    details = UPDATE_MODS_DETAILS["1"]
+
+    _, mod_path = prepare_downloaded_mod("1", downloaded_dir, details, keys_path)
+    assert (mods_path / "@mod_one" / "old.pbo").is_file()
+    state = StateStore(mods_path, tmp_path / "state.sqlite3")
+    publish_mod("1", mod_path, details, state, mods_path)
+    state.close()
+    assert sorted(path.name for path in (mods_path / "@mod_one").iterdir()) == [
+        "keys",
+        "new.pbo",
+    ]
+
+
+def test_update_mods_blob_target(
+    fake_steamcmd, fake_manifest, fake_updated_timestamps, fake_blob_storage, tmp_path
+):
+    """Check that the mods and their details are uploaded to blob storage, and that the
+    next update with nothing new uploads nothing
+    """
+    from app.download import EXIT_UP_TO_DATE
+
+    options = ("--mods_target", fake_blob_storage.url)
+    result = run_update_mods(tmp_path, fake_steamcmd, *options)
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    blobs = fake_blob_storage.blobs
+    assert blobs["@mod_two/addons/mod_2.pbo"][0] == b"mod junk " * 10
+    assert "mods_details.json" in blobs
+    assert not list((tmp_path / "mods").glob("@*"))
+
+    fake_blob_storage.requests.clear()
+    result = run_update_mods(tmp_path, fake_steamcmd, *options)
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert len(fake_steamcmd.calls) == 1
+    assert {request[0] for request in fake_blob_storage.requests} <= {"GET"}
+
+
+def test_update_mods_keep_downloads(
+    fake_steamcmd, fake_manifest, fake_updated_timestamps, tmp_path
+):
+    """Check that steamcmd's copies of the mods are kept for it to update, without
+    changing the published mods
+    """
+    from app.download import EXIT_UP_TO_DATE, get_content_path
+    from app.state import STATE_FILENAME, StateStore
+
+    result = run_update_mods(tmp_path, fake_steamcmd, "--keep_downloads")
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    content = get_content_path(tmp_path / "downloads")
+    assert (content / "2" / "Addons" / "Mod 2.pbo").is_file()
+    mod_2 = tmp_path / "mods" / "@mod_two" / "addons" / "mod_2.pbo"
+    assert mod_2.read_text() == "mod junk " * 10
+    assert (tmp_path / "keys" / "mod_2.bikey").is_file()
+
+    state = StateStore(tmp_path / "mods", tmp_path / "downloads" / STATE_FILENAME)
+    state.forget_mods(["2"])
+    state.close()
+    result = run_update_mods(tmp_path, fake_steamcmd, "--keep_downloads")
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert fake_steamcmd.calls[-1]["updated"] == ["2"]
+    assert mod_2.read_text() == "mod junk " * 10
+
+
+def test_update_mods_keep_downloads_repair(
+    fake_steamcmd, fake_manifest, fake_updated_timestamps, tmp_path
+):
+    """Check that a corrupt mod is downloaded afresh rather than published again from
+    steamcmd's copy, which shares the corrupt file's data
+    """
+    import os
+    from app.download import EXIT_UP_TO_DATE, get_content_path
+
+    options = ("--keep_downloads", "--verify")
+    result = run_update_mods(tmp_path, fake_steamcmd, *options)
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    downloaded = get_content_path(tmp_path / "downloads") / "2" / "Addons" / "Mod 2.pbo"
+    os.chmod(downloaded, 0o644)
+    downloaded.write_text("corrupt")
+
+    result = run_update_mods(tmp_path, fake_steamcmd, *options)
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    assert "Downloading corrupt mods again: ['2']" in result.output
+    assert fake_steamcmd.calls[-1]["mod_ids"] == ["2"]
+    assert fake_steamcmd.calls[-1]["updated"] == []
+    mod_2 = tmp_path / "mods" / "@mod_two" / "addons" / "mod_2.pbo"
+    assert mod_2.read_text() == "mod junk " * 10
+
+
+def test_update_mods_modlines_as_ready(
+    fake_steamcmd, fake_manifest, tmp_path, monkeypatch
+):
+    """Check that a mod line is added to the mod lines file as soon as its mods are
+    published, even though a mod in another mod line fails
+    """
+    from app import helpers
+    from app.download import EXIT_FAILED
+
+    monkeypatch.setattr(
+        helpers,
+        "get_mods_manifest",
+        lambda manifest_url: {"First": {"One": "1"}, "Second": {"Two": "2"}},
+    )
+    fake_steamcmd.set_failures({"2": 10})
+    result = run_update_mods(tmp_path, fake_steamcmd, "--backoff", "0")
+    assert result.exit_code == EXIT_FAILED, result.output
+    assert "Mod lines ready: ['First']" in result.output
+    modlines = json.loads((tmp_path / "mods" / "modlines.json").read_text())
+    assert modlines == {"First": ["@mod_one"]}
+
+
+def test_update_mods_extra_manifest(fake_steamcmd, fake_manifest, tmp_path, monkeypatch):
+    """Check that the mods of several manifests are downloaded once between them, and
+    that each manifest's mods and keys are published to its own directories with its
+    own state
+    """
+    from app import helpers
+    from app.download import EXIT_UP_TO_DATE
+    from app.state import STATE_FILENAME, StateStore, get_state_path
+
+    manifests = {
+        "https://example.com/mods_manifest.json": {"Line": {"One": "1", "Two": "2"}},
+        "https://example.com/other_manifest.json": {"Other": {"One": "1"}},
+    }
+    monkeypatch.setattr(helpers, "get_mods_manifest", manifests.get)
+    for directory in ("other_mods", "other_keys"):
+        (tmp_path / directory).mkdir()
+    result = run_update_mods(
+        tmp_path,
+        fake_steamcmd,
+        "--extra_manifest",
+        "https://example.com/other_manifest.json",
+        str(tmp_path / "other_mods"),
+        str(tmp_path / "other_keys"),
+        "--verify",
+    )
+    assert result.exit_code == EXIT_UP_TO_DATE, result.output
+    downloaded = [
+        mod_id for call in fake_steamcmd.calls for mod_id in call["mod_ids"]
+    ]
+    assert sorted(downloaded) == ["1", "2"]
+    for mods_path, keys_path in (("mods", "keys"), ("other_mods", "other_keys")):
+        mod_1 = tmp_path / mods_path / "@mod_one" / "addons" / "mod_1.pbo"
+        assert mod_1.read_text() == "mod junk " * 10
+        assert (tmp_path / keys_path / "mod_1.bikey").is_file()
+    assert not (tmp_path / "other_mods" / "@mod_two").exists()
+    assert not (tmp_path / "other_keys" / "mod_2.bikey").exists()
+
+    state = StateStore(tmp_path / "mods", tmp_path / "downloads" / STATE_FILENAME)
+    assert set(state.get_mods_details()) == {"1", "2"}
+    state.close()
+    other_state = StateStore(
+        tmp_path / "other_mods",
+        get_state_path(tmp_path / "downloads", tmp_path / "other_mods"),
+    )
+    assert set(other_state.get_mods_details()) == {"1"}
+    assert other_state.get_file_index("1")
+    other_state.close()
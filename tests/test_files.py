@@ -9,6 +9,34 @@ def test_get_current_mod_details():
     assert False
 
 
+def test_get_current_mod_details_migrated(tmp_path):
+    """Check that dates saved the way they appeared on the workshop pages are converted
+    to timestamps as of when the file was written
+    """
+    import os
+    from app.files import get_current_mod_details, MODS_DETAILS_FILENAME
+
+    mods_details_path = tmp_path / MODS_DETAILS_FILENAME
+    mods_details_path.write_text(
+        json.dumps(
+            {
+                "450814997": {"title": "CBA_A3", "updated": "10 Jan @ 7:24am"},
+                "333310405": {"title": "Enhanced Movement", "updated": 1525950060},
+            }
+        )
+    )
+    # Thu, 28 Feb 2019 15:05:18 GMT
+    os.utime(mods_details_path, (1551366318, 1551366318))
+    assert get_current_mod_details(tmp_path) == {
+        "450814997": {
+            "title": "CBA_A3",
+            "updated": 1547105040,
+            "updated_approximate": True,
+        },
+        "333310405": {"title": "Enhanced Movement", "updated": 1525950060},
+    }
+
+
 def test_is_key_dir():
     """Check that it can figure out if the given path is a key directory"""
     from app.files import is_key_dir
@@ -37,13 +65,13 @@ def test_save_mods_details():
     assert False
 
 
-def test_make_files_and_dirs_safe(source_mods, empty_destination):
+def test_make_files_and_dirs_safe(source_mods):
     """Test that files and directories are renamed to linux safe names"""
     from app.files import make_files_and_dirs_safe, prepare_mod_dir
     from tests.conftest import MOD_ID_KEY_PAIRS, MODS_DETAILS
 
     for mod_id, details in MODS_DETAILS.items():
-        prepare_mod_dir(mod_id, source_mods, empty_destination, details["directory_name"])
+        prepare_mod_dir(mod_id, source_mods, details["directory_name"])
 
     make_files_and_dirs_safe(source_mods)
     for mod_id, key_dir_name in MOD_ID_KEY_PAIRS.items():
@@ -71,3 +99,320 @@ def test_save_modlines(tmp_path):
         assert "main" in modlines and "recce" in modlines
         assert "@cba_a3" in modlines["main"] and "@ctab" in modlines["main"]
         assert "@enhanced_movement" in modlines["recce"]
+
+
+def make_synced_mods(tmp_path):
+    """Make a new version of a mod next to an old copy of it that is partly the same"""
+    import os
+    import shutil
+
+    source, destination = tmp_path / "new" / "@mod", tmp_path / "mods" / "@mod"
+    for mod_dir in (source, destination):
+        (mod_dir / "addons").mkdir(parents=True)
+    (source / "addons" / "same.pbo").write_text("unchanged")
+    shutil.copy2(source / "addons" / "same.pbo", destination / "addons" / "same.pbo")
+    (source / "addons" / "changed.pbo").write_text("new contents")
+    (destination / "addons" / "changed.pbo").write_text("old contents")
+    os.utime(destination / "addons" / "changed.pbo", (0, 0))
+    (source / "addons" / "added.pbo").write_text("added")
+    (destination / "addons" / "removed.pbo").write_text("removed")
+    (destination / "old_dir").mkdir()
+    return source, destination
+
+
+def test_sync_mod_dir(tmp_path):
+    """Check that only changed files are copied and that removed files are deleted"""
+    from app.files import SyncStats, sync_mod_dir
+
+    source, destination = make_synced_mods(tmp_path)
+    same_inode = (destination / "addons" / "same.pbo").stat().st_ino
+
+    stats = sync_mod_dir(source, destination)
+    assert stats == SyncStats(
+        copied_files=2, copied_bytes=17, skipped_files=1, skipped_bytes=9, deleted_files=1
+    )
+    assert sorted(path.name for path in (destination / "addons").iterdir()) == [
+        "added.pbo",
+        "changed.pbo",
+        "same.pbo",
+    ]
+    assert (destination / "addons" / "changed.pbo").read_text() == "new contents"
+    assert (destination / "addons" / "same.pbo").stat().st_ino == same_inode
+    assert not (destination / "old_dir").exists()
+    assert sorted(path.name for path in destination.parent.iterdir()) == ["@mod"]
+
+
+def test_sync_mod_dir_hash(tmp_path):
+    """Check that hashing catches changed files with the same size and time"""
+    import os
+    from app.files import sync_mod_dir
+
+    source, destination = make_synced_mods(tmp_path)
+    (destination / "addons" / "same.pbo").write_text("different")
+    source_stat = (source / "addons" / "same.pbo").stat()
+    os.utime(destination / "addons" / "same.pbo", ns=(0, source_stat.st_mtime_ns))
+
+    assert sync_mod_dir(source, destination).skipped_files == 1
+    (destination / "addons" / "same.pbo").write_text("different")
+    os.utime(destination / "addons" / "same.pbo", ns=(0, source_stat.st_mtime_ns))
+    assert sync_mod_dir(source, destination, use_hash=True).copied_files == 1
+    assert (destination / "addons" / "same.pbo").read_text() == "unchanged"
+
+
+def test_sync_mod_dir_fresh_download(tmp_path):
+    """Check that unchanged files that were downloaded again, and so have a new
+    modification time, aren't copied
+    """
+    import os
+    from app.files import sync_mod_dir
+
+    source, destination = make_synced_mods(tmp_path)
+    os.utime(source / "addons" / "same.pbo", (10 ** 9, 10 ** 9))
+
+    stats = sync_mod_dir(source, destination)
+    assert stats.skipped_files == 1 and stats.copied_files == 2
+
+
+def test_sync_mod_dir_in_place(tmp_path, monkeypatch):
+    """Check that mods are still synced on file systems without hard links"""
+    import os
+    from app.files import sync_mod_dir
+
+    def no_links(source, destination):
+        raise OSError("Operation not permitted")
+
+    monkeypatch.setattr(os, "link", no_links)
+    source, destination = make_synced_mods(tmp_path)
+    stats = sync_mod_dir(source, destination)
+    assert (stats.copied_files, stats.skipped_files, stats.deleted_files) == (2, 1, 1)
+    assert (destination / "addons" / "changed.pbo").read_text() == "new contents"
+    assert not (destination / "addons" / "removed.pbo").exists()
+    assert not (destination / "old_dir").exists()
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_get_safe_names_clashing(tmp_path, reverse):
+    """Check that every name in a group that would clash is left as it is, whatever
+    order the names come in
+    """
+    from app.files import get_safe_names
+
+    names = sorted(["Mod.pbo", "MOD.pbo", "mod.pbo", "Key.bikey", "Other.pbo"])
+    if reverse:
+        names.reverse()
+    assert get_safe_names(names, tmp_path) == {
+        "Key.bikey": "key.bikey",
+        "Other.pbo": "other.pbo",
+    }
+    names.remove("mod.pbo")
+    assert get_safe_names(names, tmp_path) == {
+        "Key.bikey": "key.bikey",
+        "Other.pbo": "other.pbo",
+    }
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_make_files_and_dirs_safe_single_pass(tmp_path, monkeypatch, max_workers):
+    """Check that only unsafe names are renamed, clashes are left alone and that key
+    directories are found
+    """
+    import os
+    from app.files import make_files_and_dirs_safe
+
+    mod_dir = tmp_path / "@mod"
+    (mod_dir / "Addons" / "Sub Dir").mkdir(parents=True)
+    (mod_dir / "Addons" / "Sub Dir" / "Deep File.PBO").write_text("deep")
+    (mod_dir / "Addons" / "safe.pbo").write_text("safe")
+    (mod_dir / "Addons" / "Clash.pbo").write_text("clash")
+    (mod_dir / "Addons" / "clash.pbo").write_text("lowercase clash")
+    (mod_dir / "Server Keys").mkdir()
+    (mod_dir / "Server Keys" / "Mod.bikey").write_text("key")
+    renamed = []
+    rename = os.rename
+
+    def recording_rename(source, destination):
+        renamed.append(Path(source).name)
+        rename(source, destination)
+
+    monkeypatch.setattr(os, "rename", recording_rename)
+    key_dirs = make_files_and_dirs_safe(mod_dir, max_workers)
+    assert key_dirs == [mod_dir / "server_keys"]
+    assert sorted(renamed) == [
+        "Addons",
+        "Deep File.PBO",
+        "Mod.bikey",
+        "Server Keys",
+        "Sub Dir",
+    ]
+    assert (mod_dir / "addons" / "sub_dir" / "deep_file.pbo").read_text() == "deep"
+    assert (mod_dir / "addons" / "Clash.pbo").read_text() == "clash"
+    assert (mod_dir / "addons" / "clash.pbo").read_text() == "lowercase clash"
+
+
+def test_copy_keys_found(tmp_path):
+    """Check that the keys in known or searched for key directories are copied"""
+    from app.files import copy_keys
+
+    mod_dir, keys_path = tmp_path / "@mod", tmp_path / "keys"
+    (mod_dir / "extras" / "keys").mkdir(parents=True)
+    (mod_dir / "extras" / "keys" / "mod.bikey").write_text("key")
+    keys_path.mkdir()
+    copy_keys(mod_dir, keys_path)
+    assert (keys_path / "mod.bikey").read_text() == "key"
+    (keys_path / "mod.bikey").unlink()
+    copy_keys(mod_dir, keys_path, [mod_dir / "extras" / "keys"])
+    assert (keys_path / "mod.bikey").read_text() == "key"
+
+
+def test_dependency_graph_round_trip(tmp_path):
+    """Check that a saved dependency graph is loaded back the same"""
+    from app.files import get_dependency_graph, save_dependency_graph
+
+    graph = get_dependency_graph(tmp_path)
+    assert graph.nodes == {}
+    graph.set_dependencies("1", 100, ["2"])
+    save_dependency_graph(tmp_path, graph)
+    assert get_dependency_graph(tmp_path).nodes == graph.nodes
+
+
+def test_get_directory_size(tmp_path, monkeypatch):
+    """Check that files moved away while the directory is walked are skipped"""
+    import os
+    from app.files import get_directory_size
+
+    assert get_directory_size(tmp_path / "missing") == 0
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "kept.pbo").write_bytes(b"12345")
+    (tmp_path / "gone.pbo").write_bytes(b"123")
+    getsize = os.path.getsize
+
+    def vanishing_getsize(path):
+        if path.endswith("gone.pbo"):
+            raise FileNotFoundError(path)
+        return getsize(path)
+
+    monkeypatch.setattr(os.path, "getsize", vanishing_getsize)
+    assert get_directory_size(tmp_path) == 5
+
+
+def test_verify_mod_dir(tmp_path):
+    """Check that truncated, changed, missing and unexpected files are found, and that
+    only files with a new modification time are hashed
+    """
+    import os
+    from app.files import hash_mod_dir, index_mod_dir, verify_mod_dir
+
+    mod_dir = tmp_path / "@mod"
+    (mod_dir / "addons").mkdir(parents=True)
+    for name in ("same", "touched", "truncated", "changed", "removed"):
+        (mod_dir / "addons" / f"{name}.pbo").write_text(f"{name} contents")
+    index = index_mod_dir(mod_dir, hash_mod_dir(mod_dir))
+    assert set(index) == {
+        f"addons/{name}.pbo"
+        for name in ("same", "touched", "truncated", "changed", "removed")
+    }
+    assert verify_mod_dir(mod_dir, index).problems == []
+
+    os.utime(mod_dir / "addons" / "touched.pbo", (0, 0))
+    (mod_dir / "addons" / "truncated.pbo").write_text("trunc")
+    (mod_dir / "addons" / "changed.pbo").write_text("CHANGED contents")
+    os.utime(mod_dir / "addons" / "changed.pbo", (0, 0))
+    (mod_dir / "addons" / "removed.pbo").unlink()
+    (mod_dir / "addons" / "added.pbo").write_text("added")
+    verification = verify_mod_dir(mod_dir, index)
+    assert verification.problems == [
+        "addons/removed.pbo is missing",
+        "addons/added.pbo is unexpected",
+        "addons/changed.pbo has different contents",
+        "addons/truncated.pbo is 5 bytes instead of 18",
+    ]
+    assert verification.hashed_files == 2
+    assert verification.file_index["addons/touched.pbo"].mtime_ns == 0
+    assert verify_mod_dir(tmp_path / "@missing", index).problems == [
+        "the mod directory is missing"
+    ]
+
+
+def test_copy_file(tmp_path, monkeypatch):
+    """Check that files are copied with their metadata, by the kernel or not"""
+    import os
+    from app import files
+
+    source = tmp_path / "source.pbo"
+    source.write_bytes(os.urandom(3 * 1024 ** 2 + 5))
+    os.utime(source, (10 ** 9, 10 ** 9))
+    monkeypatch.setattr(files, "KERNEL_COPY_MIN_SIZE", 1)
+    files.copy_file(source, tmp_path / "kernel.pbo")
+    monkeypatch.setattr(files, "copy_with_kernel", lambda *args: False)
+    files.copy_file(source, tmp_path / "python.pbo")
+    for name in ("kernel.pbo", "python.pbo"):
+        assert (tmp_path / name).read_bytes() == source.read_bytes()
+        assert (tmp_path / name).stat().st_mtime == 10 ** 9
+
+
+def test_transfer_mod_dir(tmp_path, monkeypatch):
+    """Check that mods are renamed into place on the same file system, and otherwise
+    copied next to the old version and swapped in
+    """
+    import os
+    from app import files
+
+    for name in ("@first", "@second"):
+        (tmp_path / "prepared" / name / "addons" / "empty").mkdir(parents=True)
+        (tmp_path / "prepared" / name / "addons" / "mod.pbo").write_text(name)
+        os.utime(tmp_path / "prepared" / name / "addons", (10 ** 9, 10 ** 9))
+    (tmp_path / "mods" / "@second" / "old_dir").mkdir(parents=True)
+
+    stats = files.transfer_mod_dir(
+        tmp_path / "prepared" / "@first", tmp_path / "mods" / "@first"
+    )
+    assert stats.renamed and stats.files == 1 and stats.bytes == 6
+
+    monkeypatch.setattr(files, "is_same_file_system", lambda first, second: False)
+    stats = files.transfer_mod_dir(
+        tmp_path / "prepared" / "@second", tmp_path / "mods" / "@second", 2
+    )
+    assert not stats.renamed and stats.files == 1 and stats.bytes == 7
+    assert sorted(path.name for path in (tmp_path / "mods").iterdir()) == [
+        "@first",
+        "@second",
+    ]
+    second = tmp_path / "mods" / "@second"
+    assert sorted(path.name for path in second.iterdir()) == ["addons"]
+    assert (second / "addons" / "mod.pbo").read_text() == "@second"
+    assert (second / "addons" / "empty").is_dir()
+    assert (second / "addons").stat().st_mtime == 10 ** 9
+    assert sorted(path.name for path in (tmp_path / "prepared").iterdir()) == []
+
+
+def test_link_mod_dir(tmp_path, monkeypatch):
+    """Check that the copy shares the downloaded files' data where it can and leaves the
+    downloaded mod as it is, falling back to copying
+    """
+    import os
+    from app import files
+
+    source = tmp_path / "content" / "1"
+    (source / "Addons" / "Empty").mkdir(parents=True)
+    (source / "Addons" / "Mod 1.pbo").write_text("mod junk")
+    (source / "Keys").mkdir()
+    (source / "Keys" / "Mod 1.bikey").write_text("key junk")
+
+    kinds = files.link_mod_dir(source, tmp_path / "linked" / "@mod", 2)
+    assert sum(kinds.values()) == 2
+    linked = tmp_path / "linked" / "@mod"
+    assert (linked / "Addons" / "Mod 1.pbo").read_text() == "mod junk"
+    assert (linked / "Addons" / "Empty").is_dir()
+    assert (source / "Keys" / "Mod 1.bikey").is_file()
+    if kinds["hardlink"]:
+        assert (source / "Keys" / "Mod 1.bikey").stat().st_nlink == 2
+        assert not (linked / "Keys" / "Mod 1.bikey").stat().st_mode & 0o222
+
+    def refuse(source, destination):
+        raise OSError("Not supported")
+
+    monkeypatch.setattr(files, "reflink_file", refuse)
+    monkeypatch.setattr(os, "link", refuse)
+    kinds = files.link_mod_dir(source, linked)
+    assert kinds == {"copy": 2}
+    assert (linked / "Keys" / "Mod 1.bikey").read_text() == "key junk"
@@ -0,0 +1,34 @@
+"""Tests for the dependency graph"""
+from app.graph import DependencyGraph
+
+
+def test_get_closure():
+    """Check that closures follow dependencies and are forgotten when the graph changes"""
+    graph = DependencyGraph()
+    graph.set_dependencies("1", 100, ["2", "3"])
+    graph.set_dependencies("2", 100, ["3"])
+    graph.set_dependencies("3", 100, ["1"])
+    graph.set_dependencies("4", 100, [])
+    assert graph.get_closure(["1"]) == {"1", "2", "3"}
+    assert graph.get_closure(["4", "5"]) == {"4", "5"}
+    graph.set_dependencies("3", 200, ["4"])
+    assert graph.get_closure(["1"]) == {"1", "2", "3", "4"}
+
+
+def test_is_current():
+    """Check that dependencies are only current for the time they were found at"""
+    graph = DependencyGraph()
+    graph.set_dependencies("1", 100, [])
+    assert graph.is_current("1", 100)
+    assert not graph.is_current("1", 200)
+    assert not graph.is_current("2", 100)
+
+
+def test_prune():
+    """Check that mods nothing depends on are forgotten"""
+    graph = DependencyGraph()
+    graph.set_dependencies("1", 100, ["2"])
+    graph.set_dependencies("2", 100, [])
+    graph.set_dependencies("3", 100, [])
+    graph.prune(["1"])
+    assert set(graph.nodes) == {"1", "2"}
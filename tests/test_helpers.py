@@ -10,3 +10,163 @@ def test_make_filename_safe():
         make_filename_safe("[BW] Bush Wars v1.3 (Recce Challenge Addition)")
         == "bw_bush_wars_v1.3_recce_challenge_addition"
     )
+
+
+class FakeResponse:
+    """Just enough of a requests response for the cache"""
+
+    def __init__(self, status_code=200, content=b"{}", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = "utf-8"
+        self.headers = headers or dict()
+
+
+def test_get_requests_object_fetches_once(monkeypatch):
+    """Check that threads asking for the same URL at once only cause a single fetch"""
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from app import helpers
+
+    calls = []
+
+    def fake_request(method, url, headers, timeout):
+        calls.append(url)
+        time.sleep(0.05)
+        return FakeResponse()
+
+    url = "https://example.com/only-once"
+    monkeypatch.setattr(helpers.SESSION, "request", fake_request)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(helpers.get_requests_object, [url] * 8))
+    assert calls == [url]
+    assert all(response.text == "{}" for response in responses)
+
+
+def test_get_requests_object_revalidates(monkeypatch):
+    """Check that a cached response is revalidated once per run and reused on a 304"""
+    from app import helpers
+
+    sent_headers = []
+
+    def fake_request(method, url, headers, timeout):
+        sent_headers.append(headers)
+        if headers.get("If-None-Match") == '"v1"':
+            return FakeResponse(status_code=304, content=b"")
+        return FakeResponse(content=b'{"a": 1}', headers={"ETag": '"v1"'})
+
+    url = "https://example.com/revalidated"
+    monkeypatch.setattr(helpers.SESSION, "request", fake_request)
+    assert helpers.get_requests_object(url).text == '{"a": 1}'
+    assert helpers.get_requests_object(url).text == '{"a": 1}'
+    assert sent_headers == [dict()]
+
+    # A new run
+    helpers.VALIDATED.discard(url)
+    response = helpers.get_requests_object(url)
+    assert response.status_code == 200 and response.text == '{"a": 1}'
+    assert sent_headers[1] == {"If-None-Match": '"v1"'}
+
+
+def test_get_requests_object_failed(monkeypatch):
+    """Check that server errors are retried a few times before giving up, and that
+    anything else but a successful response is refused straight away
+    """
+    import pytest
+    import requests
+    from app import helpers
+
+    calls = []
+
+    def fake_request(method, url, headers, timeout):
+        calls.append(url)
+        return FakeResponse(status_code=502 if url.endswith("broken") else 404)
+
+    monkeypatch.setattr(helpers.SESSION, "request", fake_request)
+    monkeypatch.setattr(helpers.CLIENT, "backoff", 0)
+    with pytest.raises(requests.HTTPError):
+        helpers.get_requests_object("https://example.com/broken")
+    assert len(calls) == helpers.CLIENT.retries + 1
+    with pytest.raises(requests.HTTPError):
+        helpers.get_requests_object("https://example.com/missing")
+    assert len(calls) == helpers.CLIENT.retries + 2
+
+
+def test_client_retries(monkeypatch):
+    """Check that throttled requests and dropped connections are retried, waiting as
+    long as the server asks, and that throttling halves how many requests are sent at
+    once
+    """
+    import requests
+    from app import client
+
+    responses = [
+        FakeResponse(status_code=429, headers={"Retry-After": "2"}),
+        requests.ConnectionError("Connection reset"),
+        FakeResponse(content=b"done"),
+    ]
+
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+    delays = []
+    monkeypatch.setattr(client.time, "sleep", delays.append)
+    steam = client.Client(FakeSession(), rate=0, max_concurrency=8, backoff=0.5)
+    assert steam.request("GET", "https://example.com/page").content == b"done"
+    assert delays[0] == 2
+    assert 0.5 <= delays[1] <= 1
+    limit = steam.get_limits("https://example.com/page")[1]
+    assert 2 < limit.limit < 3
+
+
+def test_token_bucket():
+    """Check that a burst is let straight through, and the rest at the given rate"""
+    from app.client import TokenBucket
+
+    now = [0.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+
+    bucket = TokenBucket(10, 2, clock=lambda: now[0], sleep=sleep)
+    assert [bucket.take() for _ in range(4)] == [0, 0, 0.1, 0.2]
+    now[0] = 10
+    assert bucket.take() == 0
+    assert waits == [0.1, 0.2]
+
+
+def test_evict_cache(monkeypatch, tmp_path):
+    """Check that stale and least recently used responses are evicted"""
+    import os
+    import time
+    from app import helpers
+
+    monkeypatch.setattr(helpers, "CACHE_PATH", tmp_path)
+    for number in range(3):
+        url = f"https://example.com/{number}"
+        helpers.write_cached(
+            helpers.CachedResponse(
+                url=url,
+                status_code=200,
+                content=b"x" * 100,
+                encoding="utf-8",
+                date="",
+                etag=None,
+                last_modified=None,
+            )
+        )
+        meta_path = helpers.get_cache_paths(url)[1]
+        last_used = time.time() - number * 100
+        os.utime(meta_path, (last_used, last_used))
+    entry_size = sum(path.stat().st_size for path in helpers.get_cache_paths(url))
+
+    helpers.evict_cache(ttl=150)
+    assert helpers.read_cached("https://example.com/2") is None
+    helpers.evict_cache(max_bytes=entry_size + 1)
+    assert helpers.read_cached("https://example.com/0") is not None
+    assert helpers.read_cached("https://example.com/1") is None
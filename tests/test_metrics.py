@@ -0,0 +1,39 @@
+"""Tests for run metrics"""
+
+
+def test_metrics_by_phase_and_mod():
+    """Check that counts add up per phase and per mod"""
+    from app.metrics import Metrics
+
+    metrics = Metrics()
+    metrics.add("download", "1", attempts=1)
+    metrics.add("download", "1", attempts=1, downloaded=1)
+    metrics.add("download", "2", attempts=1)
+    metrics.add("fetch", requests=1, bytes=100)
+    with metrics.time("rename", "1"):
+        pass
+    report = metrics.to_dict()
+    assert report["phases"]["download"] == {"attempts": 3, "downloaded": 1}
+    assert report["phases"]["fetch"] == {"requests": 1, "bytes": 100}
+    assert report["phases"]["rename"]["calls"] == 1
+    assert report["mods"]["1"]["download"] == {"attempts": 2, "downloaded": 1}
+    assert set(report["mods"]) == {"1", "2"}
+
+
+def test_metrics_to_prometheus():
+    """Check that the counts are written in the Prometheus text format"""
+    from app.metrics import Metrics
+
+    metrics = Metrics()
+    metrics.add("download", "1", attempts=2)
+    metrics.add("fetch", requests=3)
+    assert metrics.to_prometheus(last_run_exit_code=0).splitlines() == [
+        "# TYPE zamd_last_run_exit_code gauge",
+        "zamd_last_run_exit_code 0",
+        "# TYPE zamd_mod_attempts gauge",
+        'zamd_mod_attempts{mod_id="1",phase="download"} 2',
+        "# TYPE zamd_phase_attempts gauge",
+        'zamd_phase_attempts{phase="download"} 2',
+        "# TYPE zamd_phase_requests gauge",
+        'zamd_phase_requests{phase="fetch"} 3',
+    ]
@@ -0,0 +1,74 @@
+"""Tests for the state store"""
+import json
+
+
+def test_state_store_imports_mods_details(tmp_path):
+    """Check that an existing mods details file is taken over by a new store"""
+    from app.files import MODS_DETAILS_FILENAME
+    from app.state import StateStore
+    from tests.conftest import MODS_DETAILS
+
+    (tmp_path / MODS_DETAILS_FILENAME).write_text(json.dumps(MODS_DETAILS))
+    state = StateStore(tmp_path)
+    assert state.get_mods_details() == MODS_DETAILS
+    state.close()
+
+
+def test_state_store_persists_each_mod(tmp_path):
+    """Check that each recorded mod survives reopening and is exported"""
+    from app.files import MODS_DETAILS_FILENAME, get_current_mod_details
+    from app.state import StateStore
+
+    state = StateStore(tmp_path)
+    state.set_mod_details("1", {"title": "One", "updated": 100})
+    state.set_mod_details("2", {"title": "Two", "updated": 200})
+    state.set_mod_details("1", {"title": "One", "updated": 150})
+    state.close()
+    assert not (tmp_path / MODS_DETAILS_FILENAME).exists()
+
+    state = StateStore(tmp_path)
+    assert state.get_mods_details() == {
+        "1": {"title": "One", "updated": 150},
+        "2": {"title": "Two", "updated": 200},
+    }
+    state.export_mods_details()
+    state.close()
+    assert get_current_mod_details(tmp_path) == {
+        "1": {"title": "One", "updated": 150},
+        "2": {"title": "Two", "updated": 200},
+    }
+
+
+def test_state_store_reset(tmp_path):
+    """Check that resetting forgets everything and takes the mods details file again"""
+    from app.files import MODS_DETAILS_FILENAME
+    from app.state import StateStore
+
+    state = StateStore(tmp_path, tmp_path / "local" / "state.sqlite3")
+    state.set_mod_details("1", {"title": "One", "updated": 100})
+    state.set_value("manifest_hash", "abc")
+    (tmp_path / MODS_DETAILS_FILENAME).write_text(
+        json.dumps({"2": {"title": "Two", "updated": 200}})
+    )
+    state.reset()
+    assert state.get_mods_details() == {"2": {"title": "Two", "updated": 200}}
+    assert state.get_value("manifest_hash") is None
+    state.close()
+
+
+def test_state_store_file_index(tmp_path):
+    """Check that file indexes are kept per mod and forgotten along with their mods"""
+    from app.files import FileRecord
+    from app.state import StateStore
+
+    state = StateStore(tmp_path)
+    state.set_mods_details({"1": {"title": "One"}, "2": {"title": "Two"}})
+    state.set_file_index("1", {"a.pbo": FileRecord(1, 2, "abc")})
+    state.set_file_index("2", {"b.pbo": FileRecord(3, 4, "def")})
+    state.set_file_index("1", {"c.pbo": FileRecord(5, 6, "ghi")})
+    assert state.get_file_index("1") == {"c.pbo": FileRecord(5, 6, "ghi")}
+    state.forget_mods(["1"])
+    assert state.get_mods_details() == {"2": {"title": "Two"}}
+    assert state.get_file_index("1") == dict()
+    assert state.get_file_index("2") == {"b.pbo": FileRecord(3, 4, "def")}
+    state.close()
@@ -121,12 +121,14 @@ def test_detail_mods():
     details = {
         "450814997": {
             "title": "CBA_A3",
-            "updated": "10 Jan @ 7:24am",
+            "updated": 1547105040,
+            "file_size": 2089811,
             "directory_name": "@cba_a3",
         },
         "463939057": {
             "title": "ace",
-            "updated": "4 Dec, 2018 @ 9:14am",
+            "updated": 1543914840,
+            "file_size": 152591925,
             "directory_name": "@ace",
         },
     }
@@ -139,7 +141,8 @@ def test_detail_mods():
     current_details = {
         "450814997": {
             "title": "CBA_A3",
-            "updated": "10 Jan @ 7:24am",
+            "updated": 1547105040,
+            "file_size": 2089811,
             "directory_name": "@cba_a3",
         }
     }
@@ -157,3 +160,238 @@ def test_get_all_manifest_mods_details():
     from tests.conftest import MODS_DETAILS
 
     assert get_all_manifest_mods_details(MANIFEST_URL) == MODS_DETAILS
+
+
+def test_parse_file_size():
+    """Check that file sizes as displayed on workshop pages are converted to bytes"""
+    from app.steam_site import parse_file_size
+
+    assert parse_file_size("512 B") == 512
+    assert parse_file_size("1.5 KB") == 1536
+    assert parse_file_size("1.993 MB") == 2089811
+    assert parse_file_size("1,024.000 MB") == 1024 ** 3
+
+
+@pytest.mark.vcr()
+def test_get_workshop_page():
+    """Check that a workshop page is parsed into all of its details once"""
+    from app.steam_site import get_workshop_page
+
+    url = "https://steamcommunity.com/workshop/filedetails/?id=450814997"
+    page = get_workshop_page(url)
+    assert page.title == "CBA_A3"
+    assert page.updated == "10 Jan @ 7:24am"
+    assert page.time_updated == 1547105040
+    assert page.file_size == 2089811
+    assert page.dependencies == []
+    assert get_workshop_page(url) is page
+
+
+def test_get_workshop_page_parsed_again_if_changed(monkeypatch):
+    """Check that a page fetched again in a later run is only parsed again if it
+    changed
+    """
+    from app import helpers, steam_site
+    from benchmarks.corpus import SyntheticMod, render_workshop_page
+
+    mod = SyntheticMod("123", "First Title", 1500000000, 1024 ** 2, [])
+    pages = [render_workshop_page(mod, "https://example.com")]
+    monkeypatch.setattr(
+        helpers,
+        "get_requests_object",
+        lambda url: helpers.CachedResponse(
+            url, 200, pages[-1].encode(), "utf-8", "", None, None
+        ),
+    )
+    monkeypatch.setattr(steam_site, "PAGES", dict())
+    monkeypatch.setattr(steam_site, "PAGE_HASHES", dict())
+    parsed = []
+    parse_workshop_page = steam_site.parse_workshop_page
+    monkeypatch.setattr(
+        steam_site,
+        "parse_workshop_page",
+        lambda html, rendered: parsed.append(html) or parse_workshop_page(html, rendered),
+    )
+    url = steam_site.get_url_from_id("123")
+    page = steam_site.get_workshop_page(url)
+    assert steam_site.get_workshop_page(url) is page
+    assert len(parsed) == 1
+    pages.append(render_workshop_page(mod._replace(title="Second Title"), ""))
+    assert steam_site.get_workshop_page(url).title == "Second Title"
+    assert len(parsed) == 2
+
+
+def published_file(mod_id, title, time_updated, file_size, children=None):
+    """Make the published file details the Steam web API would give for a mod"""
+    details = {
+        "publishedfileid": mod_id,
+        "result": 1,
+        "title": title,
+        "time_updated": time_updated,
+        "file_size": file_size,
+    }
+    if children is not None:
+        details["children"] = [
+            {"publishedfileid": child, "sortorder": 0, "file_type": 0}
+            for child in children
+        ]
+    return details
+
+
+def test_get_published_file_details(fake_steam_api, monkeypatch):
+    """Check that mods are looked up in batches and unknown mods are left out"""
+    from app import steam_site
+
+    monkeypatch.setattr(steam_site, "API_BATCH_SIZE", 2)
+    fake_steam_api.published_files = {
+        "1": published_file("1", "One", 100, 10),
+        "2": published_file("2", "Two", 200, "20"),
+    }
+    details = steam_site.get_published_file_details(["2", "1", "3"])
+    assert set(details) == {"1", "2"}
+    assert details["2"]["title"] == "Two"
+    assert fake_steam_api.batches == [["1", "2"], ["3"]]
+
+
+def test_collect_all_dependencies_api(fake_steam_api):
+    """Check that each level of the dependency graph is looked up in a single batch"""
+    from app.steam_site import collect_all_dependencies, get_url_from_id
+
+    fake_steam_api.published_files = {
+        "1": published_file("1", "One", 100, 10, children=["2", "3"]),
+        "2": published_file("2", "Two", 200, 20, children=["4"]),
+        "3": published_file("3", "Three", 300, 30, children=["4"]),
+        "4": published_file("4", "Four", 400, 40, children=[]),
+    }
+    assert collect_all_dependencies([get_url_from_id("1")], backend="api") == {
+        get_url_from_id(mod_id) for mod_id in "1234"
+    }
+    assert fake_steam_api.batches == [["1"], ["2", "3"], ["4"]]
+
+
+def test_resolve_mods_details_api(fake_steam_api, monkeypatch):
+    """Check that the API's details are used and that missing mods are scraped"""
+    from app import steam_site
+    from app.graph import DependencyGraph
+
+    fake_steam_api.published_files = {
+        "1": published_file("1", "Some Mod", 1546816800, "12345", children=["2"])
+    }
+    scraped = []
+
+    def fake_get_workshop_page(url):
+        scraped.append(url)
+        return steam_site.WorkshopPage("Other Mod", "", 1546816860, 10, [])
+
+    monkeypatch.setattr(steam_site, "get_workshop_page", fake_get_workshop_page)
+    details = steam_site.resolve_mods_details(
+        {steam_site.get_url_from_id("1")}, DependencyGraph(), backend="api"
+    )
+    assert details["1"] == {
+        "title": "Some Mod",
+        "updated": 1546816800,
+        "file_size": 12345,
+        "directory_name": "@some_mod",
+    }
+    assert details["2"]["title"] == "Other Mod"
+    assert set(scraped) == {steam_site.get_url_from_id("2")}
+
+
+def test_parse_updated_date():
+    """Check that workshop dates become timestamps, with or without their year"""
+    from datetime import datetime, timezone
+    from app.steam_site import parse_updated_date
+
+    rendered = datetime(2019, 2, 28, 15, 5, tzinfo=timezone.utc)
+    assert parse_updated_date("10 Jan @ 7:24am", rendered) == 1547105040
+    assert parse_updated_date("10 May, 2018 @ 11:01am", rendered) == 1525950060
+    assert parse_updated_date("Jan 10, 2019 @ 7:24am", rendered) == 1547105040
+    # A year old date without a year would be in the future if it were this year
+    assert parse_updated_date("4 Dec @ 9:14am", rendered) == 1543914840
+    # The same date shown after the new year must not look like a change
+    new_year = datetime(2020, 1, 1, 0, 5, tzinfo=timezone.utc)
+    assert parse_updated_date("10 Jan, 2019 @ 7:24am", new_year) == 1547105040
+
+
+def test_resolve_mods_details_reuses_graph(fake_steam_api, monkeypatch):
+    """Check that dependencies are only scraped again for mods that were updated"""
+    from app import steam_site
+    from app.graph import DependencyGraph
+
+    fake_steam_api.published_files = {
+        "1": published_file("1", "One", 100, 10),
+        "2": published_file("2", "Two", 200, 20),
+        "3": published_file("3", "Three", 300, 30),
+    }
+    dependencies = {"1": ["2"], "2": ["3"], "3": []}
+    scraped = []
+
+    def fake_get_dependencies(url):
+        mod_id = steam_site.get_id_from_url(url)
+        scraped.append(mod_id)
+        return {
+            steam_site.get_url_from_id(dependency) for dependency in dependencies[mod_id]
+        }
+
+    monkeypatch.setattr(steam_site, "get_dependencies", fake_get_dependencies)
+    graph = DependencyGraph()
+    urls = [steam_site.get_url_from_id("1")]
+    details = steam_site.resolve_mods_details(urls, graph, backend="api")
+    assert set(details) == {"1", "2", "3"}
+    assert sorted(scraped) == ["1", "2", "3"]
+    assert graph.get_closure(["1"]) == {"1", "2", "3"}
+
+    scraped.clear()
+    steam_site.resolve_mods_details(urls, graph, backend="api")
+    assert scraped == []
+
+    fake_steam_api.published_files["2"] = published_file("2", "Two", 250, 20)
+    dependencies["2"] = []
+    steam_site.resolve_mods_details(urls, graph, backend="api")
+    assert scraped == ["2"]
+    assert graph.get_closure(["1"]) == {"1", "2"}
+
+
+def test_get_updated_timestamps(fake_steam_api, monkeypatch):
+    """Check that timestamps come from the API and missing mods are scraped"""
+    from app import steam_site
+
+    fake_steam_api.published_files = {"1": published_file("1", "One", 100, 10)}
+    monkeypatch.setattr(
+        steam_site,
+        "get_workshop_page",
+        lambda url: steam_site.WorkshopPage("Two", "", 200, 20, []),
+    )
+    assert steam_site.get_updated_timestamps(["1", "2"], backend="api") == {
+        "1": 60,
+        "2": 200,
+    }
+
+
+def test_api_and_scraped_timestamps_agree(fake_steam_api, monkeypatch):
+    """Check that a mod looks the same whether its details were scraped, which only
+    shows the minute, or came from the API, which has the seconds too
+    """
+    from app import steam_site
+    from app.download import get_mods_to_download
+    from app.graph import DependencyGraph
+
+    fake_steam_api.published_files = {
+        "1": published_file("1", "One", 1547105040 + 37, 10)
+    }
+    monkeypatch.setattr(
+        steam_site,
+        "get_workshop_page",
+        lambda url: steam_site.WorkshopPage("One", "", 1547105040, 10, []),
+    )
+    urls = {steam_site.get_url_from_id("1")}
+    scraped = steam_site.detail_mods(dict(), urls)
+    from_api = steam_site.resolve_mods_details(urls, DependencyGraph(), backend="api")
+    assert scraped["1"]["updated"] == from_api["1"]["updated"] == 1547105040
+    assert steam_site.get_updated_timestamps(
+        ["1"], backend="api"
+    ) == steam_site.get_updated_timestamps(["1"], backend="html")
+    assert get_mods_to_download(scraped, from_api) == set()
+    # Details recorded to the second by earlier runs don't count as changed either
+    recorded = {"1": dict(from_api["1"], updated=1547105077)}
+    assert get_mods_to_download(scraped, recorded) == set()
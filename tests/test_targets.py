@@ -0,0 +1,101 @@
+"""Test publishing to directories and blob storage"""
+import pytest
+
+
+def make_prepared_mod(directory, contents):
+    """Make a prepared mod with the given contents by relative path"""
+    for relative_path, text in contents.items():
+        (directory / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (directory / relative_path).write_text(text)
+    return directory
+
+
+def test_local_target(tmp_path):
+    """Check that mods are moved into the directory and files copied into it"""
+    from app.files import hash_mod_dir
+    from app.targets import get_target, LocalTarget
+
+    target = get_target(str(tmp_path / "mods"))
+    assert isinstance(target, LocalTarget)
+    (tmp_path / "mods").mkdir()
+    mod_path = make_prepared_mod(tmp_path / "@mod", {"addons/mod.pbo": "mod junk"})
+    index = target.put_mod("1", mod_path, "replace", hash_mod_dir(mod_path))
+    assert set(index) == {"addons/mod.pbo"}
+    assert (tmp_path / "mods" / "@mod" / "addons" / "mod.pbo").is_file()
+    assert not mod_path.exists()
+    (tmp_path / "mod.bikey").write_text("key junk")
+    target.put_file(tmp_path / "mod.bikey", "mod.bikey")
+    assert (tmp_path / "mods" / "mod.bikey").read_text() == "key junk"
+
+
+def test_blob_target(fake_blob_storage, tmp_path):
+    """Check that mods are uploaded in blocks, that unchanged files are skipped and
+    that files the mod no longer has are deleted
+    """
+    from app.files import hash_file, hash_mod_dir
+    from app.targets import BlobTarget, get_target
+
+    target = get_target(fake_blob_storage.url)
+    assert isinstance(target, BlobTarget)
+    target.chunk_size = 10
+    contents = {
+        "addons/large.pbo": "large junk " * 4,
+        "addons/small.pbo": "small",
+        "addons/removed.pbo": "removed",
+        "keys/mod.bikey": "key",
+    }
+    mod_path = make_prepared_mod(tmp_path / "@mod", contents)
+    index = target.put_mod("1", mod_path, "replace", hash_mod_dir(mod_path))
+    assert set(index) == set(contents)
+    assert not mod_path.exists()
+    blobs = fake_blob_storage.blobs
+    assert {name: data.decode() for name, (data, _) in blobs.items()} == {
+        f"@mod/{path}": text for path, text in contents.items()
+    }
+    assert blobs["@mod/addons/small.pbo"][1] == {"sha256": index["addons/small.pbo"].hash}
+    assert [request[2] for request in fake_blob_storage.requests].count("block") == 5
+
+    del contents["addons/removed.pbo"]
+    contents["addons/small.pbo"] = "SMALL"
+    fake_blob_storage.requests.clear()
+    mod_path = make_prepared_mod(tmp_path / "@mod", contents)
+    target.put_mod("1", mod_path, "hash", hash_mod_dir(mod_path))
+    assert sorted(blobs) == [f"@mod/{path}" for path in sorted(contents)]
+    assert blobs["@mod/addons/small.pbo"][0] == b"SMALL"
+    assert sorted(
+        (method, name)
+        for method, name, comp in fake_blob_storage.requests
+        if comp != "list"
+    ) == [("DELETE", "@mod/addons/removed.pbo"), ("PUT", "@mod/addons/small.pbo")]
+
+    (tmp_path / "mods_details.json").write_text("{}")
+    target.put_file(tmp_path / "mods_details.json", "mods_details.json")
+    target.put_file(tmp_path / "mods_details.json", "mods_details.json")
+    assert blobs["mods_details.json"][1] == {
+        "sha256": hash_file(tmp_path / "mods_details.json")
+    }
+    assert [request[0] for request in fake_blob_storage.requests].count("PUT") == 2
+
+
+def test_blob_target_refused(fake_blob_storage, tmp_path):
+    """Check that a failed request fails the upload"""
+    import requests
+    from app.targets import BlobTarget
+
+    target = BlobTarget(fake_blob_storage.url.replace("secret", "wrong"))
+    (tmp_path / "mod.bikey").write_text("key junk")
+    with pytest.raises(requests.HTTPError):
+        target.put_file(tmp_path / "mod.bikey", "mod.bikey")
+
+
+def test_blob_target_retried(fake_blob_storage, tmp_path):
+    """Check that requests the service fails are retried"""
+    from app.targets import BlobTarget
+
+    target = BlobTarget(fake_blob_storage.url)
+    target.client.backoff = 0
+    fake_blob_storage.failures = 2
+    (tmp_path / "mod.bikey").write_text("key junk")
+    target.put_file(tmp_path / "mod.bikey", "mod.bikey")
+    assert fake_blob_storage.blobs["mod.bikey"][0] == b"key junk"
+    assert fake_blob_storage.failures == 0
@@ -0,0 +1,59 @@
+"""Test verifying the published mods"""
+
+
+def publish_fake_mods(tmp_path):
+    """Publish two small mods with their files indexed, and one from before files were
+    indexed
+    """
+    from app.files import hash_mod_dir, index_mod_dir
+    from app.state import StateStore
+
+    mods = tmp_path / "mods"
+    state = StateStore(mods, tmp_path / "state.sqlite3")
+    for mod_id in ("1", "2", "3"):
+        mod_dir = mods / f"@mod_{mod_id}"
+        (mod_dir / "addons").mkdir(parents=True)
+        (mod_dir / "addons" / f"mod_{mod_id}.pbo").write_text("mod junk " * 10)
+        state.set_mod_details(mod_id, {"title": mod_id, "directory_name": mod_dir.name})
+        if mod_id != "3":
+            state.set_file_index(mod_id, index_mod_dir(mod_dir, hash_mod_dir(mod_dir)))
+    return mods, state
+
+
+def test_verify_mods(tmp_path):
+    """Check that only corrupt mods are reported and that unindexed mods are indexed"""
+    from app.verify import forget_corrupt_mods, verify_mods
+
+    mods, state = publish_fake_mods(tmp_path)
+    (mods / "@mod_2" / "addons" / "mod_2.pbo").write_text("mod junk")
+    assert verify_mods(mods, state) == {
+        "2": ["addons/mod_2.pbo is 8 bytes instead of 90"]
+    }
+    assert set(state.get_file_index("3")) == {"addons/mod_3.pbo"}
+
+    forget_corrupt_mods(state, {"2": []})
+    assert set(state.get_mods_details()) == {"1", "3"}
+    assert verify_mods(mods, state) == dict()
+    state.close()
+
+
+def test_verify_command(tmp_path):
+    """Check that the verify command fails on corrupt mods and can forget them"""
+    from click.testing import CliRunner
+    from app.verify import EXIT_CORRUPT, EXIT_VERIFIED, verify
+
+    mods, state = publish_fake_mods(tmp_path)
+    state.close()
+    (mods / "@mod_1" / "addons" / "mod_1.pbo").unlink()
+    arguments = [
+        *("--mods_path", str(mods), "--download_path", str(tmp_path)),
+        *("--state_path", str(tmp_path / "state.sqlite3")),
+    ]
+    result = CliRunner().invoke(verify, arguments)
+    assert result.exit_code == EXIT_CORRUPT, result.output
+    assert "WARNING: @mod_1: addons/mod_1.pbo is missing!" in result.output
+
+    result = CliRunner().invoke(verify, [*arguments, "--repair"])
+    assert result.exit_code == EXIT_CORRUPT, result.output
+    result = CliRunner().invoke(verify, arguments)
+    assert result.exit_code == EXIT_VERIFIED, result.output